@@ -0,0 +1,130 @@
+from array import array
+from BasePairUtils import BasePairUtils
+import heapq
+
+
+class AlignedSegmentCache(object):
+
+    # mates share a query name; the first/last segment bits of the flag tell them apart
+    BAM_FMATE = 0x40 | 0x80
+
+    def __init__(self):
+        self._aligned_segment_descriptors = {}
+        self._reference_ends = []  # heap of (reference end, key) for eviction
+
+    def __len__(self):
+        return len(self._aligned_segment_descriptors)
+
+    @staticmethod
+    def retrieve_key(aligned_segment):
+        return aligned_segment.query_name, aligned_segment.flag & AlignedSegmentCache.BAM_FMATE
+
+    def retrieve(self, aligned_segment):
+        key = AlignedSegmentCache.retrieve_key(aligned_segment)
+        aligned_segment_descriptor = self._aligned_segment_descriptors.get(key)
+        if aligned_segment_descriptor is None:
+            aligned_segment_descriptor = AlignedSegmentCache.AlignedSegmentDescriptor.create(aligned_segment)
+            self._aligned_segment_descriptors[key] = aligned_segment_descriptor
+            heapq.heappush(self._reference_ends, (aligned_segment_descriptor.reference_end, key))
+        return aligned_segment_descriptor
+
+    def evict(self, position):
+        # drops every read that ends at or before position, i.e. has left a window starting at position
+        while self._reference_ends and self._reference_ends[0][0] <= position:
+            _, key = heapq.heappop(self._reference_ends)
+            self._aligned_segment_descriptors.pop(key, None)
+
+    class AlignedSegmentDescriptor(object):
+
+        def __init__(self, reference_start, reference_end, query_positions, query_sequence,
+                     leading_soft_clipped_length, trailing_soft_clipped_length, soft_clipped_region_count):
+            self._reference_start = reference_start
+            self._reference_end = reference_end
+            self._query_positions = query_positions
+            self._query_sequence = query_sequence
+            self._leading_soft_clipped_length = leading_soft_clipped_length
+            self._trailing_soft_clipped_length = trailing_soft_clipped_length
+            self._soft_clipped_region_count = soft_clipped_region_count
+
+        @property
+        def reference_start(self):
+            return self._reference_start
+
+        @property
+        def reference_end(self):
+            return self._reference_end
+
+        @property
+        def query_positions(self):
+            return self._query_positions
+
+        @property
+        def query_sequence(self):
+            return self._query_sequence
+
+        @property
+        def leading_soft_clipped_length(self):
+            return self._leading_soft_clipped_length
+
+        @property
+        def trailing_soft_clipped_length(self):
+            return self._trailing_soft_clipped_length
+
+        @property
+        def soft_clipped_region_count(self):
+            return self._soft_clipped_region_count
+
+        def retrieve_query_position(self, position):
+            # None outside the aligned region, for deletions and for reference skips
+            if not self._reference_start <= position < self._reference_end:
+                return None
+            query_position = self._query_positions[position - self._reference_start]
+            return None if query_position < 0 else query_position
+
+        def retrieve_base(self, query_position):
+            return self._query_sequence[query_position]
+
+        def is_soft_clipped(self, position):
+            return not self._reference_start <= position < self._reference_end
+
+        def is_ins_adjacent(self, position):
+            # an insertion right before or right after the aligned base at position
+            query_position = self.retrieve_query_position(position)
+            if query_position is None:
+                return False
+            next_query_position = self.retrieve_query_position(position + 1)
+            previous_query_position = self.retrieve_query_position(position - 1)
+            return (next_query_position is not None and next_query_position - query_position > 1) or \
+                (previous_query_position is not None and query_position - previous_query_position > 1)
+
+        def retrieve_soft_clipped_region_length(self, position):
+            if position < self._reference_start:
+                return self._leading_soft_clipped_length
+            elif position >= self._reference_end:
+                return self._trailing_soft_clipped_length
+            return 0
+
+        @staticmethod
+        def create(aligned_segment):
+            reference_start = aligned_segment.reference_start
+            reference_end = aligned_segment.reference_end
+
+            # reference offset -> query position, -1 for deletions and reference skips
+            query_positions = array("i", [-1]) * (reference_end - reference_start)
+            for query_position, reference_position in aligned_segment.get_aligned_pairs(matches_only=True):
+                query_positions[reference_position - reference_start] = query_position
+
+            cigartuples = aligned_segment.cigartuples or []
+            leading_soft_clipped_length = cigartuples[0][1] if cigartuples and \
+                cigartuples[0][0] == BasePairUtils.BAM_CSOFT_CLIP else 0
+            trailing_soft_clipped_length = cigartuples[-1][1] if len(cigartuples) > 1 and \
+                cigartuples[-1][0] == BasePairUtils.BAM_CSOFT_CLIP else 0
+            soft_clipped_region_count = len([cigartuple for cigartuple in cigartuples
+                                             if cigartuple[0] == BasePairUtils.BAM_CSOFT_CLIP])
+
+            return AlignedSegmentCache.AlignedSegmentDescriptor(
+                reference_start=reference_start, reference_end=reference_end, query_positions=query_positions,
+                query_sequence=aligned_segment.query_sequence,
+                leading_soft_clipped_length=leading_soft_clipped_length,
+                trailing_soft_clipped_length=trailing_soft_clipped_length,
+                soft_clipped_region_count=soft_clipped_region_count)
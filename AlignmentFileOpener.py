@@ -0,0 +1,104 @@
+import hashlib
+import os
+from pysam import AlignmentFile
+from pysam import FastaFile
+
+
+class AlignmentFileOpener(object):
+
+    # Opens sample alignments, BAM or CRAM, with io_threads htslib (de)compression threads each. CRAMs are decoded
+    # against the run's reference. With a reference cache directory, each contig a CRAM needs is written there once,
+    # upper cased and named by its MD5 as htslib's REF_CACHE expects; htslib then reads those files instead of
+    # parsing the fasta again every time a CRAM is opened (and never goes looking for the reference online).
+    CRAM_MAGIC = b"CRAM"
+    DEFAULT_IO_THREADS = 1
+    REF_CACHE_PATTERN = "%2s/%2s/%s"
+    MD5_TAG = "M5"
+    NON_PRINTABLE_BASES = bytes(bytearray(list(range(ord("!"))) + list(range(ord("~") + 1, 256))))
+
+    def __init__(self, ref_seq_filename, io_threads=None, ref_cache_dirname=None):
+        self._ref_seq_filename = ref_seq_filename
+        self._io_threads = AlignmentFileOpener.DEFAULT_IO_THREADS if io_threads is None else io_threads
+        self._ref_cache_dirname = ref_cache_dirname
+        if ref_cache_dirname is not None:
+            # htslib reads both when it resolves a CRAM's reference by MD5
+            ref_cache_pattern = os.path.join(os.path.abspath(ref_cache_dirname), AlignmentFileOpener.REF_CACHE_PATTERN)
+            os.environ["REF_CACHE"] = ref_cache_pattern
+            os.environ["REF_PATH"] = ref_cache_pattern
+
+    @property
+    def ref_seq_filename(self):
+        return self._ref_seq_filename
+
+    @property
+    def io_threads(self):
+        return self._io_threads
+
+    @property
+    def ref_cache_dirname(self):
+        return self._ref_cache_dirname
+
+    @staticmethod
+    def is_cram(sample_bam_filename):
+        with open(sample_bam_filename, "rb") as sample_bam_file:
+            return sample_bam_file.read(len(AlignmentFileOpener.CRAM_MAGIC)) == AlignmentFileOpener.CRAM_MAGIC
+
+    def open(self, sample_bam_filename):
+        if not AlignmentFileOpener.is_cram(sample_bam_filename):
+            return AlignmentFile(sample_bam_filename, "rb", threads=self._io_threads)
+        sample_cram_file = AlignmentFile(sample_bam_filename, "rc", threads=self._io_threads,
+                                         reference_filename=self._ref_seq_filename)
+        if self._ref_cache_dirname is None or not self._insert_ref_cache(sample_cram_file.header.to_dict()):
+            return sample_cram_file
+        # every contig is cached: reopened without the fasta, so that htslib decodes against the cache
+        sample_cram_file.close()
+        return AlignmentFile(sample_bam_filename, "rc", threads=self._io_threads)
+
+    def retrieve_ref_cache_filename(self, md5):
+        return os.path.join(self._ref_cache_dirname, md5[:2], md5[2:4], md5[4:])
+
+    def _insert_ref_cache(self, header):
+        # caches every contig of a CRAM header missing from the cache; False when one cannot be (no M5 tag, or
+        # the fasta's contig differs from the one the CRAM was written against)
+        ref_seq_file = None
+        try:
+            for sequence in header.get("SQ", []):
+                md5 = sequence.get(AlignmentFileOpener.MD5_TAG)
+                if md5 is None:
+                    return False
+                ref_cache_filename = self.retrieve_ref_cache_filename(md5.lower())
+                if os.path.exists(ref_cache_filename):
+                    continue
+                if ref_seq_file is None:
+                    ref_seq_file = FastaFile(self._ref_seq_filename)
+                if sequence["SN"] not in ref_seq_file.references:
+                    return False
+                # the M5 of a contig covers its upper cased, printable bases only
+                ref_seq = ref_seq_file.fetch(sequence["SN"]).upper().encode("ascii").translate(
+                    None, AlignmentFileOpener.NON_PRINTABLE_BASES)
+                if hashlib.md5(ref_seq).hexdigest() != md5.lower():
+                    return False
+                AlignmentFileOpener._write_ref_cache(ref_cache_filename, ref_seq)
+        finally:
+            if ref_seq_file is not None:
+                ref_seq_file.close()
+        return True
+
+    @staticmethod
+    def _write_ref_cache(ref_cache_filename, ref_seq):
+        ref_cache_dirname = os.path.dirname(ref_cache_filename)
+        if not os.path.isdir(ref_cache_dirname):
+            try:
+                os.makedirs(ref_cache_dirname)
+            except OSError:  # created meanwhile by another worker
+                if not os.path.isdir(ref_cache_dirname):
+                    raise
+        # written under a temporary name and renamed so that concurrent readers never see a partial file
+        temporary_filename = "%s.%d.tmp" % (ref_cache_filename, os.getpid())
+        try:
+            with open(temporary_filename, "wb") as ref_cache_file:
+                ref_cache_file.write(ref_seq)
+            os.rename(temporary_filename, ref_cache_filename)
+        finally:
+            if os.path.exists(temporary_filename):
+                os.remove(temporary_filename)
@@ -18,20 +18,6 @@ class ArtifactAnalysisTable(object):
         self._alt_overlapping_aligned_segment_count = alt_overlapping_aligned_segment_count
         self._ref_overlapping_aligned_segment_count = ref_overlapping_aligned_segment_count
 
-        # Pre-computed values for contingency table
-        self._log_total_alt_col_bp_count = math.log(alt_non_ref_pileupread_bp_count + alt_ref_pileupread_bp_count +
-                                                    ArtifactAnalysisTableUtils.EPS)  # col 1 margin
-        self._log_total_ref_col_bp_count = math.log(ref_non_ref_pileupread_bp_count + ref_ref_pileupread_bp_count +
-                                                    ArtifactAnalysisTableUtils.EPS)  # col 2 margin
-        self._log_total_non_ref_row_bp_count = math.log(alt_non_ref_pileupread_bp_count +
-                                                        ref_non_ref_pileupread_bp_count +
-                                                        ArtifactAnalysisTableUtils.EPS)  # row 1 margin
-        self._log_total_ref_row_bp_count = math.log(alt_ref_pileupread_bp_count + ref_ref_pileupread_bp_count +
-                                                    ArtifactAnalysisTableUtils.EPS)  # row 2 margin
-        self._log_total_bp_count = math.log(alt_non_ref_pileupread_bp_count + alt_ref_pileupread_bp_count +
-                                            ref_non_ref_pileupread_bp_count + ref_ref_pileupread_bp_count +
-                                            ArtifactAnalysisTableUtils.EPS)  # total count
-
         alt_non_ref_soft_clipped_pileupread_bp_count = alt_non_ref_pileupread_bp_count + \
             alt_soft_clipped_pileupread_bp_count
         ref_non_ref_soft_clipped_pileupread_bp_count = ref_non_ref_pileupread_bp_count + \
@@ -40,62 +26,98 @@ class ArtifactAnalysisTable(object):
         self._alt_ref_soft_clipped_pileupread_bp_count = alt_ref_pileupread_bp_count
         self._ref_non_ref_soft_clipped_pileupread_bp_count = ref_non_ref_soft_clipped_pileupread_bp_count
         self._ref_ref_soft_clipped_pileupread_bp_count = ref_ref_pileupread_bp_count
+
+        self._is_log_margins_loaded = False  # the margins below are only worked out once an expected count is read
+
+    def _load_log_margins(self):
+        if self._is_log_margins_loaded:
+            return
+        self._is_log_margins_loaded = True
+
+        # Pre-computed values for contingency table
+        self._log_total_alt_col_bp_count = math.log(self._alt_non_ref_pileupread_bp_count +
+                                                    self._alt_ref_pileupread_bp_count +
+                                                    ArtifactAnalysisTableUtils.EPS)  # col 1 margin
+        self._log_total_ref_col_bp_count = math.log(self._ref_non_ref_pileupread_bp_count +
+                                                    self._ref_ref_pileupread_bp_count +
+                                                    ArtifactAnalysisTableUtils.EPS)  # col 2 margin
+        self._log_total_non_ref_row_bp_count = math.log(self._alt_non_ref_pileupread_bp_count +
+                                                        self._ref_non_ref_pileupread_bp_count +
+                                                        ArtifactAnalysisTableUtils.EPS)  # row 1 margin
+        self._log_total_ref_row_bp_count = math.log(self._alt_ref_pileupread_bp_count +
+                                                    self._ref_ref_pileupread_bp_count +
+                                                    ArtifactAnalysisTableUtils.EPS)  # row 2 margin
+        self._log_total_bp_count = math.log(self._alt_non_ref_pileupread_bp_count +
+                                            self._alt_ref_pileupread_bp_count +
+                                            self._ref_non_ref_pileupread_bp_count +
+                                            self._ref_ref_pileupread_bp_count +
+                                            ArtifactAnalysisTableUtils.EPS)  # total count
+
         self._log_total_alt_col_soft_clipped_bp_count = \
-            math.log(alt_non_ref_soft_clipped_pileupread_bp_count + alt_ref_pileupread_bp_count +
+            math.log(self._alt_non_ref_soft_clipped_pileupread_bp_count + self._alt_ref_pileupread_bp_count +
                      ArtifactAnalysisTableUtils.EPS)  # col 1 margin
         self._log_total_ref_col_soft_clipped_bp_count = \
-            math.log(ref_non_ref_soft_clipped_pileupread_bp_count + ref_ref_pileupread_bp_count +
+            math.log(self._ref_non_ref_soft_clipped_pileupread_bp_count + self._ref_ref_pileupread_bp_count +
                      ArtifactAnalysisTableUtils.EPS)  # col 2 margin
         self._log_total_non_ref_row_soft_clipped_bp_count = \
-            math.log(alt_non_ref_soft_clipped_pileupread_bp_count + ref_non_ref_soft_clipped_pileupread_bp_count +
+            math.log(self._alt_non_ref_soft_clipped_pileupread_bp_count +
+                     self._ref_non_ref_soft_clipped_pileupread_bp_count +
                      ArtifactAnalysisTableUtils.EPS)  # row 1 margin
         self._log_total_ref_row_soft_clipped_bp_count = \
-            math.log(alt_ref_pileupread_bp_count + ref_ref_pileupread_bp_count +
+            math.log(self._alt_ref_pileupread_bp_count + self._ref_ref_pileupread_bp_count +
                      ArtifactAnalysisTableUtils.EPS)  # row 2 margin
         self._log_total_soft_clipped_bp_count = \
-            math.log(alt_non_ref_soft_clipped_pileupread_bp_count + alt_ref_pileupread_bp_count +
-                     ref_non_ref_soft_clipped_pileupread_bp_count + ref_ref_pileupread_bp_count +
+            math.log(self._alt_non_ref_soft_clipped_pileupread_bp_count + self._alt_ref_pileupread_bp_count +
+                     self._ref_non_ref_soft_clipped_pileupread_bp_count + self._ref_ref_pileupread_bp_count +
                      ArtifactAnalysisTableUtils.EPS)  # total count
 
     @property
     def expected_alt_non_ref_pileupread_bp_count(self):
+        self._load_log_margins()
         return math.exp(self._log_total_alt_col_bp_count + self._log_total_non_ref_row_bp_count -
                         self._log_total_bp_count)
 
     @property
     def expected_alt_ref_pileupread_bp_count(self):
+        self._load_log_margins()
         return math.exp(self._log_total_alt_col_bp_count + self._log_total_ref_row_bp_count - self._log_total_bp_count)
 
     @property
     def expected_ref_non_ref_pileupread_bp_count(self):
+        self._load_log_margins()
         return math.exp(self._log_total_ref_col_bp_count + self._log_total_non_ref_row_bp_count -
                         self._log_total_bp_count)
 
     @property
     def expected_ref_ref_pileupread_bp_count(self):
+        self._load_log_margins()
         return math.exp(self._log_total_ref_col_bp_count + self._log_total_ref_row_bp_count -
                         self._log_total_bp_count)
 
     @property
     def expected_alt_non_ref_soft_clipped_pileupread_bp_count(self):
+        self._load_log_margins()
         return math.exp(self._log_total_alt_col_soft_clipped_bp_count +
                         self._log_total_non_ref_row_soft_clipped_bp_count -
                         self._log_total_soft_clipped_bp_count)
 
     @property
     def expected_alt_ref_soft_clipped_pileupread_bp_count(self):
+        self._load_log_margins()
         return math.exp(self._log_total_alt_col_soft_clipped_bp_count +
                         self._log_total_ref_row_soft_clipped_bp_count -
                         self._log_total_soft_clipped_bp_count)
 
     @property
     def expected_ref_non_ref_soft_clipped_pileupread_bp_count(self):
+        self._load_log_margins()
         return math.exp(self._log_total_ref_col_soft_clipped_bp_count +
                         self._log_total_non_ref_row_soft_clipped_bp_count -
                         self._log_total_soft_clipped_bp_count)
 
     @property
     def expected_ref_ref_soft_clipped_pileupread_bp_count(self):
+        self._load_log_margins()
         return math.exp(self._log_total_ref_col_soft_clipped_bp_count +
                         self._log_total_ref_row_soft_clipped_bp_count -
                         self._log_total_soft_clipped_bp_count)
@@ -153,11 +175,10 @@ class ArtifactAnalysisTable(object):
         ref_overlapping_aligned_segment_count = 0
         alt_overlapping_aligned_segment_count = 0
 
-        pileupread_alignment_query_names = []
-        ref_supporting_pileupread_alignment_query_names = []
-        alt_supporting_pileupread_alignment_query_names = []
+        # sets, so that membership stays constant time at high depth
+        ref_supporting_pileupread_alignment_query_names = set()
+        alt_supporting_pileupread_alignment_query_names = set()
 
-        ref_alleles = ArtifactAnalysisTableUtils.retrieve_ref_alleles(pileupcolumn_knapsack)
         for pileupread in pileupcolumn.pileups:
             pileupread_alignment_query_name = pileupread.alignment.query_name
 
@@ -179,41 +200,28 @@ class ArtifactAnalysisTable(object):
                         pileupread_alignment_query_name in ref_supporting_pileupread_alignment_query_names):
                 pass  # alt/ref supporting mate pairs
             elif not is_indel and is_ref and not is_alt:  # ref supporting read
-                pileupread_alignment_query_names += [pileupread_alignment_query_name]
-                ref_supporting_pileupread_alignment_query_names += [pileupread_alignment_query_name]
+                ref_supporting_pileupread_alignment_query_names.add(pileupread_alignment_query_name)
             elif not is_indel and not is_ref and is_alt:  # alt supporting read
-                pileupread_alignment_query_names += [pileupread_alignment_query_name]
-                alt_supporting_pileupread_alignment_query_names += [pileupread_alignment_query_name]
+                alt_supporting_pileupread_alignment_query_names.add(pileupread_alignment_query_name)
             else:  # indel based pivots and non-biallelic leftovers
                 pass  # do nothing
 
         # TODO: what happens when the read is ref supporting but it's mate is alt supporting?
         indexed_pileupreads = \
             ArtifactAnalysisTableUtils.retrieve_indexed_pileupreads(pileupcolumn_knapsack,
-                                                                    pileupread_alignment_query_names,
+                                                                    ref_supporting_pileupread_alignment_query_names |
+                                                                    alt_supporting_pileupread_alignment_query_names,
                                                                     pileupcolumn_mask)
-
-        # ref supporting counts
-        ref_ref_pileupread_bp_count = \
-            ArtifactAnalysisTableUtils.retrieve_ref_bp_count(indexed_pileupreads, ref_alleles,
-                ref_supporting_pileupread_alignment_query_names)
-        ref_non_ref_pileupread_bp_count = \
-            ArtifactAnalysisTableUtils.retrieve_non_ref_bp_count(indexed_pileupreads, ref_alleles,
-                ref_supporting_pileupread_alignment_query_names)
-        ref_soft_clipped_pileupread_bp_count = \
-            ArtifactAnalysisTableUtils.retrieve_soft_clipped_bp_count(indexed_pileupreads,
-                ref_supporting_pileupread_alignment_query_names)
-
-        # alt supporting counts
-        alt_ref_pileupread_bp_count = \
-            ArtifactAnalysisTableUtils.retrieve_ref_bp_count(indexed_pileupreads, ref_alleles,
-                alt_supporting_pileupread_alignment_query_names)
-        alt_non_ref_pileupread_bp_count = \
-            ArtifactAnalysisTableUtils.retrieve_non_ref_bp_count(indexed_pileupreads, ref_alleles,
-                alt_supporting_pileupread_alignment_query_names)
-        alt_soft_clipped_pileupread_bp_count = \
-            ArtifactAnalysisTableUtils.retrieve_soft_clipped_bp_count(indexed_pileupreads,
-                alt_supporting_pileupread_alignment_query_names)
+        # only the pysam based knapsack needs the reference alleles; the others count on their own
+        ref_alleles = None if hasattr(indexed_pileupreads, "retrieve_bp_counts") else \
+            ArtifactAnalysisTableUtils.retrieve_ref_alleles(pileupcolumn_knapsack)
+
+        # ref and alt supporting counts, all in one pass over the indexed reads
+        ref_ref_pileupread_bp_count, ref_non_ref_pileupread_bp_count, ref_soft_clipped_pileupread_bp_count, \
+            alt_ref_pileupread_bp_count, alt_non_ref_pileupread_bp_count, alt_soft_clipped_pileupread_bp_count = \
+            ArtifactAnalysisTableUtils.retrieve_bp_counts(indexed_pileupreads, ref_alleles,
+                                                          ref_supporting_pileupread_alignment_query_names,
+                                                          alt_supporting_pileupread_alignment_query_names)
 
         return ArtifactAnalysisTable(alt_non_ref_pileupread_bp_count=alt_non_ref_pileupread_bp_count,
                                      alt_ref_pileupread_bp_count=alt_ref_pileupread_bp_count,
@@ -15,18 +15,22 @@ class ArtifactAnalysisTableUtils():
 
     @staticmethod
     def pileupread_has_alt_allele(pileupread, alt_allele):
-        return bool(~ArtifactAnalysisTableUtils.pileupread_has_indel(pileupread) &
-                    (pileupread.alignment.query_sequence[pileupread.query_position] == alt_allele))
+        return bool(not ArtifactAnalysisTableUtils.pileupread_has_indel(pileupread) and
+                    pileupread.query_position is not None and
+                    pileupread.alignment.query_sequence[pileupread.query_position] == alt_allele)
 
     @staticmethod
     def pileupread_has_ref_allele(pileupread, ref_allele):
         # soft clip regions are discarded
-        return bool(~ArtifactAnalysisTableUtils.pileupread_has_indel(pileupread) &
-                    (pileupread.alignment.query_sequence[pileupread.query_position] == ref_allele))
+        return bool(not ArtifactAnalysisTableUtils.pileupread_has_indel(pileupread) and
+                    pileupread.query_position is not None and
+                    pileupread.alignment.query_sequence[pileupread.query_position] == ref_allele)
 
     @staticmethod
     def _retrieve_non_ref_length(pileupread, ref_allele, binarize_length=True):
         length = 0
+        if pileupread.query_position is None:  # deletions and reference skips carry no base
+            return length
         if not pileupread.is_del and pileupread.indel > 0:
             if binarize_length:
                 length += 1  # for the subsequent insertion
@@ -48,15 +52,17 @@ class ArtifactAnalysisTableUtils():
 
     @staticmethod
     def retrieve_indexed_pileupreads(pileupcolumn_knapsack, pileupread_alignment_query_names, pileupcolumn_mask):
+        if hasattr(pileupcolumn_knapsack, "retrieve_indexed_pileupreads"):  # columnar, see PileupColumnMatrix
+            return pileupcolumn_knapsack.retrieve_indexed_pileupreads(pileupread_alignment_query_names,
+                                                                      pileupcolumn_mask)
+        pileupread_alignment_query_names = set(pileupread_alignment_query_names)
         indexed_pileupreads = OrderedDict()
-        for pileupcolumn_name in pileupcolumn_knapsack.pileupcolumn_names:
-            if not pileupcolumn_mask[pileupcolumn_name]:  # pileupcolumn is not masked
-                indexed_pileupreads[pileupcolumn_name] = []
-                for pileupread_alignment_query_name in pileupread_alignment_query_names:
-                    pileupread = pileupcolumn_knapsack.retrieve_pileupread(pileupcolumn_name,
-                                                                           pileupread_alignment_query_name)
-                    if pileupread:
-                        indexed_pileupreads[pileupcolumn_name] += [pileupread]
+        for pileupcolumn_name, pileupread_knapsack in pileupcolumn_knapsack.pileupread_knapsacks.items():
+            if not pileupcolumn_mask.get(pileupcolumn_name, True):  # pileupcolumn is not masked
+                pileupreads = pileupread_knapsack.pileupreads
+                indexed_pileupreads[pileupcolumn_name] = \
+                    [pileupreads[pileupread_alignment_query_name] for pileupread_alignment_query_name in pileupreads
+                     if pileupread_alignment_query_name in pileupread_alignment_query_names]
         return indexed_pileupreads
 
     @staticmethod
@@ -70,6 +76,8 @@ class ArtifactAnalysisTableUtils():
 
     @staticmethod
     def retrieve_ref_bp_count(indexed_pileupreads, ref_alleles, pileupread_alignment_query_names=None):
+        if hasattr(indexed_pileupreads, "retrieve_ref_bp_count"):
+            return indexed_pileupreads.retrieve_ref_bp_count(pileupread_alignment_query_names)
         pileupread_alignment_query_names = [] if not pileupread_alignment_query_names else \
             pileupread_alignment_query_names
         count = 0
@@ -85,6 +93,8 @@ class ArtifactAnalysisTableUtils():
     @staticmethod  # does not include soft clipped counts
     def retrieve_non_ref_bp_count(indexed_pileupreads, ref_alleles, pileupread_alignment_query_names=None,
                                   binarize_length=True):
+        if hasattr(indexed_pileupreads, "retrieve_non_ref_bp_count"):
+            return indexed_pileupreads.retrieve_non_ref_bp_count(pileupread_alignment_query_names, binarize_length)
         pileupread_alignment_query_names = [] if not pileupread_alignment_query_names else \
             pileupread_alignment_query_names
         count = 0
@@ -97,6 +107,36 @@ class ArtifactAnalysisTableUtils():
                                                                                  binarize_length)
         return count
 
+    @staticmethod
+    def retrieve_bp_counts(indexed_pileupreads, ref_alleles, ref_supporting_pileupread_alignment_query_names,
+                           alt_supporting_pileupread_alignment_query_names, binarize_length=True):
+        # the ref, non ref and soft clipped counts of both the ref and the alt supporting reads in a single pass
+        # -> (ref_ref, ref_non_ref, ref_soft_clipped, alt_ref, alt_non_ref, alt_soft_clipped)
+        if hasattr(indexed_pileupreads, "retrieve_bp_counts"):
+            return indexed_pileupreads.retrieve_bp_counts(ref_supporting_pileupread_alignment_query_names,
+                                                          alt_supporting_pileupread_alignment_query_names,
+                                                          binarize_length)
+        ref_supporting_pileupread_alignment_query_names = set(ref_supporting_pileupread_alignment_query_names)
+        alt_supporting_pileupread_alignment_query_names = set(alt_supporting_pileupread_alignment_query_names)
+        ref_counts = [0, 0, 0]
+        alt_counts = [0, 0, 0]
+        for pileupcolumn_name in indexed_pileupreads:  # iterate over columns
+            ref_allele = ref_alleles[pileupcolumn_name]
+            for pileupread in indexed_pileupreads[pileupcolumn_name]:  # iterate over rows
+                pileupread_alignment_query_name = pileupread.alignment.query_name
+                if pileupread_alignment_query_name in ref_supporting_pileupread_alignment_query_names:
+                    counts = ref_counts
+                elif pileupread_alignment_query_name in alt_supporting_pileupread_alignment_query_names:
+                    counts = alt_counts
+                else:
+                    continue
+                if ArtifactAnalysisTableUtils.pileupread_has_ref_allele(pileupread, ref_allele):
+                    counts[0] += 1
+                counts[1] += ArtifactAnalysisTableUtils._retrieve_non_ref_length(pileupread, ref_allele,
+                                                                                 binarize_length)
+                counts[2] += ArtifactAnalysisTableUtils._retrieve_soft_clipped_length(pileupread, binarize_length)
+        return tuple(ref_counts + alt_counts)
+
     @staticmethod
     def _retrieve_soft_clipped_length(pileupread, binarize_length=True):
         length = 0
@@ -111,6 +151,9 @@ class ArtifactAnalysisTableUtils():
     @staticmethod
     def retrieve_soft_clipped_bp_count(indexed_pileupreads, pileupread_alignment_query_names=None,
                                        binarize_length=True):
+        if hasattr(indexed_pileupreads, "retrieve_soft_clipped_bp_count"):
+            return indexed_pileupreads.retrieve_soft_clipped_bp_count(pileupread_alignment_query_names,
+                                                                      binarize_length)
         pileupread_alignment_query_names = [] if not pileupread_alignment_query_names else \
             pileupread_alignment_query_names
         count = 0
@@ -166,4 +209,4 @@ class ArtifactAnalysisTableUtils():
         data["ref_overlapping_aligned_segment_count"] = dataTable.ref_overlapping_aligned_segment_count
 
         return pandas.Series(data=OrderedDict([("%s%s%s" % (prefix, key, suffix), val)
-                                               for key, val in data.iteritems()]))
\ No newline at end of file
+                                               for key, val in data.items()]))
\ No newline at end of file
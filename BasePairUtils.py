@@ -7,7 +7,12 @@ class BasePairUtils(object):
     BAM_CMATCH = 0
     BAM_CINS = 1
     BAM_CDEL = 2
+    BAM_CREF_SKIP = 3
     BAM_CSOFT_CLIP = 4
+    BAM_CHARD_CLIP = 5
+    BAM_CPAD = 6
+    BAM_CEQUAL = 7
+    BAM_CDIFF = 8
 
     @staticmethod
     def retrieve_pileupcolumn_name(chrom, start, end):
@@ -23,12 +28,15 @@ class BasePairUtils(object):
         return mask
 
     @staticmethod
-    def determine_soft_clipped_region_length(position, aligned_segment):
-        aligned_pair_positions = [aligned_pair[1] for aligned_pair in aligned_segment.aligned_pairs]
-        if aligned_pair_positions[0] > position and aligned_segment.cigartuples[0][0] == BasePairUtils.BAM_CSOFT_CLIP:
+    def determine_soft_clipped_region_length(position, aligned_segment, aligned_segment_cache=None):
+        if aligned_segment_cache is not None:
+            return aligned_segment_cache.retrieve(aligned_segment).retrieve_soft_clipped_region_length(position)
+        # aligned pairs start with (query position, None) for soft clipped bases, so use the aligned span instead
+        if position < aligned_segment.reference_start and \
+                aligned_segment.cigartuples[0][0] == BasePairUtils.BAM_CSOFT_CLIP:
             return aligned_segment.cigartuples[0][1]
-        elif aligned_pair_positions[-1] < position and aligned_segment.cigartuples[0][0] == \
-                BasePairUtils.BAM_CSOFT_CLIP:
+        elif position >= aligned_segment.reference_end and \
+                aligned_segment.cigartuples[-1][0] == BasePairUtils.BAM_CSOFT_CLIP:
             return aligned_segment.cigartuples[-1][1]
         return 0
 
@@ -39,4 +47,183 @@ class BasePairUtils(object):
 
     @staticmethod
     def aligned_segment_has_del(aligned_segment_positions, position):
-        return position not in aligned_segment_positions
\ No newline at end of file
+        return position not in aligned_segment_positions
+
+    # The helpers below follow htslib's (>= 1.13) handling of overlapping mates in a pileup, so that a pileup over a
+    # wide window can reproduce the base qualities a pileup restricted to a single site would see.
+
+    @staticmethod
+    def is_overlapping_mate_candidate(aligned_segment):
+        if aligned_segment.mate_is_unmapped or not aligned_segment.is_proper_pair:
+            return False
+        if (aligned_segment.next_reference_id >= 0 and
+                aligned_segment.reference_id != aligned_segment.next_reference_id) or \
+                (abs(aligned_segment.template_length) >= 2 * aligned_segment.query_length and
+                 aligned_segment.next_reference_start >= aligned_segment.reference_end):
+            return False
+        return True
+
+    @staticmethod
+    def retrieve_read_key(aligned_segment):
+        return aligned_segment.query_name, aligned_segment.flag
+
+    @staticmethod
+    def retrieve_overlapping_mate_base_qualities(aligned_segments, mate_base_qualities=None):
+        # aligned_segments all overlap one position, in load order -> {read key: base qualities} for the mates htslib
+        # pairs up there; mate_base_qualities (query name -> both lists) carries the pairs over between calls
+        mate_base_qualities = {} if mate_base_qualities is None else mate_base_qualities
+        overlapping_mate_base_qualities = {}
+        pending_aligned_segments = {}
+        for aligned_segment in aligned_segments:
+            if aligned_segment.query_qualities is None or \
+                    not BasePairUtils.is_overlapping_mate_candidate(aligned_segment):
+                continue
+            mate_aligned_segment = pending_aligned_segments.pop(aligned_segment.query_name, None)
+            if mate_aligned_segment is None:
+                if aligned_segment.next_reference_start >= aligned_segment.reference_start or \
+                        (aligned_segment.is_paired and aligned_segment.next_reference_start == -1):
+                    pending_aligned_segments[aligned_segment.query_name] = aligned_segment
+                continue
+
+            if aligned_segment.query_name not in mate_base_qualities:
+                mate_base_qualities[aligned_segment.query_name] = \
+                    BasePairUtils.tweak_overlapping_mate_base_qualities(mate_aligned_segment, aligned_segment)
+            overlapping_mate_base_qualities[BasePairUtils.retrieve_read_key(mate_aligned_segment)], \
+                overlapping_mate_base_qualities[BasePairUtils.retrieve_read_key(aligned_segment)] = \
+                mate_base_qualities[aligned_segment.query_name]
+        return overlapping_mate_base_qualities
+
+    @staticmethod
+    def _hash_query_name(query_name):
+        # khash's X31 string hash followed by Wang's integer hash (32-bit)
+        h = 0
+        for index, character in enumerate(query_name):
+            h = ord(character) if index == 0 else (((h << 5) - h + ord(character)) & 0xffffffff)
+        h = (h + ~(h << 15)) & 0xffffffff
+        h ^= h >> 10
+        h = (h + (h << 3)) & 0xffffffff
+        h ^= h >> 6
+        h = (h + ~(h << 11)) & 0xffffffff
+        h ^= h >> 16
+        return h
+
+    @staticmethod
+    def _cigar_iref2iseq_set(cigartuples, position):
+        # -> (op, cigar index, offset in cigar op, query position, reference offset)
+        if position < 0:
+            return -1, 0, 0, 0, position
+        cigar_index = cigar_offset = query_position = reference_offset = 0
+        while cigar_index < len(cigartuples):
+            operation, length = cigartuples[cigar_index]
+            if operation in (BasePairUtils.BAM_CMATCH, BasePairUtils.BAM_CEQUAL, BasePairUtils.BAM_CDIFF):
+                position -= length
+                if position < 0:
+                    cigar_offset = length + position
+                    return BasePairUtils.BAM_CMATCH, cigar_index, cigar_offset, query_position + cigar_offset, \
+                        reference_offset + cigar_offset
+                query_position += length
+                reference_offset += length
+            elif operation in (BasePairUtils.BAM_CDEL, BasePairUtils.BAM_CREF_SKIP):
+                position = max(position - length, 0)
+                reference_offset += length
+            elif operation in (BasePairUtils.BAM_CINS, BasePairUtils.BAM_CSOFT_CLIP):
+                query_position += length
+            cigar_index += 1
+            cigar_offset = 0
+        return -1, cigar_index, cigar_offset, -1, reference_offset
+
+    @staticmethod
+    def _cigar_iref2iseq_next(cigartuples, cigar_index, cigar_offset, query_position, reference_offset):
+        while cigar_index < len(cigartuples):
+            operation, length = cigartuples[cigar_index]
+            if operation in (BasePairUtils.BAM_CMATCH, BasePairUtils.BAM_CEQUAL, BasePairUtils.BAM_CDIFF):
+                if cigar_offset >= length - 1:
+                    cigar_index += 1
+                    cigar_offset = -1
+                    continue
+                return BasePairUtils.BAM_CMATCH, cigar_index, cigar_offset + 1, query_position + 1, \
+                    reference_offset + 1
+            if operation in (BasePairUtils.BAM_CDEL, BasePairUtils.BAM_CREF_SKIP):
+                reference_offset += length
+            elif operation in (BasePairUtils.BAM_CINS, BasePairUtils.BAM_CSOFT_CLIP):
+                query_position += length
+            cigar_index += 1
+            cigar_offset = -1
+        return -1, cigar_index, cigar_offset, -1, -1
+
+    @staticmethod
+    def tweak_overlapping_mate_base_qualities(aligned_segment1, aligned_segment2):
+        # aligned_segment1 is the mate loaded first; returns both (adjusted) base quality lists
+        base_qualities1 = list(aligned_segment1.query_qualities)
+        base_qualities2 = list(aligned_segment2.query_qualities)
+        query_sequence1 = aligned_segment1.query_sequence
+        query_sequence2 = aligned_segment2.query_sequence
+        cigartuples1 = aligned_segment1.cigartuples
+        cigartuples2 = aligned_segment2.cigartuples
+        start1 = aligned_segment1.reference_start
+        start2 = aligned_segment2.reference_start
+
+        position = start2
+        cursor1 = BasePairUtils._cigar_iref2iseq_set(cigartuples1, position - start1)
+        if cursor1[0] < 0:
+            return base_qualities1, base_qualities2
+        cursor2 = BasePairUtils._cigar_iref2iseq_set(cigartuples2, 0)
+        if cursor2[0] < 0:
+            return base_qualities1, base_qualities2
+
+        multiplier1, multiplier2 = (1, 0) if BasePairUtils._hash_query_name(aligned_segment1.query_name) & 1 else \
+            (0, 1)
+
+        while True:
+            while cursor1[0] >= 0 and 0 <= cursor1[4] < position - start1:
+                cursor1 = BasePairUtils._cigar_iref2iseq_next(cigartuples1, *cursor1[1:])
+            if cursor1[0] < 0:
+                break
+            while cursor2[0] >= 0 and 0 <= cursor2[4] < position - start2:
+                cursor2 = BasePairUtils._cigar_iref2iseq_next(cigartuples2, *cursor2[1:])
+            if cursor2[0] < 0:
+                break
+
+            position = max(position, cursor1[4] + start1, cursor2[4] + start2) + 1
+
+            if cursor1[4] + start1 != cursor2[4] + start2:
+                if cursor1[4] + start1 < cursor2[4] + start2 and cursor2[1] > 0 and \
+                        cigartuples2[cursor2[1] - 1][0] == BasePairUtils.BAM_CDEL:  # catch up over a deletion
+                    while True:
+                        base_qualities1[cursor1[3]] = int(base_qualities1[cursor1[3]] * 0.8) if multiplier1 else 0
+                        cursor1 = BasePairUtils._cigar_iref2iseq_next(cigartuples1, *cursor1[1:])
+                        if cursor1[0] < 0:
+                            return base_qualities1, base_qualities2
+                        if cursor1[4] + start1 >= cursor2[4] + start2:
+                            break
+                elif cursor1[1] > 0 and cigartuples1[cursor1[1] - 1][0] == BasePairUtils.BAM_CDEL:
+                    while True:
+                        base_qualities2[cursor2[3]] = int(base_qualities2[cursor2[3]] * 0.8) if multiplier2 else 0
+                        cursor2 = BasePairUtils._cigar_iref2iseq_next(cigartuples2, *cursor2[1:])
+                        if cursor2[0] < 0:
+                            return base_qualities1, base_qualities2
+                        if cursor2[4] + start2 >= cursor1[4] + start1:
+                            break
+                else:
+                    continue
+
+            query_position1 = cursor1[3]
+            query_position2 = cursor2[3]
+            if query_position1 >= len(base_qualities1) or query_position2 >= len(base_qualities2):
+                break
+
+            if query_sequence1[query_position1] == query_sequence2[query_position2]:
+                base_quality = min(base_qualities1[query_position1] + base_qualities2[query_position2], 200)
+                base_qualities1[query_position1] = multiplier1 * base_quality
+                base_qualities2[query_position2] = multiplier2 * base_quality
+            elif base_qualities1[query_position1] > base_qualities2[query_position2]:
+                base_qualities1[query_position1] = int(0.8 * base_qualities1[query_position1])
+                base_qualities2[query_position2] = 0
+            elif base_qualities1[query_position1] < base_qualities2[query_position2]:
+                base_qualities2[query_position2] = int(0.8 * base_qualities2[query_position2])
+                base_qualities1[query_position1] = 0
+            else:
+                base_qualities1[query_position1] = multiplier1 * int(0.8 * base_qualities1[query_position1])
+                base_qualities2[query_position2] = multiplier2 * int(0.8 * base_qualities2[query_position2])
+
+        return base_qualities1, base_qualities2
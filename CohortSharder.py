@@ -0,0 +1,207 @@
+import heapq
+import json
+import os
+import pandas
+from collections import OrderedDict
+from GenomicShardPlanner import GenomicShardPlanner
+
+
+class CohortSharder(object):
+
+    # Splits a cohort's mutations into shard MAFs of similar estimated cost, one per batch job, and gathers the jobs'
+    # output MAFs back into one. Every pair is cut into genomic regions by GenomicShardPlanner (each site costed by
+    # the read depth of its contig in the pair's bams) and the regions are dealt out costliest first, each to the
+    # cheapest shard so far. Every row carries its row number in the cohort, in the order a single run writes the
+    # rows, as INDEX_COLUMN; the jobs pass it through, and gathering puts the rows back in that order and checks that
+    # each of them was written exactly once.
+    INDEX_COLUMN = "Cohort_row_index"
+    # more regions than shards so that the regions dealt out last even the shards out
+    DEFAULT_REGIONS_PER_SHARD = 4
+    SHARD_MAF_PATTERN = "%s.%d.maf"
+    MANIFEST_PATTERN = "%s.manifest.json"
+    # missing or duplicated row numbers named in an error
+    REPORTED_ROW_COUNT = 10
+
+    def __init__(self, shard_count, regions_per_shard=None):
+        if shard_count < 1:
+            raise ValueError("%d is not a shard count." % shard_count)
+        self._shard_count = shard_count
+        self._regions_per_shard = CohortSharder.DEFAULT_REGIONS_PER_SHARD if regions_per_shard is None else \
+            regions_per_shard
+
+    @property
+    def shard_count(self):
+        return self._shard_count
+
+    @staticmethod
+    def retrieve_shard_maf_filename(shard_prefix, shard_index):
+        return CohortSharder.SHARD_MAF_PATTERN % (shard_prefix, shard_index)
+
+    @staticmethod
+    def retrieve_manifest_filename(shard_prefix):
+        return CohortSharder.MANIFEST_PATTERN % shard_prefix
+
+    def create_shards(self, pairs):
+        # pairs: [(mutations dataframe, case bam, control bam), ...] in the order a single run writes them -> (the
+        # cohort's mutations numbered in INDEX_COLUMN, [CohortShard, ...])
+        numbered_pairs = []
+        row_count = 0
+        for mutations_dataframe, case_sample_bam_filename, control_sample_bam_filename in pairs:
+            mutations_dataframe = mutations_dataframe.copy()
+            mutations_dataframe[CohortSharder.INDEX_COLUMN] = range(row_count, row_count + len(mutations_dataframe))
+            numbered_pairs += [(mutations_dataframe, case_sample_bam_filename, control_sample_bam_filename)]
+            row_count += len(mutations_dataframe)
+
+        genomic_shard_planners = [GenomicShardPlanner([case_sample_bam_filename, control_sample_bam_filename])
+                                  for _, case_sample_bam_filename, control_sample_bam_filename in numbered_pairs]
+        total_cost = sum([genomic_shard_planner.retrieve_cost(mutations_dataframe)
+                          for genomic_shard_planner, (mutations_dataframe, _, _) in zip(genomic_shard_planners,
+                                                                                        numbered_pairs)])
+        target_cost = total_cost / float(self._shard_count * self._regions_per_shard)
+
+        regions = []  # (cost, order, pair index, row numbers)
+        for pair_index, (mutations_dataframe, _, _) in enumerate(numbered_pairs):
+            for genomic_shard in genomic_shard_planners[pair_index].create_shards(mutations_dataframe, target_cost):
+                regions += [(genomic_shard.cost, len(regions), pair_index,
+                             mutations_dataframe.loc[genomic_shard.indices, CohortSharder.INDEX_COLUMN].tolist())]
+        regions.sort(key=lambda region: (-region[0], region[1]))
+
+        cohort_shards = [CohortSharder.CohortShard() for _ in range(self._shard_count)]
+        cheapest_shards = [(0.0, shard_index) for shard_index in range(self._shard_count)]  # min heap of (cost, shard)
+        for cost, _, pair_index, row_indices in regions:
+            _, shard_index = heapq.heappop(cheapest_shards)
+            cohort_shards[shard_index].insert(pair_index, row_indices, cost)
+            heapq.heappush(cheapest_shards, (cohort_shards[shard_index].cost, shard_index))
+
+        cohort_dataframe = pandas.concat([mutations_dataframe for mutations_dataframe, _, _ in numbered_pairs]) \
+            if numbered_pairs else pandas.DataFrame(columns=[CohortSharder.INDEX_COLUMN])
+        return cohort_dataframe.set_index(CohortSharder.INDEX_COLUMN, drop=False), cohort_shards
+
+    def scatter(self, pairs, shard_prefix):
+        # writes every shard's rows, in cohort order, to its own MAF (an empty shard gets the header only) and the
+        # manifest gather checks the outputs against -> the manifest
+        cohort_dataframe, cohort_shards = self.create_shards(pairs)
+        shard_dirname = os.path.dirname(shard_prefix)
+        if shard_dirname and not os.path.isdir(shard_dirname):
+            os.makedirs(shard_dirname)
+
+        manifest = dict(row_count=len(cohort_dataframe), shards=[])
+        for shard_index, cohort_shard in enumerate(cohort_shards):
+            shard_maf_filename = CohortSharder.retrieve_shard_maf_filename(shard_prefix, shard_index)
+            cohort_dataframe.loc[sorted(cohort_shard.row_indices)].to_csv(shard_maf_filename, sep="\t", index=False)
+            manifest["shards"] += [dict(maf_filename=shard_maf_filename, row_count=len(cohort_shard.row_indices),
+                                        pair_count=len(cohort_shard.pair_indices), cost=cohort_shard.cost)]
+        with open(CohortSharder.retrieve_manifest_filename(shard_prefix), "w") as manifest_file:
+            json.dump(manifest, manifest_file, indent=2)
+        return manifest
+
+    @staticmethod
+    def _read_shard_output(shard_output_maf_filename):
+        # every value as the job wrote it, so that gathering changes no text; a job without rows wrote nothing
+        if os.path.getsize(shard_output_maf_filename) == 0:
+            return None
+        shard_output_dataframe = pandas.read_csv(shard_output_maf_filename, sep="\t", header=0, comment="#", dtype=str,
+                                                 keep_default_na=False)
+        if CohortSharder.INDEX_COLUMN not in shard_output_dataframe.columns:
+            raise ValueError("%s has no %s column; it was not written from a scattered MAF." %
+                             (shard_output_maf_filename, CohortSharder.INDEX_COLUMN))
+        return shard_output_dataframe
+
+    @staticmethod
+    def _retrieve_missing_shard_counts(manifest, missing_row_indices):
+        # shard MAF -> rows of it missing from the outputs, when the shard MAFs can still be read
+        missing_row_indices = set(missing_row_indices)
+        missing_shard_counts = OrderedDict()
+        for shard in manifest["shards"]:
+            if shard["row_count"] == 0 or not os.path.exists(shard["maf_filename"]):
+                continue
+            row_indices = pandas.read_csv(shard["maf_filename"], sep="\t", header=0, comment="#",
+                                          usecols=[CohortSharder.INDEX_COLUMN])[CohortSharder.INDEX_COLUMN]
+            missing_count = sum([row_index in missing_row_indices for row_index in row_indices])
+            if missing_count > 0:
+                missing_shard_counts[shard["maf_filename"]] = missing_count
+        return missing_shard_counts
+
+    @staticmethod
+    def gather(manifest, shard_output_maf_filenames, output_maf_filename, allow_missing_rows=False):
+        # writes the outputs' rows in cohort order, without INDEX_COLUMN. Duplicated rows (e.g. an output given
+        # twice) are an error, and so are missing ones (e.g. a failed job, or a pair skipped for memory) unless
+        # allowed; the rows are all checked before anything is written, and the output MAF only appears, whole, once
+        # it is done -> the missing row numbers
+        shard_output_dataframes = []
+        first_shard_output_maf_filename = None
+        for shard_output_maf_filename in shard_output_maf_filenames:
+            shard_output_dataframe = CohortSharder._read_shard_output(shard_output_maf_filename)
+            if shard_output_dataframe is None:
+                continue
+            if shard_output_dataframes and \
+                    shard_output_dataframe.columns.tolist() != shard_output_dataframes[0].columns.tolist():
+                raise ValueError("%s has other columns than %s; were the shards run with different options?" %
+                                 (shard_output_maf_filename, first_shard_output_maf_filename))
+            if first_shard_output_maf_filename is None:
+                first_shard_output_maf_filename = shard_output_maf_filename
+            shard_output_dataframes += [shard_output_dataframe]
+        if not shard_output_dataframes:
+            row_indices = pandas.Series([], dtype="int64")
+        else:
+            output_dataframe = pandas.concat(shard_output_dataframes, ignore_index=True)
+            row_indices = output_dataframe[CohortSharder.INDEX_COLUMN].astype("int64")
+
+        duplicated_row_indices = sorted(set(row_indices[row_indices.duplicated()]))
+        if duplicated_row_indices:
+            raise ValueError("%d rows were written more than once, e.g. rows %s." %
+                             (len(duplicated_row_indices),
+                              ", ".join([str(row_index) for row_index in
+                                         duplicated_row_indices[:CohortSharder.REPORTED_ROW_COUNT]])))
+        unknown_row_indices = row_indices[(row_indices < 0) | (row_indices >= manifest["row_count"])]
+        if len(unknown_row_indices) > 0:
+            raise ValueError("Row %d is not in the scattered cohort of %d rows." %
+                             (unknown_row_indices.iloc[0], manifest["row_count"]))
+        missing_row_indices = sorted(set(range(manifest["row_count"])) - set(row_indices))
+        if missing_row_indices and not allow_missing_rows:
+            missing_shard_counts = CohortSharder._retrieve_missing_shard_counts(manifest, missing_row_indices)
+            raise ValueError("%d of %d rows are missing%s, e.g. rows %s." %
+                             (len(missing_row_indices), manifest["row_count"],
+                              " (%s)" % ", ".join(["%d from %s" % (missing_count, shard_maf_filename)
+                                                   for shard_maf_filename, missing_count in
+                                                   missing_shard_counts.items()]) if missing_shard_counts else "",
+                              ", ".join([str(row_index) for row_index in
+                                         missing_row_indices[:CohortSharder.REPORTED_ROW_COUNT]])))
+
+        # written under a temporary name and renamed so that a scheduler never takes a partial file for a result
+        temporary_filename = "%s.%d.tmp" % (output_maf_filename, os.getpid())
+        try:
+            with open(temporary_filename, "w") as output_maf_file:
+                if shard_output_dataframes:
+                    output_dataframe = output_dataframe.iloc[row_indices.argsort(kind="mergesort")]
+                    output_dataframe.drop(columns=[CohortSharder.INDEX_COLUMN]).to_csv(output_maf_file, sep="\t",
+                                                                                       index=False)
+            os.rename(temporary_filename, output_maf_filename)
+        finally:
+            if os.path.exists(temporary_filename):
+                os.remove(temporary_filename)
+        return missing_row_indices
+
+    class CohortShard(object):
+
+        def __init__(self):
+            self._pair_indices = set()
+            self._row_indices = []
+            self._cost = 0.0
+
+        @property
+        def pair_indices(self):
+            return self._pair_indices
+
+        @property
+        def row_indices(self):
+            return self._row_indices
+
+        @property
+        def cost(self):
+            return self._cost
+
+        def insert(self, pair_index, row_indices, cost):
+            self._pair_indices.add(pair_index)
+            self._row_indices += row_indices
+            self._cost += cost
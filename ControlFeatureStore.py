@@ -0,0 +1,477 @@
+import argparse
+import json
+import mmap
+import multiprocessing
+import os
+import struct
+import numpy
+from collections import OrderedDict
+from pysam import FastaFile
+from AlignmentFileOpener import AlignmentFileOpener
+from BasePairUtils import BasePairUtils
+from FragmentDownsampler import FragmentDownsampler
+from GenomeMask import GenomeMask
+from MutationAnnotationFormatReader import MutationAnnotationFormatReader
+from PileupReadFilter import PileupReadFilter
+from PileupSweepEngine import PileupSweepEngine
+from ReadFetchEngine import ReadFetchEngine
+from ReferenceSequenceWindow import ReferenceSequenceWindow
+from SiteResultCache import SiteResultCache
+
+
+class ControlFeatureStore(object):
+
+    # The control side of every site's tables, precomputed for a panel of normal bams over a site list so that a
+    # normal shared by many pairs is decoded once. Per sample and site it keeps what the tables read from the control:
+    # the site calls of every read fragment and, per fragment class (fragments whose reads make the same calls at the
+    # site, in load order; the class alone decides whether a fragment supports the ref or the alt allele), the ref,
+    # non ref and soft clipped counts (binarized, as in the tables) at each of the control's columns. The column mask
+    # still depends on the case, so it is applied when the counts are read. File layout: MAGIC, header length (little
+    # endian uint64), JSON header, then every array listed in the header. The file is memory-mapped read only.
+    MAGIC = b"REBCCTRL"
+    HEADER_LENGTH_FORMAT = "<Q"
+    # bump whenever what is stored for a site changes, so that older stores are no longer used
+    VERSION = 1
+    NO_CALL = "-"  # a read without a base at the site (deletion, reference skip or insertion after it)
+    # name -> dtype; *_offsets arrays have one more entry than the rows they delimit
+    ARRAYS = OrderedDict([("site_positions", "<i8"), ("site_sampling_fractions", "<f8"),
+                          ("site_column_offsets", "<i8"), ("column_positions", "<i8"),
+                          ("site_class_offsets", "<i8"), ("class_fragment_counts", "<i8"),
+                          ("class_call_offsets", "<i8"), ("class_calls", "u1"),
+                          ("class_count_offsets", "<i8"), ("count_positions", "<i8"), ("count_refs", "<i4"),
+                          ("count_non_refs", "<i4"), ("count_soft_clips", "<i4")])
+    OFFSET_ARRAYS = ["site_column_offsets", "site_class_offsets", "class_call_offsets", "class_count_offsets"]
+
+    def __init__(self, control_feature_store_filename):
+        self._control_feature_store_filename = control_feature_store_filename
+        self._file = open(control_feature_store_filename, "rb")
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic_length = len(ControlFeatureStore.MAGIC)
+        if self._mmap[:magic_length] != ControlFeatureStore.MAGIC:
+            self.close()
+            raise ValueError("%s is not a control feature store." % control_feature_store_filename)
+        header_length_size = struct.calcsize(ControlFeatureStore.HEADER_LENGTH_FORMAT)
+        header_length, = struct.unpack(ControlFeatureStore.HEADER_LENGTH_FORMAT,
+                                       self._mmap[magic_length:magic_length + header_length_size])
+        header_start = magic_length + header_length_size
+        header = json.loads(self._mmap[header_start:header_start + header_length].decode("ascii"))
+        data_start = header_start + header_length
+
+        self._options = header["options"]
+        self._samples = header["samples"]
+        self._arrays = dict([(name, (data_start + array["offset"], numpy.dtype(array["dtype"]), array["length"]))
+                             for name, array in header["arrays"].items()])
+
+    @property
+    def filename(self):
+        return self._control_feature_store_filename
+
+    @property
+    def options(self):
+        return self._options
+
+    @property
+    def sample_bam_filenames(self):
+        return [sample["identity"][0] for sample in self._samples]
+
+    @staticmethod
+    def retrieve_options(ref_seq_filename, genome_mask_filename=None, read_flag_filter=None, min_mapping_quality=None,
+                         min_base_quality=None, max_mismatches=None, max_depth=None, downsample_seed=None):
+        # every setting a site's stored control side depends on, as the JSON the store keeps
+        pileup_read_filter = PileupReadFilter(flag_filter=read_flag_filter, min_mapping_quality=min_mapping_quality,
+                                              min_base_quality=min_base_quality, max_mismatches=max_mismatches)
+        options = dict(version=ControlFeatureStore.VERSION,
+                       ref_seq=SiteResultCache.retrieve_file_identity(ref_seq_filename),
+                       genome_mask=SiteResultCache.retrieve_file_identity(genome_mask_filename)
+                       if genome_mask_filename is not None else None,
+                       read_flag_filter=pileup_read_filter.flag_filter,
+                       min_mapping_quality=pileup_read_filter.min_mapping_quality,
+                       min_base_quality=pileup_read_filter.min_base_quality,
+                       max_mismatches=pileup_read_filter.max_mismatches, max_depth=max_depth,
+                       downsample_seed=(FragmentDownsampler.DEFAULT_SEED if downsample_seed is None else
+                                        downsample_seed) if max_depth is not None else None)
+        return json.loads(json.dumps(options))
+
+    def retrieve_sample(self, sample_bam_filename, options):
+        # -> the stored sites of sample_bam_filename, or None when the bam is not in the store, was rewritten since
+        # or the store was built with other options
+        if options != self._options:
+            return None
+        identity = SiteResultCache.retrieve_file_identity(sample_bam_filename)
+        for sample in self._samples:
+            if sample["identity"] == identity:
+                return ControlFeatureStore.StoredSample(self, sample["contigs"])
+        return None
+
+    def retrieve_array(self, name, start=0, end=None):
+        # -> rows [start, end) of an array, as a view of the mmap; copy whatever outlives the call (the mmap cannot
+        # be closed while views of it are around)
+        offset, dtype, length = self._arrays[name]
+        end = length if end is None else end
+        return numpy.frombuffer(self._mmap, dtype=dtype, count=end - start, offset=offset + start * dtype.itemsize)
+
+    def close(self):
+        self._mmap.close()
+        self._file.close()
+
+    @staticmethod
+    def _retrieve_call(pileupread):
+        # the base ArtifactAnalysisTable judges a read on at the site
+        if pileupread.is_del or pileupread.indel > 0 or pileupread.query_position is None:
+            return ControlFeatureStore.NO_CALL
+        return pileupread.alignment.query_sequence[pileupread.query_position]
+
+    @staticmethod
+    def _insert_site(sample_arrays, pileupcolumn, pileupcolumn_knapsack):
+        column_positions = numpy.array(pileupcolumn_knapsack.column_positions, dtype=numpy.int64)
+        sample_arrays["site_positions"] += [pileupcolumn.pos]
+        sample_arrays["site_sampling_fractions"] += [pileupcolumn.sampling_fraction]
+        sample_arrays["column_positions"] += [column_positions]
+        sample_arrays["site_column_offsets"] += [len(column_positions)]
+
+        # fragment -> its reads' calls at the site, in load order
+        fragment_calls = OrderedDict()
+        for pileupread in pileupcolumn.pileups:
+            query_name = pileupread.alignment.query_name
+            fragment_calls[query_name] = fragment_calls.get(query_name, "") + \
+                ControlFeatureStore._retrieve_call(pileupread)
+
+        # class calls -> [fragment count, per column ref, non ref and soft clipped counts]
+        fragment_classes = OrderedDict()
+        for query_name, calls in fragment_calls.items():
+            if not calls.strip(ControlFeatureStore.NO_CALL):  # supports neither allele, whatever they are
+                continue
+            if calls not in fragment_classes:
+                fragment_classes[calls] = [0] + [numpy.zeros(len(column_positions), dtype=numpy.int64)
+                                                 for _ in range(3)]
+            fragment_class = fragment_classes[calls]
+            fragment_class[0] += 1
+            aligned_segment_columns = pileupcolumn_knapsack.retrieve_aligned_segment_columns(query_name)
+            for columns, is_selected in zip(aligned_segment_columns,
+                                            ReadFetchEngine.IndexedAlignedSegmentKnapsack.
+                                            retrieve_fragment_selections(aligned_segment_columns)):
+                # the read's share of the control's columns
+                column_start = numpy.searchsorted(column_positions, columns.reference_start)
+                column_end = numpy.searchsorted(column_positions, columns.reference_end)
+                offsets = column_positions[column_start:column_end] - columns.reference_start
+                for counts, column_counts in zip(fragment_class[1:],
+                                                 columns.retrieve_column_bp_counts(is_selected)):
+                    counts[column_start:column_end] += column_counts[offsets]
+
+        sample_arrays["site_class_offsets"] += [len(fragment_classes)]
+        for calls, (fragment_count, refs, non_refs, soft_clips) in fragment_classes.items():
+            sample_arrays["class_fragment_counts"] += [fragment_count]
+            sample_arrays["class_calls"] += [numpy.frombuffer(calls.encode("ascii"), dtype=numpy.uint8)]
+            sample_arrays["class_call_offsets"] += [len(calls)]
+            is_counted = (refs != 0) | (non_refs != 0) | (soft_clips != 0)
+            sample_arrays["count_positions"] += [column_positions[is_counted]]
+            sample_arrays["count_refs"] += [refs[is_counted]]
+            sample_arrays["count_non_refs"] += [non_refs[is_counted]]
+            sample_arrays["count_soft_clips"] += [soft_clips[is_counted]]
+            sample_arrays["class_count_offsets"] += [int(numpy.count_nonzero(is_counted))]
+
+    @staticmethod
+    def retrieve_sample_arrays(task):
+        # (sample bam, sorted [(chrom, position), ...], reference, build options) -> (bam identity, contig -> [first
+        # site, end site], arrays); offset arrays hold lengths until the store is written
+        sample_bam_filename, sites, ref_seq_filename, build_options = task
+        alignment_file_opener = AlignmentFileOpener(ref_seq_filename, build_options.get("io_threads"),
+                                                    build_options.get("ref_cache_dirname"))
+        sample_bam_file = alignment_file_opener.open(sample_bam_filename)
+        ref_seq_file = ReferenceSequenceWindow(FastaFile(ref_seq_filename))
+        genome_mask_filename = build_options.get("genome_mask_filename")
+        genome_mask = GenomeMask(genome_mask_filename) if genome_mask_filename is not None else None
+        pileup_read_filter = PileupReadFilter(flag_filter=build_options.get("read_flag_filter"),
+                                              min_mapping_quality=build_options.get("min_mapping_quality"),
+                                              min_base_quality=build_options.get("min_base_quality"),
+                                              max_mismatches=build_options.get("max_mismatches"))
+        max_depth = build_options.get("max_depth")
+        fragment_downsampler = FragmentDownsampler(max_depth, build_options.get("downsample_seed")) \
+            if max_depth is not None else None
+        # the read-centric engine, which counts exactly as the pileup ones do
+        read_fetch_engine = ReadFetchEngine(sample_bam_file, ref_seq_file, genome_mask, pileup_read_filter,
+                                            fragment_downsampler)
+
+        sample_arrays = dict([(name, []) for name in ControlFeatureStore.ARRAYS])
+        contigs = OrderedDict()
+        try:
+            for site_index, (chrom, position) in enumerate(sites):
+                contigs.setdefault(chrom, [site_index, site_index])
+                contigs[chrom][1] = site_index + 1
+                ref_seq_file.prefetch(chrom, position, position+1)
+                pileupcolumn, pileupcolumn_knapsack = read_fetch_engine.retrieve(chrom, position)
+                ControlFeatureStore._insert_site(sample_arrays, pileupcolumn, pileupcolumn_knapsack)
+        finally:
+            sample_bam_file.close()
+            ref_seq_file.close()
+            if genome_mask is not None:
+                genome_mask.close()
+        return SiteResultCache.retrieve_file_identity(sample_bam_filename), contigs, sample_arrays
+
+    @staticmethod
+    def retrieve_sites(mutations_dataframe):
+        # -> sorted, unique [(chrom, zero based position), ...] of the SNP sites
+        return sorted(set(zip(mutations_dataframe["Chromosome"].astype(str),
+                              mutations_dataframe["Start_position"].astype(int) - 1)))
+
+    @staticmethod
+    def create(control_feature_store_filename, sample_bam_filenames, sites, ref_seq_filename, build_options=None,
+               workers=1):
+        # sites: [(chrom, zero based position), ...]; build_options: genome_mask_filename, read_flag_filter,
+        # min_mapping_quality, min_base_quality, max_mismatches, max_depth, downsample_seed, io_threads and
+        # ref_cache_dirname, as retrieve_mutational_features takes them
+        build_options = dict(build_options or {})
+        sites = sorted(set(sites))
+        tasks = [(sample_bam_filename, sites, ref_seq_filename, build_options)
+                 for sample_bam_filename in sample_bam_filenames]
+        if workers > 1:
+            pool = multiprocessing.Pool(processes=workers)
+            try:
+                results = pool.map(ControlFeatureStore.retrieve_sample_arrays, tasks)
+                pool.close()
+            except BaseException:
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+        else:
+            results = [ControlFeatureStore.retrieve_sample_arrays(task) for task in tasks]
+
+        # the samples' sites follow each other, so that a sample's contig is a single range of site rows
+        samples = []
+        arrays = dict([(name, []) for name in ControlFeatureStore.ARRAYS])
+        site_count = 0
+        for identity, contigs, sample_arrays in results:
+            samples += [dict(identity=identity,
+                             contigs=dict([(chrom, [site_start + site_count, site_end + site_count])
+                                           for chrom, (site_start, site_end) in contigs.items()]))]
+            site_count += len(sample_arrays["site_positions"])
+            for name in ControlFeatureStore.ARRAYS:
+                arrays[name] += sample_arrays[name]
+
+        header = dict(version=ControlFeatureStore.VERSION,
+                      options=ControlFeatureStore.retrieve_options(
+                          ref_seq_filename, build_options.get("genome_mask_filename"),
+                          build_options.get("read_flag_filter"), build_options.get("min_mapping_quality"),
+                          build_options.get("min_base_quality"), build_options.get("max_mismatches"),
+                          build_options.get("max_depth"), build_options.get("downsample_seed")),
+                      samples=samples, arrays=OrderedDict())
+        data = []
+        data_length = 0
+        for name, dtype in ControlFeatureStore.ARRAYS.items():
+            if name in ControlFeatureStore.OFFSET_ARRAYS:  # lengths -> offsets
+                array = numpy.concatenate([[0], numpy.cumsum(numpy.array(arrays[name], dtype=numpy.int64))])
+            elif arrays[name] and isinstance(arrays[name][0], numpy.ndarray):
+                array = numpy.concatenate(arrays[name])
+            else:
+                array = numpy.array(arrays[name])
+            array = numpy.ascontiguousarray(array, dtype=dtype)
+            data_length += -data_length % array.itemsize  # aligned for numpy.frombuffer
+            header["arrays"][name] = dict(offset=data_length, dtype=dtype, length=len(array))
+            data += [(data_length, array)]
+            data_length += array.nbytes
+
+        # written under a temporary name and renamed, so that a failed build never leaves a partial store
+        encoded_header = json.dumps(header).encode("ascii")
+        encoded_header += b" " * (-len(encoded_header) % 8)  # keeps the data 8 byte aligned
+        temporary_filename = "%s.%d.tmp" % (control_feature_store_filename, os.getpid())
+        try:
+            with open(temporary_filename, "wb") as control_feature_store_file:
+                control_feature_store_file.write(ControlFeatureStore.MAGIC)
+                control_feature_store_file.write(struct.pack(ControlFeatureStore.HEADER_LENGTH_FORMAT,
+                                                             len(encoded_header)))
+                control_feature_store_file.write(encoded_header)
+                data_end = 0
+                for offset, array in data:
+                    control_feature_store_file.write(b"\0" * (offset - data_end))
+                    control_feature_store_file.write(array.tobytes())
+                    data_end = offset + array.nbytes
+            os.rename(temporary_filename, control_feature_store_filename)
+        finally:
+            if os.path.exists(temporary_filename):
+                os.remove(temporary_filename)
+        return control_feature_store_filename
+
+    class StoredSample(object):
+        # one sample's sites; retrieve stands in for ReadFetchEngine.retrieve
+
+        def __init__(self, control_feature_store, contigs):
+            self._control_feature_store = control_feature_store
+            self._contigs = contigs  # contig -> [first site, end site]
+
+        def retrieve(self, chrom, position):
+            # -> (site pileupcolumn snapshot, knapsack), or None when the site is not stored
+            contig = self._contigs.get(chrom)
+            if contig is None:
+                return None
+            retrieve_array = self._control_feature_store.retrieve_array
+            site_positions = retrieve_array("site_positions", contig[0], contig[1])
+            site_index = int(numpy.searchsorted(site_positions, position))
+            if site_index == len(site_positions) or site_positions[site_index] != position:
+                return None
+            site_index += contig[0]
+
+            column_start, column_end = retrieve_array("site_column_offsets", site_index, site_index + 2).tolist()
+            class_start, class_end = retrieve_array("site_class_offsets", site_index, site_index + 2).tolist()
+            class_fragment_counts = retrieve_array("class_fragment_counts", class_start, class_end).tolist()
+            class_call_offsets = retrieve_array("class_call_offsets", class_start, class_end + 1).tolist()
+            # every fragment of class i is named "i:j", which is all the tables need of a fragment
+            pileupreads = []
+            for class_index, fragment_count in enumerate(class_fragment_counts):
+                calls = retrieve_array("class_calls", class_call_offsets[class_index],
+                                       class_call_offsets[class_index + 1]).tobytes().decode("ascii")
+                for fragment_index in range(fragment_count):
+                    query_name = "%d:%d" % (class_index, fragment_index)
+                    pileupreads += [ControlFeatureStore.StoredPileupRead(query_name, call) for call in calls]
+
+            class_count_offsets = retrieve_array("class_count_offsets", class_start, class_end + 1)
+            count_start, count_end = int(class_count_offsets[0]), int(class_count_offsets[-1])
+            sampling_fraction = float(retrieve_array("site_sampling_fractions", site_index, site_index + 1)[0])
+            return PileupSweepEngine.PileupColumnSnapshot(position, None, pileupreads,
+                                                          sampling_fraction=sampling_fraction), \
+                ControlFeatureStore.StoredKnapsack(chrom,
+                                                   retrieve_array("column_positions", column_start,
+                                                                  column_end).copy(),
+                                                   numpy.repeat(numpy.arange(class_end - class_start),
+                                                                numpy.diff(class_count_offsets)),
+                                                   *[retrieve_array(name, count_start, count_end).copy()
+                                                     for name in ["count_positions", "count_refs",
+                                                                  "count_non_refs", "count_soft_clips"]])
+
+    class StoredPileupRead(object):
+        # stands in for a pysam PileupRead, and its alignment, at the site
+
+        __slots__ = ("_query_name", "_query_sequence", "_query_position")
+
+        def __init__(self, query_name, call):
+            self._query_name = query_name
+            self._query_sequence = call
+            self._query_position = None if call == ControlFeatureStore.NO_CALL else 0
+
+        @property
+        def alignment(self):
+            return self
+
+        @property
+        def query_name(self):
+            return self._query_name
+
+        @property
+        def query_sequence(self):
+            return self._query_sequence
+
+        @property
+        def query_position(self):
+            return self._query_position
+
+        @property
+        def is_del(self):
+            return False
+
+        @property
+        def indel(self):
+            return 0
+
+    class StoredKnapsack(object):
+        # stands in for PileupColumnKnapsack: the control's columns and its fragment classes' counts on them
+
+        def __init__(self, chrom, column_positions, count_classes, count_positions, count_refs, count_non_refs,
+                     count_soft_clips):
+            self._chrom = chrom
+            self._column_positions = column_positions
+            self._count_classes = count_classes
+            self._count_positions = count_positions
+            self._counts = (count_refs, count_non_refs, count_soft_clips)
+            self._pileupcolumn_names = None  # built on first use
+
+        @property
+        def pileupcolumn_names(self):
+            if self._pileupcolumn_names is None:
+                self._pileupcolumn_names = [BasePairUtils.retrieve_pileupcolumn_name(self._chrom, position,
+                                                                                     position+1)
+                                            for position in self._column_positions]
+            return self._pileupcolumn_names
+
+        @property
+        def stored_count_length(self):
+            return len(self._count_positions)
+
+        def retrieve_indexed_pileupreads(self, pileupread_alignment_query_names, pileupcolumn_mask):
+            # counterpart of ArtifactAnalysisTableUtils.retrieve_indexed_pileupreads
+            unmasked_positions = [position for pileupcolumn_name, position in zip(self.pileupcolumn_names,
+                                                                                 self._column_positions)
+                                  if not pileupcolumn_mask.get(pileupcolumn_name, True)]
+            is_unmasked = numpy.isin(self._count_positions, unmasked_positions)
+            return ControlFeatureStore.IndexedStoredKnapsack(self._count_classes[is_unmasked],
+                                                             [counts[is_unmasked] for counts in self._counts])
+
+    class IndexedStoredKnapsack(object):
+        # the unmasked counts; answers ArtifactAnalysisTableUtils.retrieve_bp_counts
+
+        def __init__(self, count_classes, counts):
+            self._count_classes = count_classes
+            self._counts = counts
+
+        def _retrieve_bp_counts(self, pileupread_alignment_query_names):
+            # all fragments of a class support the same allele, so a class is counted whole
+            class_indices = set([int(query_name.split(":", 1)[0])
+                                 for query_name in pileupread_alignment_query_names or []])
+            is_selected = numpy.isin(self._count_classes, list(class_indices))
+            return [int(counts[is_selected].sum()) for counts in self._counts]
+
+        def retrieve_bp_counts(self, ref_supporting_pileupread_alignment_query_names,
+                               alt_supporting_pileupread_alignment_query_names, binarize_length=True):
+            if not binarize_length:
+                raise ValueError("A control feature store only keeps binarized lengths.")
+            return tuple(self._retrieve_bp_counts(ref_supporting_pileupread_alignment_query_names) +
+                         self._retrieve_bp_counts(alt_supporting_pileupread_alignment_query_names))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Precompute the control features of normal bams over a site list.",
+                                     epilog="")
+    parser.add_argument("--control_feature_store_filename", dest="control_feature_store_filename", action="store",
+                        required=True, help="The store is written here.")
+    parser.add_argument("--control_sample_bam_filenames", dest="control_sample_bam_filenames", action="store",
+                        required=True, help="Comma separated normal bams (or crams).")
+    parser.add_argument("--input_maf_filename", dest="input_maf_filename", action="store", required=True,
+                        help="MAF whose SNP sites are stored.")
+    parser.add_argument("--ref_seq_filename", dest="ref_seq_filename", action="store", required=True,
+                        help="Reference genome sequence fasta")
+    parser.add_argument("--genome_mask_filename", dest="genome_mask_filename", action="store", required=False,
+                        default=None, help="Genome mask the tool runs with, if any.")
+    parser.add_argument("--read_flag_filter", dest="read_flag_filter", action="store", type=lambda value: int(value, 0),
+                        required=False, default=None, help="As the tool's --read_flag_filter.")
+    parser.add_argument("--min_mapping_quality", dest="min_mapping_quality", action="store", type=int,
+                        required=False, default=None, help="As the tool's --min_mapping_quality.")
+    parser.add_argument("--min_base_quality", dest="min_base_quality", action="store", type=int, required=False,
+                        default=None, help="As the tool's --min_base_quality.")
+    parser.add_argument("--max_mismatches", dest="max_mismatches", action="store", type=int, required=False,
+                        default=None, help="As the tool's --max_mismatches.")
+    parser.add_argument("--max_depth", dest="max_depth", action="store", type=int, required=False, default=None,
+                        help="As the tool's --max_depth.")
+    parser.add_argument("--downsample_seed", dest="downsample_seed", action="store", type=int, required=False,
+                        default=None, help="As the tool's --downsample_seed.")
+    parser.add_argument("--io_threads", dest="io_threads", action="store", type=int, required=False, default=None,
+                        help="htslib decompression threads per bam.")
+    parser.add_argument("--ref_cache_dirname", dest="ref_cache_dirname", action="store", required=False,
+                        default=None, help="As the tool's --ref_cache_dirname.")
+    parser.add_argument("--workers", dest="workers", action="store", type=int, required=False, default=1,
+                        help="Samples built in parallel.")
+
+    args, _ = parser.parse_known_args()
+
+    mutations_dataframe = MutationAnnotationFormatReader(args.input_maf_filename, variant_types=["SNP"]).read()
+    build_options = dict(genome_mask_filename=args.genome_mask_filename, read_flag_filter=args.read_flag_filter,
+                         min_mapping_quality=args.min_mapping_quality, min_base_quality=args.min_base_quality,
+                         max_mismatches=args.max_mismatches, max_depth=args.max_depth,
+                         downsample_seed=args.downsample_seed, io_threads=args.io_threads,
+                         ref_cache_dirname=args.ref_cache_dirname)
+    ControlFeatureStore.create(args.control_feature_store_filename, args.control_sample_bam_filenames.split(","),
+                               ControlFeatureStore.retrieve_sites(mutations_dataframe), args.ref_seq_filename,
+                               build_options, args.workers)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,67 +1,71 @@
-import scipy
-import scipy.stats
 import argparse
-from pysam import AlignmentFile
 from pysam import FastaFile
 import pandas
-import math
+import multiprocessing
+import resource
+import sys
+import json
+import time
 from PileupColumnMask import PileupColumnMask
 from collections import OrderedDict
 from BasePairUtils import BasePairUtils
 from ArtifactAnalysisTable import ArtifactAnalysisTable
-from ArtifactAnalysisTable import ArtifactAnalysisTableUtils
 from PileupReadKnapsack import PileupReadKnapsack
 from PileupColumnKnapsack import PileupColumnKnapsack
+from PileupColumnMatrix import PileupColumnMatrix
+from PileupSweepEngine import PileupSweepEngine
+from AlignmentFileOpener import AlignmentFileOpener
+from ReadFetchEngine import ReadFetchEngine
+from ControlFeatureStore import ControlFeatureStore
+from FileHandlePool import FileHandlePool
+from SampleSiteCache import SampleSiteCache
+from FeatureTableWriter import FeatureTableWriter
+from CohortSharder import CohortSharder
+from SitePrefetcher import SitePrefetcher
+from GenomicShardPlanner import GenomicShardPlanner
+from FisherExactTest import FisherExactTest
+from ReferenceSequenceWindow import ReferenceSequenceWindow
+from PackedReferenceGenome import PackedReferenceGenome
+from MutationAnnotationFormatReader import MutationAnnotationFormatReader
+from MutationalFeatureTable import MutationalFeatureTable
+from SiteResultCache import SiteResultCache
+from PipelineProfiler import PipelineProfiler
+from GenomeMask import GenomeMask
+from PileupReadFilter import PileupReadFilter
+from FragmentDownsampler import FragmentDownsampler
 
 # Q. Does reverse strand impact query sequence?
 # A. No, it does not. Pysam orders them correctly.
 
 # Q. Two reasons for the clipping? base quality went down and they were alternate
 
+# the process' handle pool and sample site cache, shared by all of its pairs; see initialize_worker
+FILE_HANDLE_POOL = None
+SAMPLE_SITE_CACHE = None
+
 CODING_VARIANT_CLASSIFICATION = ["Frame_Shift_Del", "Frame_Shift_Ins", "Missense_Mutation", "Silent", "Splice_Site",
                                  "In_Frame_Ins", "In_Frame_Del", "Nonsense_Mutation", "Start_Codon_Del"]
 
 
-def retrieve_features(chrom, start, end, ref_allele, alt_allele, bam_file, prefix="case_", base_pair_mask=None):
-
-    dataTable = None
-    for pileupcolumn in bam_file.pileup(chrom, start, end, truncate=True):
-        if pileupcolumn.pos == start:
-            dataTable = ArtifactContingencyTable.create(ref_allele=ref_allele, alt_allele=alt_allele, pileupcolumn=pileupcolumn,
-                                         base_pair_mask=base_pair_mask)
-            break
-
-    contingency_table = dataTable.render_contingency_table(dataTable=dataTable)
-    _, two_sided_pvalue = scipy.stats.fisher_exact(contingency_table, alternative="two-sided")
-    _, greater_pvalue = scipy.stats.fisher_exact(contingency_table, alternative="greater")
-
-    clipped_contingency_table = dataTable.render_clipped_contingency_table(dataTable=dataTable)
-    _, two_sided_clipped_pvalue = scipy.stats.fisher_exact(clipped_contingency_table, alternative="two-sided")
-    _, greater_clipped_pvalue = scipy.stats.fisher_exact(clipped_contingency_table, alternative="greater")
+def insert_features(mutational_feature_table, indices, ref_allele, alt_allele, pileupcolumn, pileupcolumn_knapsack,
+                    pileupcolumn_mask, prefix="case_", pipeline_profiler=None, sampling_fraction=None):
+    # fills the prefix's count columns of the rows of the mutation (one per input row repeating it); their p-values
+    # are worked out for the whole pair at once, see MutationalFeatureTable.test
+    pipeline_profiler = PipelineProfiler.DISABLED if pipeline_profiler is None else pipeline_profiler
 
-    # row = pandas.Series({"Chromosome": chrom, "Start_position": start, "End_position": end,
-    #                      "Reference_Allele": ref_allele, "Tumor_Seq_Allele2": alt_allele
-    #                      "Tumor_Sample_Barcode": row["Tumor_Sample_Barcode"],
-    #                      "Matched_Norm_Sample_Barcode": row["Matched_Norm_Sample_Barcode"]})
-    row = ArtifactContingencyTable.retrieve_as_series(dataTable, prefix)
+    with pipeline_profiler.stage("table_create"):
+        data_table = ArtifactAnalysisTable.create(ref_allele, alt_allele, pileupcolumn, pileupcolumn_knapsack,
+                                                  pileupcolumn_mask)
 
-    two_sided_pvalue += ArtifactContingencyTable.EPS
-    greater_pvalue += ArtifactContingencyTable.EPS
-    two_sided_clipped_pvalue += ArtifactContingencyTable.EPS
-    greater_clipped_pvalue += ArtifactContingencyTable.EPS
-
-    row[prefix + "log_two_sided_p_value"] = math.log(two_sided_pvalue, 10)
-    row[prefix + "log_greater_p_value"] = math.log(greater_pvalue, 10)
-    row[prefix + "clipped_log_two_sided_p_value"] = math.log(two_sided_clipped_pvalue, 10)
-    row[prefix + "clipped_log_greater_p_value"] = math.log(greater_clipped_pvalue, 10)
-
-    return row
+    with pipeline_profiler.stage("row_assembly"):
+        mutational_feature_table.insert(indices, prefix, data_table, sampling_fraction)
 
 
 def main():
     parser = argparse.ArgumentParser(description="", epilog="")
-    parser.add_argument("--input_maf_filename", dest="input_maf_filename", action="store", required=True,
-                        help="Input MAF filename.")
+    parser.add_argument("--input_maf_filename", dest="input_maf_filename", action="store", required=True, nargs="+",
+                        help="Input MAF filename(s); rows of several MAFs (e.g. callers) repeating a mutation are "
+                             "computed once and all written.")
     parser.add_argument("--ref_seq_filename", dest="ref_seq_filename", action="store", required=False,
                         help="Reference genome sequence fasta",
                         default="/seq/references/Homo_sapiens_assembly19/v1/Homo_sapiens_assembly19.fasta")
@@ -73,119 +77,1034 @@ def main():
                         required=False, help="List of samples and associated bam filenames")
     parser.add_argument("--output_maf_filename", dest="output_maf_filename", action="store",
                         required=True, help="Name of the output MAF filename.")
+    parser.add_argument("--sweep", dest="sweep", action="store_true", required=False,
+                        help="Sort sites by position and share one forward pileup per merged window.")
+    parser.add_argument("--sweep_merge_distance", dest="sweep_merge_distance", action="store", type=int,
+                        required=False, default=PileupSweepEngine.DEFAULT_MERGE_DISTANCE,
+                        help="Sites closer than this many bases are swept with the same pileup.")
+    parser.add_argument("--workers", dest="workers", action="store", type=int, required=False, default=1,
+                        help="Number of processes; pairs are split into genomic shards of similar cost.")
+    parser.add_argument("--worker_memory_limit", dest="worker_memory_limit", action="store", type=int,
+                        required=False, default=None,
+                        help="Address space cap per worker process in MB; a pair exceeding it is skipped.")
+    parser.add_argument("--max_open_files", dest="max_open_files", action="store", type=int, required=False,
+                        default=FileHandlePool.DEFAULT_MAX_OPEN_FILES,
+                        help="Bams and references each process keeps open for the next pairs reading them "
+                             "(0 closes them after every pair).")
+    parser.add_argument("--max_shared_site_memory", dest="max_shared_site_memory", action="store", type=int,
+                        required=False, default=SampleSiteCache.DEFAULT_MAX_SITE_BYTES // (1024 * 1024),
+                        help="Estimated memory in MB for the sites of a bam several pairs read at the same locus (e.g. "
+                             "a shared normal), kept for the next of those pairs (0 builds them again for every "
+                             "pair). With --workers, each process keeps its own, and the shards reading the same "
+                             "loci are run in one process as far as the load stays even.")
+    parser.add_argument("--columnar", dest="columnar", action="store_true", required=False,
+                        help="Keep each site's context as a compact (columns x reads) code matrix.")
+    parser.add_argument("--read_fetch", dest="read_fetch", action="store_true", required=False,
+                        help="Count each site's reads from fetch() and their CIGAR and MD/NM tags instead of "
+                             "piling up their columns (overrides --sweep and --columnar).")
+    parser.add_argument("--packed_ref_seq_filename", dest="packed_ref_seq_filename", action="store",
+                        required=False, default=None,
+                        help="2-bit packed copy of the reference, built on first use and memory-mapped by every "
+                             "worker instead of the fasta.")
+    parser.add_argument("--maf_chunk_size", dest="maf_chunk_size", action="store", type=int, required=False,
+                        default=None,
+                        help="Stream the input MAF in chunks of this many rows, filtering and typing while parsing. "
+                             "With --case_sample_bam_filename and --control_sample_bam_filename the chunks are run "
+                             "and written one after the other in this process, so not with --workers; with "
+                             "--sample_bam_filename the whole MAF is read before its pairs are run.")
+    parser.add_argument("--maf_columns", dest="maf_columns", action="store", required=False, default=None,
+                        help="Comma separated MAF columns to keep when streaming; the ones the tool needs are "
+                             "always kept.")
+    parser.add_argument("--output_feature_table_filename", dest="output_feature_table_filename", action="store",
+                        required=False, default=None,
+                        help="Also write the annotated mutations as a compressed, typed Parquet file (Arrow IPC for "
+                             "a .arrow, .feather or .ipc name), one row group per pair; needs pyarrow.")
+    parser.add_argument("--output_feature_table_format", dest="output_feature_table_format", action="store",
+                        required=False, default=None, choices=FeatureTableWriter.FORMATS,
+                        help="Format of --output_feature_table_filename, instead of the one its extension names.")
+    parser.add_argument("--output_batch_size", dest="output_batch_size", action="store", type=int, required=False,
+                        default=None, help="Write and flush output rows in batches of at most this many rows.")
+    parser.add_argument("--site_result_cache_filename", dest="site_result_cache_filename", action="store",
+                        required=False, default=None,
+                        help="SQLite file of per-site results; sites already in it are not recomputed, so a "
+                             "restarted or extended run only computes the missing ones.")
+    parser.add_argument("--read_flag_filter", dest="read_flag_filter", action="store", type=lambda value: int(value, 0),
+                        required=False, default=PileupReadFilter.DEFAULT_FLAG_FILTER,
+                        help="Reads with any of these flags are left out of every pileup (e.g. 0xF04 also drops "
+                             "supplementary alignments).")
+    parser.add_argument("--min_mapping_quality", dest="min_mapping_quality", action="store", type=int,
+                        required=False, default=PileupReadFilter.DEFAULT_MIN_MAPPING_QUALITY,
+                        help="Reads below this mapping quality are left out of every pileup.")
+    parser.add_argument("--min_base_quality", dest="min_base_quality", action="store", type=int, required=False,
+                        default=PileupReadFilter.DEFAULT_MIN_BASE_QUALITY,
+                        help="Bases below this quality are left out of every pileup.")
+    parser.add_argument("--max_mismatches", dest="max_mismatches", action="store", type=int, required=False,
+                        default=None, help="Reads whose NM tag exceeds this are left out of every pileup.")
+    parser.add_argument("--max_depth", dest="max_depth", action="store", type=int, required=False, default=None,
+                        help="Use at most this many read fragments per site and sample, picked by a seeded hash of "
+                             "the query name; the fraction used is reported as *_sampling_fraction.")
+    parser.add_argument("--downsample_seed", dest="downsample_seed", action="store", type=int, required=False,
+                        default=FragmentDownsampler.DEFAULT_SEED, help="Seed of the --max_depth fragment hash.")
+    parser.add_argument("--mask_bed_filename", dest="mask_bed_filename", action="store", required=False,
+                        default=None, help="BED of positions (e.g. known germline or problematic sites) whose "
+                                           "columns are left out of every site's context.")
+    parser.add_argument("--genome_mask_filename", dest="genome_mask_filename", action="store", required=False,
+                        default=None, help="Memory-mapped bitset of the masked positions, built from "
+                                           "--mask_bed_filename on first use (default: the BED name + .mask).")
+    parser.add_argument("--io_threads", dest="io_threads", action="store", type=int, required=False, default=None,
+                        help="htslib decompression threads for every bam or cram opened (per worker).")
+    parser.add_argument("--ref_cache_dirname", dest="ref_cache_dirname", action="store", required=False,
+                        default=None,
+                        help="Directory of decoded reference contigs (htslib's REF_CACHE layout) that cram inputs "
+                             "are decoded against; filled from --ref_seq_filename on first use.")
+    parser.add_argument("--control_feature_store_filename", dest="control_feature_store_filename", action="store",
+                        required=False, default=None,
+                        help="Panel of normals store (see ControlFeatureStore.py) the control side of its sites is "
+                             "read from, when it holds the control bam and was built with the same settings.")
+    parser.add_argument("--prefetch_sites", dest="prefetch_sites", action="store", type=int, required=False,
+                        default=None,
+                        help="Read case and control sites ahead, each in a thread of its own, holding at most this "
+                             "many sites ahead of the features being computed.")
+    parser.add_argument("--profile", dest="profile_json_filename", action="store", required=False, default=None,
+                        help="Write a JSON report of per stage wall time, call counts and traced peak memory, work "
+                             "per site and the slowest sites to this file. Memory tracing slows the run down "
+                             "severalfold.")
+    parser.add_argument("--profile_site_count", dest="profile_site_count", action="store", type=int,
+                        required=False, default=PipelineProfiler.DEFAULT_SLOWEST_SITE_COUNT,
+                        help="Number of slowest sites kept in the profile.")
 
     # TODO: add option for both germline and somatic mask, etc.
 
     args, _ = parser.parse_known_args()
+    # checked before the output MAF is opened, so that a bad option leaves it as it was
+    if args.output_feature_table_filename is not None and not FeatureTableWriter.is_available():
+        parser.error("--output_feature_table_filename needs pyarrow, which is not installed.")
+    if args.output_feature_table_format is not None and args.output_feature_table_filename is None:
+        parser.error("--output_feature_table_format needs --output_feature_table_filename.")
+    is_sample_sheet = (not args.case_sample_bam_filename or not args.control_sample_bam_filename) and \
+        args.sample_bam_filename is not None
+    if args.maf_chunk_size is not None and not is_sample_sheet and args.workers > 1:
+        # sharding needs every row up front, which would read the whole MAF before the first chunk is run
+        parser.error("--maf_chunk_size streams the MAF through a single process; it cannot be used with --workers.")
 
-    mutations_dataframe = pandas.read_csv(args.input_maf_filename, sep="\t", header=0, comment="#")
-    mutations_dataframe = mutations_dataframe[(mutations_dataframe["Variant_Type"] == "SNP")]  # use SNPs
-    mutations_dataframe = \
-        mutations_dataframe[mutations_dataframe["Variant_Classification"].isin(CODING_VARIANT_CLASSIFICATION)]  # use coding regions
-    mutations_2_write = pandas.DataFrame()
-
+    start_time = time.time()
+    if args.maf_chunk_size is not None:
+        # SNPs in coding regions, filtered chunk by chunk as the file is parsed; a scattered MAF's row numbers are
+        # kept for gather
+        maf_readers = [MutationAnnotationFormatReader(input_maf_filename, variant_types=["SNP"],
+                                                      variant_classifications=CODING_VARIANT_CLASSIFICATION,
+                                                      columns=args.maf_columns.split(",") +
+                                                      [CohortSharder.INDEX_COLUMN] if args.maf_columns else None,
+                                                      chunk_size=args.maf_chunk_size)
+                       for input_maf_filename in args.input_maf_filename]
+        mutations_dataframe = None
+    else:
+        maf_readers = None
+        mutations_dataframe = read_mutations_dataframe(args.input_maf_filename)
     # mutations = mutations.drop_duplicates()
 
+    with open(args.output_maf_filename, "w") as output_maf_file:
+        if is_sample_sheet:
+            if maf_readers is not None:  # pairs are only known once every chunk is in
+                mutations_dataframe = pandas.concat([maf_reader.read() for maf_reader in maf_readers],
+                                                    ignore_index=True)
+            pairs = retrieve_sample_pairs(mutations_dataframe, args.sample_bam_filename)
+        elif maf_readers is not None:
+            # every chunk is run as a pair of its own, so rows are written while later chunks are still unparsed
+            pairs = ((mutations_dataframe_chunk, args.case_sample_bam_filename, args.control_sample_bam_filename)
+                     for maf_reader in maf_readers for mutations_dataframe_chunk in maf_reader.read_chunks())
+        else:
+            pairs = [(mutations_dataframe, args.case_sample_bam_filename, args.control_sample_bam_filename)]
+
+        # keyword arguments of retrieve_mutational_features shared by every pair
+        feature_options = dict(sweep=args.sweep, sweep_merge_distance=args.sweep_merge_distance,
+                               columnar=args.columnar, read_fetch=args.read_fetch, read_flag_filter=args.read_flag_filter,
+                               min_mapping_quality=args.min_mapping_quality, min_base_quality=args.min_base_quality,
+                               max_mismatches=args.max_mismatches)
+        if args.max_depth is not None:
+            feature_options["max_depth"] = args.max_depth
+            feature_options["downsample_seed"] = args.downsample_seed
+        if args.packed_ref_seq_filename is not None:
+            # built once here so that the workers only ever map it
+            feature_options["packed_ref_seq_filename"] = \
+                PackedReferenceGenome.retrieve(args.ref_seq_filename, args.packed_ref_seq_filename)
+        if args.site_result_cache_filename is not None:
+            feature_options["site_result_cache_filename"] = args.site_result_cache_filename
+        if args.mask_bed_filename is not None:
+            feature_options["genome_mask_filename"] = \
+                GenomeMask.retrieve(args.mask_bed_filename, args.ref_seq_filename,
+                                    args.genome_mask_filename if args.genome_mask_filename is not None else
+                                    args.mask_bed_filename + ".mask")
+        elif args.genome_mask_filename is not None:
+            feature_options["genome_mask_filename"] = args.genome_mask_filename
+        if args.io_threads is not None:
+            feature_options["io_threads"] = args.io_threads
+        if args.ref_cache_dirname is not None:
+            feature_options["ref_cache_dirname"] = args.ref_cache_dirname
+        if args.control_feature_store_filename is not None:
+            feature_options["control_feature_store_filename"] = args.control_feature_store_filename
+        if args.prefetch_sites is not None:
+            feature_options["prefetch_sites"] = args.prefetch_sites
+
+        # every task profiles itself (possibly in a worker) and its report is merged into this one
+        pipeline_profiler = PipelineProfiler.DISABLED
+        if args.profile_json_filename is not None:
+            pipeline_profiler = PipelineProfiler(slowest_site_count=args.profile_site_count)
+            feature_options["profile_site_count"] = args.profile_site_count
+
+        if args.workers > 1:
+            mutation_groups = retrieve_sharded_mutation_groups(pairs, args.ref_seq_filename,
+                                                               feature_options, args.workers,
+                                                               args.worker_memory_limit, pipeline_profiler,
+                                                               args.max_open_files,
+                                                               args.max_shared_site_memory * 1024 * 1024)
+        else:
+            # the loci several pairs read from the same bam; streamed chunks are never planned
+            planned_site_uses = SampleSiteCache.plan(pairs) \
+                if isinstance(pairs, list) and args.max_shared_site_memory > 0 else None
+            initialize_worker(args.worker_memory_limit, args.max_open_files, planned_site_uses,
+                              args.max_shared_site_memory * 1024 * 1024)
+            mutation_groups = retrieve_mutation_groups(pairs, args.ref_seq_filename, feature_options,
+                                                       pipeline_profiler)
+        feature_table_writer = None
+        if args.output_feature_table_filename is not None:
+            ref_seq_file = FastaFile(args.ref_seq_filename)
+            feature_table_writer = FeatureTableWriter(args.output_feature_table_filename, ref_seq_file.references,
+                                                      args.output_feature_table_format)
+            ref_seq_file.close()
+        try:
+            write_mutation_groups(output_maf_file, mutation_groups, args.output_batch_size, feature_table_writer)
+        finally:
+            if feature_table_writer is not None:
+                feature_table_writer.close()
+        if FILE_HANDLE_POOL is not None:
+            FILE_HANDLE_POOL.close()
+
+    if pipeline_profiler.is_enabled:
+        profile_report = pipeline_profiler.retrieve_report()
+        profile_report["wall_seconds"] = time.time() - start_time
+        profile_report["max_rss_kilobytes"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        with open(args.profile_json_filename, "w") as profile_json_file:
+            json.dump(profile_report, profile_json_file, indent=2)
+
+
+def scatter(argv):
+    parser = argparse.ArgumentParser(prog="FFPEAritfactFinder.py scatter",
+                                     description="Splits the cohort's mutations into shard MAFs of similar estimated "
+                                                 "cost, to be run as separate jobs and gathered afterwards.")
+    parser.add_argument("--input_maf_filename", dest="input_maf_filename", action="store", required=True, nargs="+",
+                        help="Input MAF filename(s), as they would be given to a single run.")
+    parser.add_argument("--case_sample_bam_filename", dest="case_sample_bam_filename", action="store", required=False,
+                        help="Case sample bam filename")
+    parser.add_argument("--control_sample_bam_filename", dest="control_sample_bam_filename", action="store",
+                        required=False, help="Control sample bam filename")
+    parser.add_argument("--sample_bam_filename", dest="sample_bam_filename", action="store",
+                        required=False, help="List of samples and associated bam filenames")
+    parser.add_argument("--shard_count", dest="shard_count", action="store", type=int, required=True,
+                        help="Number of shard MAFs written, one per job.")
+    parser.add_argument("--output_shard_prefix", dest="output_shard_prefix", action="store", required=True,
+                        help="Shard MAFs are written as <prefix>.<shard>.maf (shards numbered from 0), next to "
+                             "<prefix>.manifest.json, which gather checks the jobs' outputs against.")
+    parser.add_argument("--regions_per_shard", dest="regions_per_shard", action="store", type=int, required=False,
+                        default=CohortSharder.DEFAULT_REGIONS_PER_SHARD,
+                        help="Number of genomic regions every pair is cut into, per shard, before they are dealt "
+                             "out; more regions balance the shards better and split pairs across more of them.")
+
+    args, _ = parser.parse_known_args(argv)
+
+    mutations_dataframe = read_mutations_dataframe(args.input_maf_filename)
     if (not args.case_sample_bam_filename or not args.control_sample_bam_filename) \
             and args.sample_bam_filename is not None:
-        samples = pandas.read_csv(args.sample_bam_filename, sep="\t")
-        samples = samples[["sample_id", "clean_bam_file_capture"]]  # subset
-        mutations_dataframe = mutations_dataframe.sort(["Tumor_Sample_Barcode", "Matched_Norm_Sample_Barcode"])  # sort by case and control sample names
-        mutations_dataframe = mutations_dataframe[(mutations_dataframe["Tumor_Sample_Barcode"].isin(samples["sample_id"])) &
-                                                  (mutations_dataframe["Matched_Norm_Sample_Barcode"].isin(samples["sample_id"]))]
-
-        mutations_dataframe_grouped = mutations_dataframe.groupby(["Tumor_Sample_Barcode", "Matched_Norm_Sample_Barcode"])
-        column_names = None
-
-        for _, mutations_dataframe_group in mutations_dataframe_grouped:
-            case_sample_bam_filename = \
-                samples[samples["sample_id"].isin([mutations_dataframe_group["Tumor_Sample_Barcode"][0]])].iloc[0, 1]
-            control_sample_bam_filename = \
-                samples[samples["sample_id"].isin([mutations_dataframe_group["Matched_Norm_Sample_Barcode"][0]])].iloc[0, 1]
-
-            mutational_features = retrieve_mutational_features(mutations_dataframe=mutations_dataframe_group,
-                                                               case_sample_bam_filename=case_sample_bam_filename,
-                                                               control_sample_bam_filename=control_sample_bam_filename,
-                                                               ref_seq_filename=args.ref_seq_filename)
-
-        #     mutation_group = pandas.merge(control_mutations, case_mutations, how="inner")
-        #     column_names = mutation_group.columns.tolist() if column_names is None else column_names
-        #     mutations_2_write = pandas.concat([mutations_2_write, mutation_group])
-        # mutations_2_write = mutations_2_write[column_names]
+        pairs = retrieve_sample_pairs(mutations_dataframe, args.sample_bam_filename)
     else:
+        pairs = [(mutations_dataframe, args.case_sample_bam_filename, args.control_sample_bam_filename)]
+    manifest = CohortSharder(args.shard_count, args.regions_per_shard).scatter(pairs, args.output_shard_prefix)
+    for shard in manifest["shards"]:
+        sys.stderr.write("%s: %d rows of %d pairs, cost %.1f\n" %
+                         (shard["maf_filename"], shard["row_count"], shard["pair_count"], shard["cost"]))
+
+
+def gather(argv):
+    parser = argparse.ArgumentParser(prog="FFPEAritfactFinder.py gather",
+                                     description="Merges the output MAFs of the scattered shards' jobs, in the order "
+                                                 "a single run writes them, and their profiles.")
+    parser.add_argument("--manifest_filename", dest="manifest_filename", action="store", required=True,
+                        help="The manifest scatter wrote, <prefix>.manifest.json.")
+    parser.add_argument("--shard_output_maf_filename", dest="shard_output_maf_filename", action="store",
+                        required=True, nargs="+", help="The jobs' output MAFs, in any order.")
+    parser.add_argument("--output_maf_filename", dest="output_maf_filename", action="store",
+                        required=True, help="Output MAF filename")
+    parser.add_argument("--allow_missing_rows", dest="allow_missing_rows", action="store_true", required=False,
+                        help="Only warn about rows no job wrote (e.g. pairs skipped for their worker memory limit) "
+                             "instead of failing.")
+    parser.add_argument("--shard_profile_filename", dest="shard_profile_filename", action="store", required=False,
+                        nargs="+", default=None, help="The jobs' --profile reports, to be combined.")
+    parser.add_argument("--profile", dest="profile_json_filename", action="store", required=False, default=None,
+                        help="Write the combined profile of the jobs to this file: stages, sites and counters summed "
+                             "over the jobs, the slowest sites of them all, the slowest job's wall time and the "
+                             "largest resident set.")
+    parser.add_argument("--profile_site_count", dest="profile_site_count", action="store", type=int,
+                        required=False, default=PipelineProfiler.DEFAULT_SLOWEST_SITE_COUNT,
+                        help="Number of slowest sites kept in the profile.")
+
+    args, _ = parser.parse_known_args(argv)
+
+    with open(args.manifest_filename) as manifest_file:
+        manifest = json.load(manifest_file)
+    try:
+        missing_row_indices = CohortSharder.gather(manifest, args.shard_output_maf_filename,
+                                                   args.output_maf_filename, args.allow_missing_rows)
+    except (ValueError, IOError) as error:  # the output MAF is left as it was
+        sys.exit("gather failed: %s" % error)
+    if missing_row_indices:
+        sys.stderr.write("%d of %d rows are missing from the outputs.\n" %
+                         (len(missing_row_indices), manifest["row_count"]))
+
+    if args.profile_json_filename is not None:
+        pipeline_profiler = PipelineProfiler(slowest_site_count=args.profile_site_count, trace_memory=False)
+        shard_profile_reports = []
+        for shard_profile_filename in args.shard_profile_filename or []:
+            with open(shard_profile_filename) as shard_profile_file:
+                shard_profile_report = json.load(shard_profile_file)
+            pipeline_profiler.merge(shard_profile_report)
+            shard_profile_reports += [dict(profile_filename=shard_profile_filename,
+                                           wall_seconds=shard_profile_report.get("wall_seconds"),
+                                           max_rss_kilobytes=shard_profile_report.get("max_rss_kilobytes"))]
+        profile_report = pipeline_profiler.retrieve_report()
+        wall_seconds = [shard_profile_report["wall_seconds"] for shard_profile_report in shard_profile_reports
+                        if shard_profile_report["wall_seconds"] is not None]
+        max_rss_kilobytes = [shard_profile_report["max_rss_kilobytes"] for shard_profile_report in
+                             shard_profile_reports if shard_profile_report["max_rss_kilobytes"] is not None]
+        # the jobs run side by side: the slowest of them bounds the cohort's wall time
+        profile_report["wall_seconds"] = max(wall_seconds) if wall_seconds else None
+        profile_report["total_wall_seconds"] = sum(wall_seconds)
+        profile_report["max_rss_kilobytes"] = max(max_rss_kilobytes) if max_rss_kilobytes else None
+        profile_report["shards"] = shard_profile_reports
+        with open(args.profile_json_filename, "w") as profile_json_file:
+            json.dump(profile_report, profile_json_file, indent=2)
+
+
+def read_mutations_dataframe(input_maf_filenames):
+    # several MAFs are stacked; their rows are numbered anew
+    mutations_dataframe = pandas.concat([pandas.read_csv(input_maf_filename, sep="\t", header=0, comment="#")
+                                         for input_maf_filename in input_maf_filenames], ignore_index=True)
+    mutations_dataframe = mutations_dataframe[(mutations_dataframe["Variant_Type"] == "SNP")]  # use SNPs
+    mutations_dataframe = \
+        mutations_dataframe[mutations_dataframe["Variant_Classification"].isin(CODING_VARIANT_CLASSIFICATION)]  # use coding regions
+    return mutations_dataframe
+
+
+def retrieve_sample_pairs(mutations_dataframe, sample_bam_filename):
+    # -> [(mutations, case bam, control bam), ...] of the pairs whose samples are both in the sample sheet
+    samples = pandas.read_csv(sample_bam_filename, sep="\t")
+    samples = samples[["sample_id", "clean_bam_file_capture"]]  # subset
+    mutations_dataframe = mutations_dataframe.sort_values(["Tumor_Sample_Barcode",
+                                                           "Matched_Norm_Sample_Barcode"])  # sort by case and control sample names
+    mutations_dataframe = mutations_dataframe[(mutations_dataframe["Tumor_Sample_Barcode"].isin(samples["sample_id"])) &
+                                              (mutations_dataframe["Matched_Norm_Sample_Barcode"].isin(samples["sample_id"]))]
+
+    mutations_dataframe_grouped = mutations_dataframe.groupby(["Tumor_Sample_Barcode", "Matched_Norm_Sample_Barcode"])
+
+    pairs = []
+    for _, mutations_dataframe_group in mutations_dataframe_grouped:
+        case_sample_bam_filename = \
+            samples[samples["sample_id"].isin([mutations_dataframe_group["Tumor_Sample_Barcode"].iloc[0]])].iloc[0, 1]
+        control_sample_bam_filename = \
+            samples[samples["sample_id"].isin([mutations_dataframe_group["Matched_Norm_Sample_Barcode"].iloc[0]])].iloc[0, 1]
+        pairs += [(mutations_dataframe_group, case_sample_bam_filename, control_sample_bam_filename)]
+    return pairs
+
+
+def initialize_worker(memory_limit=None, max_open_files=None, planned_site_uses=None, max_shared_site_bytes=None):
+    # memory_limit in MB; caps the address space so one huge bam fails its own pair rather than the node.
+    # planned_site_uses: see SampleSiteCache.plan
+    global FILE_HANDLE_POOL
+    global SAMPLE_SITE_CACHE
+    FILE_HANDLE_POOL = FileHandlePool(max_open_files)
+    SAMPLE_SITE_CACHE = SampleSiteCache(planned_site_uses, max_shared_site_bytes) if planned_site_uses else None
+    if memory_limit is not None:
+        memory_limit_bytes = memory_limit * 1024 * 1024
+        _, hard_limit = resource.getrlimit(resource.RLIMIT_AS)
+        if hard_limit != resource.RLIM_INFINITY:
+            memory_limit_bytes = min(memory_limit_bytes, hard_limit)
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit_bytes, hard_limit))
+
+
+def retrieve_task_mutational_features(task):
+    # (key, mutations, case bam, control bam, reference, feature options) -> (key, features or None, profile report
+    # or None); a profile_site_count feature option turns profiling on
+    key, mutations_dataframe, case_sample_bam_filename, control_sample_bam_filename, ref_seq_filename, \
+        feature_options = task
+    feature_options = dict(feature_options)
+    profile_site_count = feature_options.pop("profile_site_count", None)
+    pipeline_profiler = PipelineProfiler(slowest_site_count=profile_site_count) \
+        if profile_site_count is not None else PipelineProfiler.DISABLED
+
+    file_handle_pool_counts = FILE_HANDLE_POOL.retrieve_counts() if FILE_HANDLE_POOL is not None else None
+    sample_site_cache_counts = SAMPLE_SITE_CACHE.retrieve_counts() if SAMPLE_SITE_CACHE is not None else None
+    pipeline_profiler.start()
+    try:
         mutational_features = retrieve_mutational_features(mutations_dataframe=mutations_dataframe,
-                                                           case_sample_bam_filename=args.case_sample_bam_filename,
-                                                           control_sample_bam_filename=args.control_sample_bam_filename,
-                                                           ref_seq_filename=args.ref_seq_filename)
-    mutations_2_write.to_csv(args.output_maf_filename, sep="\t", index=False)
+                                                           case_sample_bam_filename=case_sample_bam_filename,
+                                                           control_sample_bam_filename=control_sample_bam_filename,
+                                                           ref_seq_filename=ref_seq_filename,
+                                                           pipeline_profiler=pipeline_profiler,
+                                                           file_handle_pool=FILE_HANDLE_POOL,
+                                                           sample_site_cache=SAMPLE_SITE_CACHE, **feature_options)
+    except MemoryError:
+        sys.stderr.write("Skipping pair %s/%s: worker memory limit exceeded.\n" %
+                         (case_sample_bam_filename, control_sample_bam_filename))
+        mutational_features = None
+    finally:
+        pipeline_profiler.stop()
+        if file_handle_pool_counts is not None:  # the task's share of the pool's counts
+            pipeline_profiler.record_counts("file_handle_pool",
+                                            dict([(name, count - file_handle_pool_counts[name])
+                                                  for name, count in FILE_HANDLE_POOL.retrieve_counts().items()]))
+        if sample_site_cache_counts is not None:
+            pipeline_profiler.record_counts("sample_site_cache",
+                                            dict([(name, count - sample_site_cache_counts[name])
+                                                  for name, count in SAMPLE_SITE_CACHE.retrieve_counts().items()]))
+    return key, mutational_features, \
+        pipeline_profiler.retrieve_report() if pipeline_profiler.is_enabled else None
+
+
+def retrieve_task_group_mutational_features(task_group):
+    # (tasks, planned site uses, max shared site bytes) -> [retrieve_task_mutational_features of every task, ...];
+    # the tasks share the sites of the plan, which only counts their own uses (see SampleSiteCache.group)
+    global SAMPLE_SITE_CACHE
+    tasks, planned_site_uses, max_shared_site_bytes = task_group
+    SAMPLE_SITE_CACHE = SampleSiteCache(planned_site_uses, max_shared_site_bytes) if planned_site_uses else None
+    try:
+        return [retrieve_task_mutational_features(task) for task in tasks]
+    finally:
+        SAMPLE_SITE_CACHE = None  # what is left is of no use to the next group
+
+
+def join_mutational_features(mutations_dataframe, mutational_features):
+    # a pair is written only if every one of its shards came back
+    if any([shard_mutational_features is None for shard_mutational_features in mutational_features]):
+        return None
+    if not mutational_features:
+        return mutations_dataframe
+    return mutations_dataframe.join(pandas.concat(mutational_features))
+
+
+def retrieve_mutation_groups(pairs, ref_seq_filename, feature_options, pipeline_profiler=None):
+    # -> ((case bam, control bam), the pair's annotated mutations or None when skipped), ... in the pairs' order
+    pipeline_profiler = PipelineProfiler.DISABLED if pipeline_profiler is None else pipeline_profiler
+    for mutations_dataframe_group, case_sample_bam_filename, control_sample_bam_filename in pairs:
+        _, mutational_features, profile_report = \
+            retrieve_task_mutational_features((None, mutations_dataframe_group, case_sample_bam_filename,
+                                               control_sample_bam_filename, ref_seq_filename, feature_options))
+        if profile_report is not None:
+            pipeline_profiler.merge(profile_report)
+        yield (case_sample_bam_filename, control_sample_bam_filename), \
+            join_mutational_features(mutations_dataframe_group, [mutational_features])
+
+
+def retrieve_sharded_mutation_groups(pairs, ref_seq_filename, feature_options, workers, worker_memory_limit=None,
+                                     pipeline_profiler=None, max_open_files=None, max_shared_site_bytes=None):
+    # every pair is cut into genomic shards of similar estimated cost, all shards share one pool and the pairs are
+    # handed back in their original order once all of their shards are done, as retrieve_mutation_groups does. Shards
+    # of different pairs reading the same loci of a bam run in one task, up to a worker's share of the cost, so that
+    # they share the sites (see SampleSiteCache); max_shared_site_bytes 0 runs every shard on its own
+    genomic_shard_planners = [GenomicShardPlanner([case_sample_bam_filename, control_sample_bam_filename])
+                              for _, case_sample_bam_filename, control_sample_bam_filename in pairs]
+    total_cost = sum([genomic_shard_planner.retrieve_cost(mutations_dataframe_group)
+                      for genomic_shard_planner, (mutations_dataframe_group, _, _) in zip(genomic_shard_planners,
+                                                                                            pairs)])
+    target_cost = total_cost / float(workers * GenomicShardPlanner.DEFAULT_SHARDS_PER_WORKER)
+    pipeline_profiler = PipelineProfiler.DISABLED if pipeline_profiler is None else pipeline_profiler
+
+    shards = []
+    for pair_index, (mutations_dataframe_group, _, _) in enumerate(pairs):
+        for genomic_shard in genomic_shard_planners[pair_index].create_shards(mutations_dataframe_group, target_cost):
+            shards += [(genomic_shard.cost, pair_index, mutations_dataframe_group.loc[genomic_shard.indices])]
+
+    shard_pairs = [(shard_mutations_dataframe, pairs[pair_index][1], pairs[pair_index][2])
+                   for _, pair_index, shard_mutations_dataframe in shards]
+    if max_shared_site_bytes is None or max_shared_site_bytes > 0:
+        shard_groups = SampleSiteCache.group(shard_pairs, [cost for cost, _, _ in shards],
+                                             total_cost / float(workers))
+    else:
+        shard_groups = [[shard_index] for shard_index in range(len(shards))]
+    # costliest groups first; the pool's shared task queue lets whichever worker goes idle take the next pending one
+    shard_groups.sort(key=lambda shard_group: -sum([shards[shard_index][0] for shard_index in shard_group]))
+    task_groups = [([(shards[shard_index][1],) + shard_pairs[shard_index] + (ref_seq_filename, feature_options)
+                     for shard_index in shard_group],
+                    SampleSiteCache.plan([shard_pairs[shard_index] for shard_index in shard_group]),
+                    max_shared_site_bytes) for shard_group in shard_groups]
+
+    pending_shard_counts = [0] * len(pairs)
+    for _, pair_index, _ in shards:
+        pending_shard_counts[pair_index] += 1
+    pair_mutational_features = [[] for _ in pairs]
+
+    pool = multiprocessing.Pool(processes=workers, initializer=initialize_worker,
+                                initargs=(worker_memory_limit, max_open_files))
+    try:
+        results = (result for task_group_results in
+                   pool.imap_unordered(retrieve_task_group_mutational_features, task_groups)
+                   for result in task_group_results)
+        for pair_index, (mutations_dataframe_group, _, _) in enumerate(pairs):
+            while pending_shard_counts[pair_index] > 0:
+                shard_pair_index, mutational_features, profile_report = next(results)
+                if profile_report is not None:
+                    pipeline_profiler.merge(profile_report)
+                pending_shard_counts[shard_pair_index] -= 1
+                pair_mutational_features[shard_pair_index] += [mutational_features]
+            yield pairs[pair_index][1:], \
+                join_mutational_features(mutations_dataframe_group, pair_mutational_features[pair_index])
+            pair_mutational_features[pair_index] = None
+        pool.close()
+    except BaseException:
+        pool.terminate()  # do not wait for the remaining shards
+        raise
+    finally:
+        pool.join()
+
+
+def write_mutation_groups(output_maf_file, mutation_groups, batch_size=None, feature_table_writer=None):
+    # mutation_groups: (pair key, annotated mutations), ... as retrieve_mutation_groups yields them. Streams each
+    # group's rows as soon as it is done, at most batch_size rows per flush; the header comes with the first written
+    # batch. A feature_table_writer gets the rows of every pair (all of its groups) as one row group
+    is_header_written = False
+    for pair_key, mutation_group in mutation_groups:
+        if mutation_group is None:
+            continue
+        if feature_table_writer is not None:
+            feature_table_writer.write(mutation_group, pair_key)
+        group_batch_size = len(mutation_group) if batch_size is None else batch_size
+        for batch_start in range(0, max(len(mutation_group), 1), max(group_batch_size, 1)):
+            mutation_group.iloc[batch_start:batch_start + group_batch_size].to_csv(
+                output_maf_file, sep="\t", index=False, header=not is_header_written)
+            output_maf_file.flush()
+            is_header_written = True
 
 
 def retrieve_mutational_features(mutations_dataframe, case_sample_bam_filename, control_sample_bam_filename,
-                                 ref_seq_filename):
+                                 ref_seq_filename, sweep=False, sweep_merge_distance=None, columnar=False,
+                                 read_fetch=False, packed_ref_seq_filename=None, site_result_cache_filename=None,
+                                 genome_mask_filename=None, read_flag_filter=None, min_mapping_quality=None,
+                                 min_base_quality=None, max_mismatches=None, max_depth=None, downsample_seed=None,
+                                 io_threads=None, ref_cache_dirname=None, control_feature_store_filename=None,
+                                 prefetch_sites=None, pipeline_profiler=None, file_handle_pool=None,
+                                 sample_site_cache=None, site_result_cache=None):
+    # site_result_cache: where the engines add their sites as they go, see retrieve_cached_mutational_features
+    pipeline_profiler = PipelineProfiler.DISABLED if pipeline_profiler is None else pipeline_profiler
+
+    if site_result_cache_filename is not None:
+        return retrieve_cached_mutational_features(mutations_dataframe, case_sample_bam_filename,
+                                                   control_sample_bam_filename, ref_seq_filename,
+                                                   site_result_cache_filename, pipeline_profiler, file_handle_pool,
+                                                   sample_site_cache, sweep=sweep,
+                                                   sweep_merge_distance=sweep_merge_distance, columnar=columnar,
+                                                   read_fetch=read_fetch,
+                                                   packed_ref_seq_filename=packed_ref_seq_filename,
+                                                   genome_mask_filename=genome_mask_filename,
+                                                   read_flag_filter=read_flag_filter,
+                                                   min_mapping_quality=min_mapping_quality,
+                                                   min_base_quality=min_base_quality, max_mismatches=max_mismatches,
+                                                   max_depth=max_depth, downsample_seed=downsample_seed,
+                                                   io_threads=io_threads, ref_cache_dirname=ref_cache_dirname,
+                                                   control_feature_store_filename=control_feature_store_filename,
+                                                   prefetch_sites=prefetch_sites)
 
     # works for SNPs only
-    case_sample_bam_file = AlignmentFile(case_sample_bam_filename, "rb")
-    control_sample_bam_file = AlignmentFile(control_sample_bam_filename, "rb")
-    ref_seq_file = FastaFile(ref_seq_filename)
+    # handles come from the process' pool when there is one; otherwise they are closed once the call is done
+    file_handle_pool = FileHandlePool(max_open_files=0) if file_handle_pool is None else file_handle_pool
+    alignment_file_opener = AlignmentFileOpener(ref_seq_filename, io_threads, ref_cache_dirname)
+    # whatever was acquired goes back to the pool (or is closed) even when the pair fails, e.g. on the worker's
+    # memory limit, since the worker goes on with its next pair
+    case_sample_bam_file = None
+    control_sample_bam_file = None
+    case_ref_seq_file = None
+    control_ref_seq_file = None
+    genome_mask = None
+    control_feature_store = None
+    try:
+        case_sample_bam_file = file_handle_pool.acquire_alignment_file(alignment_file_opener,
+                                                                       case_sample_bam_filename)
+        control_sample_bam_file = file_handle_pool.acquire_alignment_file(alignment_file_opener,
+                                                                          control_sample_bam_filename)
+        # case and control read the same reference bases, so they share one window of it; with prefetch_sites they
+        # are read ahead in threads of their own (see SitePrefetcher), each through its own reference handle and
+        # window
+        case_ref_seq_file = ReferenceSequenceWindow(file_handle_pool.acquire_ref_seq_file(ref_seq_filename,
+                                                                                          packed_ref_seq_filename))
+        control_ref_seq_file = ReferenceSequenceWindow(file_handle_pool.acquire_ref_seq_file(
+            ref_seq_filename, packed_ref_seq_filename)) if prefetch_sites else case_ref_seq_file
+        fisher_exact_test = FisherExactTest()  # tests all of the pair's tables in one batch
+        genome_mask = GenomeMask(genome_mask_filename) if genome_mask_filename is not None else None
+        # the same read filters for case and control, applied inside every pileup
+        pileup_read_filter = PileupReadFilter(flag_filter=read_flag_filter, min_mapping_quality=min_mapping_quality,
+                                              min_base_quality=min_base_quality, max_mismatches=max_mismatches)
+        # the same fragment sampling for case and control
+        fragment_downsampler = FragmentDownsampler(max_depth, downsample_seed) if max_depth is not None else None
+        # the control side of the sites a panel of normals store holds is read from it, not from the control bam; a
+        # store built with other settings, or without this control, is not used
+        control_feature_store = ControlFeatureStore(control_feature_store_filename) \
+            if control_feature_store_filename is not None else None
+        stored_control_sample = control_feature_store.retrieve_sample(
+            control_sample_bam_filename, ControlFeatureStore.retrieve_options(
+                ref_seq_filename, genome_mask_filename, read_flag_filter, min_mapping_quality, min_base_quality,
+                max_mismatches, max_depth, downsample_seed)) if control_feature_store is not None else None
+        # the sites of the loci other pairs read from the same bam are built once per process and shared
+        cached_case_sample = sample_site_cache.retrieve_sample(case_sample_bam_filename) \
+            if sample_site_cache is not None else None
+        cached_control_sample = sample_site_cache.retrieve_sample(control_sample_bam_filename) \
+            if sample_site_cache is not None else None
+
+        if read_fetch:
+            mutational_features = retrieve_fetched_mutational_features(mutations_dataframe, case_sample_bam_file,
+                                                                       control_sample_bam_file, case_ref_seq_file,
+                                                                       fisher_exact_test, pipeline_profiler,
+                                                                       genome_mask, pileup_read_filter,
+                                                                       fragment_downsampler, stored_control_sample,
+                                                                       control_ref_seq_file, prefetch_sites,
+                                                                       cached_case_sample, cached_control_sample,
+                                                                       site_result_cache)
+        elif sweep:
+            mutational_features = retrieve_swept_mutational_features(mutations_dataframe, case_sample_bam_file,
+                                                                     control_sample_bam_file, case_ref_seq_file,
+                                                                     sweep_merge_distance, columnar,
+                                                                     fisher_exact_test, pipeline_profiler,
+                                                                     genome_mask, pileup_read_filter,
+                                                                     fragment_downsampler, stored_control_sample,
+                                                                     control_ref_seq_file, prefetch_sites,
+                                                                     cached_case_sample, cached_control_sample,
+                                                                     site_result_cache)
+        else:
+            pileupcolumn_knapsack_class = PileupColumnMatrix if columnar else PileupColumnKnapsack
+            locus_mutations = retrieve_locus_mutations(mutations_dataframe)
+            sample_pipeline_profilers = retrieve_sample_pipeline_profilers(pipeline_profiler, prefetch_sites)
+            case_sites = retrieve_sample_sites(list(locus_mutations.keys()), case_sample_bam_file,
+                                               case_ref_seq_file, pileupcolumn_knapsack_class, genome_mask,
+                                               pileup_read_filter, fragment_downsampler, sample_pipeline_profilers[0],
+                                               cached_sample=cached_case_sample)
+            control_sites = retrieve_sample_sites(list(locus_mutations.keys()), control_sample_bam_file,
+                                                  control_ref_seq_file, pileupcolumn_knapsack_class, genome_mask,
+                                                  pileup_read_filter, fragment_downsampler,
+                                                  sample_pipeline_profilers[1], stored_control_sample,
+                                                  cached_control_sample)
+            mutational_features = retrieve_paired_mutational_features(mutations_dataframe, locus_mutations,
+                                                                      case_sites, control_sites, fisher_exact_test,
+                                                                      pipeline_profiler, fragment_downsampler,
+                                                                      prefetch_sites, site_result_cache,
+                                                                      sample_pipeline_profilers)
+    finally:
+        if case_sample_bam_file is not None:
+            file_handle_pool.release(case_sample_bam_file)
+        if control_sample_bam_file is not None:
+            file_handle_pool.release(control_sample_bam_file)
+        if case_ref_seq_file is not None:
+            file_handle_pool.release(case_ref_seq_file.ref_seq_file)
+        if control_ref_seq_file is not None and control_ref_seq_file is not case_ref_seq_file:
+            file_handle_pool.release(control_ref_seq_file.ref_seq_file)
+        if genome_mask is not None:
+            genome_mask.close()
+        if control_feature_store is not None:
+            control_feature_store.close()
+
+    return mutational_features
+
+
+def retrieve_cached_mutational_features(mutations_dataframe, case_sample_bam_filename, control_sample_bam_filename,
+                                        ref_seq_filename, site_result_cache_filename, pipeline_profiler=None,
+                                        file_handle_pool=None, sample_site_cache=None, **feature_options):
+    # only the sites missing from the cache are computed; they are added to it in batches as they are done
+    pipeline_profiler = PipelineProfiler.DISABLED if pipeline_profiler is None else pipeline_profiler
+    site_result_cache = SiteResultCache(site_result_cache_filename, case_sample_bam_filename,
+                                        control_sample_bam_filename, ref_seq_filename, feature_options)
+    try:
+        with pipeline_profiler.stage("site_result_cache"):
+            cached_mutational_features = site_result_cache.retrieve(mutations_dataframe)
+        # the cached rows in one frame; the computed ones come in another
+        cached_index = cached_mutational_features.index
+        mutational_features = [cached_mutational_features]
+        missing_mutations_dataframe = mutations_dataframe[~mutations_dataframe.index.isin(cached_index)]
+        if len(missing_mutations_dataframe) > 0:
+            missing_mutational_features = retrieve_mutational_features(missing_mutations_dataframe,
+                                                                       case_sample_bam_filename,
+                                                                       control_sample_bam_filename,
+                                                                       ref_seq_filename,
+                                                                       pipeline_profiler=pipeline_profiler,
+                                                                       file_handle_pool=file_handle_pool,
+                                                                       sample_site_cache=sample_site_cache,
+                                                                       site_result_cache=site_result_cache,
+                                                                       **feature_options)
+            mutational_features += [missing_mutational_features]
+    finally:
+        site_result_cache.close()
 
+    return pandas.concat(mutational_features).loc[mutations_dataframe.index] if len(cached_index) > 0 else \
+        mutational_features[-1]
+
+
+def retrieve_pileupcolumn(chrom, start, end, sample_bam_file, pileup_read_filter=None):
+    pileup_read_filter = PileupReadFilter.DEFAULT if pileup_read_filter is None else pileup_read_filter
+    for pileupcolumn in sample_bam_file.pileup(chrom, start, end, truncate=True,
+                                               **pileup_read_filter.retrieve_pileup_options()):
+        # pysam invalidates the column once the iterator moves on, so keep only its reads
+        return PileupSweepEngine.PileupColumnSnapshot(pileupcolumn.pos, None,
+                                                      pileup_read_filter.filter_pileupreads(pileupcolumn.pileups))
+    return PileupSweepEngine.PileupColumnSnapshot(start, None, [])  # no coverage
+
+
+def downsample_pileupcolumn(pileupcolumn, fragment_downsampler, pileup_read_filter):
+    # -> (the site column with only the sampled fragments, pileup_read_filter restricted to them)
+    if pileupcolumn is None:  # no coverage
+        return pileupcolumn, pileup_read_filter
+    pileupreads, sampled_query_names, sampling_fraction = fragment_downsampler.downsample(pileupcolumn.pileups)
+    return PileupSweepEngine.PileupColumnSnapshot(pileupcolumn.pos, pileupcolumn.ref_allele, pileupreads,
+                                                  sampling_fraction=sampling_fraction), \
+        pileup_read_filter.restrict(sampled_query_names)
+
+
+def retrieve_sampling_fraction(pileupcolumn, fragment_downsampler):
+    # reported only when downsampling
+    if fragment_downsampler is None:
+        return None
+    return pileupcolumn.sampling_fraction if pileupcolumn is not None else 1.0
+
+
+def retrieve_sample_pipeline_profilers(pipeline_profiler, prefetch_sites=None):
+    # -> the profilers the case and the control sites are read with: pipeline_profiler itself, or one per thread when
+    # they are prefetched, merged into it by prefetch_sample_sites
+    if not prefetch_sites:
+        return pipeline_profiler, pipeline_profiler
+    return pipeline_profiler.create_thread_profiler(), pipeline_profiler.create_thread_profiler()
+
+
+def prefetch_sample_sites(sample_sites, prefetch_sites=None, pipeline_profiler=None, sample_pipeline_profiler=None):
+    # -> sample_sites, read ahead in a thread of their own when prefetch_sites (sites held ahead at most) is set;
+    # the stages sample_sites records into sample_pipeline_profiler are then merged into pipeline_profiler
+    if not prefetch_sites:
+        return sample_sites
+    return SitePrefetcher(sample_sites, prefetch_sites, pipeline_profiler, sample_pipeline_profiler)
+
+
+def retrieve_locus_mutations(mutations_dataframe):
+    # -> {(chrom, zero based start, end): {(ref allele, alt allele): [index, ...]}}, loci and alleles in the order they
+    # first appear; each locus is read once per bam and the tables of each of its alleles are made once, whatever the
+    # number of rows (callers, input MAFs) repeating them
+    locus_mutations = OrderedDict()
     for index, mutation_row in mutations_dataframe.iterrows():
-        chrom = str(mutation_row["Chromosome"])
-        start = mutation_row["Start_position"] - 1  # subtracted to account for zero based indexing when using pysam
-        end = mutation_row["End_position"]
+        locus = (str(mutation_row["Chromosome"]), int(mutation_row["Start_position"]) - 1,
+                 int(mutation_row["End_position"]))
+        locus_mutations.setdefault(locus, OrderedDict())
+        locus_mutations[locus].setdefault((mutation_row["Reference_Allele"], mutation_row["Tumor_Seq_Allele2"]), [])
+        locus_mutations[locus][(mutation_row["Reference_Allele"], mutation_row["Tumor_Seq_Allele2"])] += [index]
+    return locus_mutations
+
 
-        ref_allele = mutation_row["Reference_Allele"]
-        alt_allele = mutation_row["Tumor_Seq_Allele2"]
+def retrieve_sample_sites(loci, sample_bam_file, ref_seq_file, pileupcolumn_knapsack_class, genome_mask=None,
+                          pileup_read_filter=None, fragment_downsampler=None, pipeline_profiler=None,
+                          stored_sample=None, cached_sample=None):
+    # yields (site pileupcolumn, pileupcolumn knapsack) of one sample for every (chrom, start, end) locus, in order;
+    # the sites stored_sample (see ControlFeatureStore) or cached_sample (see SampleSiteCache) holds are read from it
+    pipeline_profiler = PipelineProfiler.DISABLED if pipeline_profiler is None else pipeline_profiler
+    for chrom, start, end in loci:
+        if stored_sample is not None:
+            with pipeline_profiler.stage("control_feature_store"):
+                stored_site = stored_sample.retrieve(chrom, start)
+            if stored_site is not None:
+                yield stored_site
+                continue
+        if cached_sample is not None:
+            with pipeline_profiler.stage("sample_site_cache"):
+                cached_site = cached_sample.retrieve(chrom, start)
+            if cached_site is not None:
+                yield cached_site
+                continue
 
-        # Gather data for cases
-        case_pileupcolumn_knapsack = PileupColumnKnapsack.create(chrom, start, end, case_sample_bam_file, ref_seq_file)
-        case_pileupcolumn_mask = PileupColumnMask.create(case_pileupcolumn_knapsack)
+        with pipeline_profiler.stage("reference_fetch"):
+            ref_seq_file.prefetch(chrom, start, end)
+        with pipeline_profiler.stage("site_pileupcolumn"):
+            pileupcolumn = retrieve_pileupcolumn(chrom, start, end, sample_bam_file, pileup_read_filter)
 
-        # Gather data for controls
-        control_pileupcolumn_knapsack = PileupColumnKnapsack.create(chrom, start, end, control_sample_bam_file,
-                                                                    ref_seq_file)
-        control_pileupcolumn_mask = PileupColumnMask.create(control_pileupcolumn_knapsack)
+        # the knapsack only keeps the fragments sampled at the site
+        sample_pileup_read_filter = pileup_read_filter
+        if fragment_downsampler is not None:
+            with pipeline_profiler.stage("downsample"):
+                pileupcolumn, sample_pileup_read_filter = \
+                    downsample_pileupcolumn(pileupcolumn, fragment_downsampler, pileup_read_filter)
 
+        with pipeline_profiler.stage("knapsack_create"):
+            pileupcolumn_knapsack = pileupcolumn_knapsack_class.create(chrom, start, end, sample_bam_file,
+                                                                       ref_seq_file, genome_mask=genome_mask,
+                                                                       pileup_read_filter=sample_pileup_read_filter)
+        if cached_sample is not None:
+            cached_sample.insert(chrom, start, (pileupcolumn, pileupcolumn_knapsack))
+        yield pileupcolumn, pileupcolumn_knapsack
+
+
+def retrieve_fetched_sample_sites(loci, read_fetch_engine, ref_seq_file, pipeline_profiler=None, stored_sample=None,
+                                  is_prefetched=False, cached_sample=None):
+    # retrieve_sample_sites with one fetch() per site, no pileup; knapsacks read for another thread or kept for
+    # another pair are detached from ref_seq_file, which only this one may use
+    pipeline_profiler = PipelineProfiler.DISABLED if pipeline_profiler is None else pipeline_profiler
+    for chrom, start, _ in loci:
+        if stored_sample is not None:
+            with pipeline_profiler.stage("control_feature_store"):
+                stored_site = stored_sample.retrieve(chrom, start)
+            if stored_site is not None:
+                yield stored_site
+                continue
+        if cached_sample is not None:
+            with pipeline_profiler.stage("sample_site_cache"):
+                cached_site = cached_sample.retrieve(chrom, start)
+            if cached_site is not None:
+                yield cached_site
+                continue
+
+        with pipeline_profiler.stage("reference_fetch"):
+            ref_seq_file.prefetch(chrom, start, start+1)
+        with pipeline_profiler.stage("read_fetch"):
+            pileupcolumn, pileupcolumn_knapsack = read_fetch_engine.retrieve(chrom, start)
+            is_cached = cached_sample is not None and cached_sample.is_planned(chrom, start)
+            if is_prefetched or is_cached:
+                pileupcolumn_knapsack.detach()
+        if is_cached:
+            cached_sample.insert(chrom, start, (pileupcolumn, pileupcolumn_knapsack))
+        yield pileupcolumn, pileupcolumn_knapsack
+
+
+def insert_locus_features(mutational_feature_table, allele_mutations, case_pileupcolumn, case_pileupcolumn_knapsack,
+                          control_pileupcolumn, control_pileupcolumn_knapsack, pipeline_profiler=None,
+                          fragment_downsampler=None):
+    # allele_mutations: {(ref allele, alt allele): [index, ...]} of the locus; one mask for all of them
+    pipeline_profiler = PipelineProfiler.DISABLED if pipeline_profiler is None else pipeline_profiler
+    with pipeline_profiler.stage("mask_create"):
         # Determine what positions to mask
         pileupcolumn_names_mask = \
-            BasePairUtils.intersect_pileupcolumn_masks(case_pileupcolumn_mask, control_pileupcolumn_mask)
-
-        for pileupcolumn in case_sample_bam_file.pileup(chrom, start, end, truncate=True):
-            case_data_table = ArtifactAnalysisTable.create(ref_allele, alt_allele, pileupcolumn,
-                                                           case_pileupcolumn_knapsack, pileupcolumn_names_mask)
-
-            case_contingency_table = ArtifactAnalysisTableUtils.render_contingency_table(dataTable=case_data_table)
-            _, two_sided_pvalue = scipy.stats.fisher_exact(case_contingency_table, alternative="two-sided")
-            _, greater_pvalue = scipy.stats.fisher_exact(case_contingency_table, alternative="greater")
-
-            soft_clipped_case_contingency_table = \
-                ArtifactAnalysisTableUtils.render_soft_clipped_contingency_table(dataTable=case_data_table)
-            _, two_sided_soft_clipped_pvalue = \
-                scipy.stats.fisher_exact(soft_clipped_case_contingency_table, alternative="two-sided")
-            _, greater_soft_clipped_pvalue = \
-                scipy.stats.fisher_exact(soft_clipped_case_contingency_table, alternative="greater")
-            break
-
-        for pileupcolumn in control_sample_bam_file.pileup(chrom, start, end, truncate=True):
-            control_data_table = ArtifactAnalysisTable.create(ref_allele, alt_allele, pileupcolumn,
-                                                              control_pileupcolumn_knapsack, pileupcolumn_names_mask)
-            control_contingency_table = \
-                ArtifactAnalysisTableUtils.render_contingency_table(dataTable=control_data_table)
-            _, two_sided_pvalue = scipy.stats.fisher_exact(control_contingency_table, alternative="two-sided")
-            _, greater_pvalue = scipy.stats.fisher_exact(control_contingency_table, alternative="greater")
-
-            soft_clipped_control_contingency_table = \
-                ArtifactAnalysisTableUtils.render_soft_clipped_contingency_table(dataTable=control_data_table)
-            _, two_sided_soft_clipped_pvalue = \
-                scipy.stats.fisher_exact(soft_clipped_control_contingency_table, alternative="two-sided")
-            _, greater_soft_clipped_pvalue = \
-                scipy.stats.fisher_exact(soft_clipped_control_contingency_table, alternative="greater")
-            break
-
-
-    case_sample_bam_file.close()
-    control_sample_bam_file.close()
-    ref_seq_file.close()
+            BasePairUtils.intersect_pileupcolumn_masks(PileupColumnMask.create(case_pileupcolumn_knapsack),
+                                                       PileupColumnMask.create(control_pileupcolumn_knapsack))
+
+    for (ref_allele, alt_allele), indices in allele_mutations.items():
+        insert_features(mutational_feature_table, indices, ref_allele, alt_allele, case_pileupcolumn,
+                        case_pileupcolumn_knapsack, pileupcolumn_names_mask, prefix="case_",
+                        pipeline_profiler=pipeline_profiler,
+                        sampling_fraction=retrieve_sampling_fraction(case_pileupcolumn, fragment_downsampler))
+        insert_features(mutational_feature_table, indices, ref_allele, alt_allele, control_pileupcolumn,
+                        control_pileupcolumn_knapsack, pileupcolumn_names_mask, prefix="control_",
+                        pipeline_profiler=pipeline_profiler,
+                        sampling_fraction=retrieve_sampling_fraction(control_pileupcolumn, fragment_downsampler))
+
+
+def insert_site_results(site_result_cache, mutations_dataframe, mutational_feature_table, indices,
+                        pipeline_profiler=None):
+    # adds the features of the rows of indices, whose sites are all done, to the site result cache
+    pipeline_profiler = PipelineProfiler.DISABLED if pipeline_profiler is None else pipeline_profiler
+    with pipeline_profiler.stage("fisher_exact_test"):
+        mutational_feature_table.test(indices)
+    with pipeline_profiler.stage("row_assembly"):
+        mutational_features = mutational_feature_table.retrieve_dataframe(indices)
+    with pipeline_profiler.stage("site_result_cache"):
+        site_result_cache.insert(mutations_dataframe.loc[indices], mutational_features)
+
+
+def retrieve_paired_mutational_features(mutations_dataframe, locus_mutations, case_sites, control_sites,
+                                        fisher_exact_test=None, pipeline_profiler=None, fragment_downsampler=None,
+                                        prefetch_sites=None, site_result_cache=None, sample_pipeline_profilers=None):
+    # case_sites and control_sites: (site pileupcolumn, pileupcolumn knapsack) for every locus of locus_mutations (see
+    # retrieve_locus_mutations), in order, as retrieve_sample_sites yields them; read ahead in threads with
+    # prefetch_sites, recording into sample_pipeline_profilers (see retrieve_sample_pipeline_profilers). With
+    # site_result_cache, the done rows are added to it every SiteResultCache.INSERT_LOCUS_COUNT loci
+    pipeline_profiler = PipelineProfiler.DISABLED if pipeline_profiler is None else pipeline_profiler
+    sample_pipeline_profilers = (None, None) if sample_pipeline_profilers is None else sample_pipeline_profilers
+    case_sites = prefetch_sample_sites(case_sites, prefetch_sites, pipeline_profiler, sample_pipeline_profilers[0])
+    control_sites = prefetch_sample_sites(control_sites, prefetch_sites, pipeline_profiler,
+                                          sample_pipeline_profilers[1])
+
+    mutational_feature_table = MutationalFeatureTable(mutations_dataframe.index,
+                                                      has_sampling_fraction=fragment_downsampler is not None,
+                                                      fisher_exact_test=fisher_exact_test)
+    done_indices = []  # rows not yet added to site_result_cache
+    try:
+        for locus_position, ((chrom, start, _), allele_mutations) in enumerate(locus_mutations.items()):
+            site_start_time = time.time()
+            case_pileupcolumn, case_pileupcolumn_knapsack = next(case_sites)
+            control_pileupcolumn, control_pileupcolumn_knapsack = next(control_sites)
+            insert_locus_features(mutational_feature_table, allele_mutations, case_pileupcolumn,
+                                  case_pileupcolumn_knapsack, control_pileupcolumn, control_pileupcolumn_knapsack,
+                                  pipeline_profiler, fragment_downsampler)
+            pipeline_profiler.record_site(chrom, start, time.time() - site_start_time,
+                                          [case_pileupcolumn_knapsack, control_pileupcolumn_knapsack])
+            if site_result_cache is not None:
+                done_indices += [index for indices in allele_mutations.values() for index in indices]
+                if (locus_position + 1) % SiteResultCache.INSERT_LOCUS_COUNT == 0:
+                    insert_site_results(site_result_cache, mutations_dataframe, mutational_feature_table,
+                                        done_indices, pipeline_profiler)
+                    done_indices = []
+    finally:
+        case_sites.close()
+        control_sites.close()
+    if done_indices:
+        insert_site_results(site_result_cache, mutations_dataframe, mutational_feature_table, done_indices,
+                            pipeline_profiler)
+
+    with pipeline_profiler.stage("fisher_exact_test"):
+        mutational_feature_table.test()
+    with pipeline_profiler.stage("row_assembly"):
+        return mutational_feature_table.retrieve_dataframe()
+
+
+def retrieve_fetched_mutational_features(mutations_dataframe, case_sample_bam_file, control_sample_bam_file,
+                                         ref_seq_file, fisher_exact_test=None, pipeline_profiler=None,
+                                         genome_mask=None, pileup_read_filter=None, fragment_downsampler=None,
+                                         stored_control_sample=None, control_ref_seq_file=None,
+                                         prefetch_sites=None, cached_case_sample=None, cached_control_sample=None,
+                                         site_result_cache=None):
+    # one fetch() per locus and bam, no pileup; none for the control at the sites stored_control_sample holds
+    pipeline_profiler = PipelineProfiler.DISABLED if pipeline_profiler is None else pipeline_profiler
+    control_ref_seq_file = ref_seq_file if control_ref_seq_file is None else control_ref_seq_file
+    case_read_fetch_engine = ReadFetchEngine(case_sample_bam_file, ref_seq_file, genome_mask, pileup_read_filter,
+                                             fragment_downsampler)
+    control_read_fetch_engine = ReadFetchEngine(control_sample_bam_file, control_ref_seq_file, genome_mask,
+                                                pileup_read_filter, fragment_downsampler)
+
+    locus_mutations = retrieve_locus_mutations(mutations_dataframe)
+    sample_pipeline_profilers = retrieve_sample_pipeline_profilers(pipeline_profiler, prefetch_sites)
+    case_sites = retrieve_fetched_sample_sites(list(locus_mutations.keys()), case_read_fetch_engine, ref_seq_file,
+                                               sample_pipeline_profilers[0], is_prefetched=bool(prefetch_sites),
+                                               cached_sample=cached_case_sample)
+    control_sites = retrieve_fetched_sample_sites(list(locus_mutations.keys()), control_read_fetch_engine,
+                                                  control_ref_seq_file, sample_pipeline_profilers[1],
+                                                  stored_control_sample, bool(prefetch_sites), cached_control_sample)
+    return retrieve_paired_mutational_features(mutations_dataframe, locus_mutations, case_sites, control_sites,
+                                               fisher_exact_test, pipeline_profiler, fragment_downsampler,
+                                               prefetch_sites, site_result_cache, sample_pipeline_profilers)
+
+
+def retrieve_swept_sample_sites(sweep_engine, chrom, site_positions, pipeline_profiler=None, stored_sample=None,
+                                cached_sample=None, sweep_pipeline_profiler=None):
+    # -> ({site position: (site pileupcolumn, pileupcolumn knapsack)} of the positions stored_sample or cached_sample
+    # holds, iterator of (site position, site pileupcolumn, pileupcolumn knapsack) sweeping the others in order, each
+    # sweep step timed in sweep_pipeline_profiler, e.g. that of the thread prefetching them)
+    pipeline_profiler = PipelineProfiler.DISABLED if pipeline_profiler is None else pipeline_profiler
+    sweep_pipeline_profiler = PipelineProfiler.DISABLED if sweep_pipeline_profiler is None else \
+        sweep_pipeline_profiler
+    held_sites = {}
+    if stored_sample is not None:
+        with pipeline_profiler.stage("control_feature_store"):
+            held_sites = dict([(site_position, stored_sample.retrieve(chrom, site_position))
+                               for site_position in site_positions])
+    if cached_sample is not None:
+        with pipeline_profiler.stage("sample_site_cache"):
+            for site_position in site_positions:
+                if held_sites.get(site_position) is None:
+                    held_sites[site_position] = cached_sample.retrieve(chrom, site_position)
+    held_sites = dict([(site_position, site) for site_position, site in held_sites.items() if site is not None])
+    swept_site_positions = [site_position for site_position in site_positions if site_position not in held_sites]
+
+    def retrieve_sites():
+        swept_sites = sweep_engine.retrieve(chrom, swept_site_positions)
+        while True:
+            with sweep_pipeline_profiler.stage("sweep"):
+                swept_site = next(swept_sites, None)
+            if swept_site is None:
+                return
+            site_position, pileupcolumn, pileupcolumn_knapsack = swept_site
+            if cached_sample is not None:
+                cached_sample.insert(chrom, site_position, (pileupcolumn, pileupcolumn_knapsack))
+            yield site_position, pileupcolumn, pileupcolumn_knapsack
+    return held_sites, retrieve_sites()
+
+
+def retrieve_swept_mutational_features(mutations_dataframe, case_sample_bam_file, control_sample_bam_file,
+                                       ref_seq_file, sweep_merge_distance=None, columnar=False,
+                                       fisher_exact_test=None, pipeline_profiler=None, genome_mask=None,
+                                       pileup_read_filter=None, fragment_downsampler=None,
+                                       stored_control_sample=None, control_ref_seq_file=None, prefetch_sites=None,
+                                       cached_case_sample=None, cached_control_sample=None,
+                                       site_result_cache=None):
+    # one forward pileup per merged window per bam; sites are handed out in coordinate order. The control is only
+    # swept for the sites stored_control_sample does not hold, and neither bam for the sites its cached sample holds.
+    # With prefetch_sites, each bam is swept ahead in a thread of its own; with site_result_cache, the done rows are
+    # added to it every SiteResultCache.INSERT_LOCUS_COUNT loci
+    pipeline_profiler = PipelineProfiler.DISABLED if pipeline_profiler is None else pipeline_profiler
+    control_ref_seq_file = ref_seq_file if control_ref_seq_file is None else control_ref_seq_file
+    case_sweep_engine = PileupSweepEngine(case_sample_bam_file, ref_seq_file, sweep_merge_distance, columnar,
+                                          genome_mask, pileup_read_filter, fragment_downsampler)
+    control_sweep_engine = PileupSweepEngine(control_sample_bam_file, control_ref_seq_file, sweep_merge_distance,
+                                             columnar, genome_mask, pileup_read_filter, fragment_downsampler)
+
+    mutational_feature_table = MutationalFeatureTable(mutations_dataframe.index,
+                                                      has_sampling_fraction=fragment_downsampler is not None,
+                                                      fisher_exact_test=fisher_exact_test)
+    chrom_locus_mutations = OrderedDict()  # chrom -> {site position: {(ref allele, alt allele): [index, ...]}}
+    for (chrom, start, _), allele_mutations in retrieve_locus_mutations(mutations_dataframe).items():
+        chrom_locus_mutations.setdefault(chrom, {})
+        chrom_locus_mutations[chrom].setdefault(start, OrderedDict())
+        for alleles, indices in allele_mutations.items():
+            chrom_locus_mutations[chrom][start].setdefault(alleles, [])
+            chrom_locus_mutations[chrom][start][alleles] += indices
+
+    done_indices = []  # rows not yet added to site_result_cache
+    done_locus_count = 0
+    for chrom in sorted(chrom_locus_mutations.keys()):
+        site_mutations = chrom_locus_mutations[chrom]
+        site_positions = sorted(site_mutations.keys())
+        # prefetched sites are swept, and timed, in their threads, and waited for here
+        sample_pipeline_profilers = retrieve_sample_pipeline_profilers(pipeline_profiler, prefetch_sites) \
+            if prefetch_sites else (None, None)
+        held_case_sites, case_sites = retrieve_swept_sample_sites(case_sweep_engine, chrom, site_positions,
+                                                                  pipeline_profiler, cached_sample=cached_case_sample,
+                                                                  sweep_pipeline_profiler=sample_pipeline_profilers[0])
+        held_control_sites, control_sites = retrieve_swept_sample_sites(control_sweep_engine, chrom, site_positions,
+                                                                        pipeline_profiler, stored_control_sample,
+                                                                        cached_control_sample,
+                                                                        sample_pipeline_profilers[1])
+        case_sites = prefetch_sample_sites(case_sites, prefetch_sites, pipeline_profiler, sample_pipeline_profilers[0])
+        control_sites = prefetch_sample_sites(control_sites, prefetch_sites, pipeline_profiler,
+                                              sample_pipeline_profilers[1])
+        sweep_pipeline_profiler = PipelineProfiler.DISABLED if prefetch_sites else pipeline_profiler
+        try:
+            for site_position in site_positions:  # each engine yields exactly one site per position it is given
+                site_start_time = time.time()
+                with sweep_pipeline_profiler.stage("sweep"):
+                    if site_position in held_case_sites:
+                        case_pileupcolumn, case_pileupcolumn_knapsack = held_case_sites.pop(site_position)
+                    else:
+                        _, case_pileupcolumn, case_pileupcolumn_knapsack = next(case_sites)
+                    if site_position in held_control_sites:
+                        control_pileupcolumn, control_pileupcolumn_knapsack = held_control_sites.pop(site_position)
+                    else:
+                        _, control_pileupcolumn, control_pileupcolumn_knapsack = next(control_sites)
+
+                insert_locus_features(mutational_feature_table, site_mutations[site_position], case_pileupcolumn,
+                                      case_pileupcolumn_knapsack, control_pileupcolumn,
+                                      control_pileupcolumn_knapsack, pipeline_profiler, fragment_downsampler)
+                pipeline_profiler.record_site(chrom, site_position, time.time() - site_start_time,
+                                              [case_pileupcolumn_knapsack, control_pileupcolumn_knapsack])
+                if site_result_cache is not None:
+                    done_indices += [index for indices in site_mutations[site_position].values()
+                                     for index in indices]
+                    done_locus_count += 1
+                    if done_locus_count % SiteResultCache.INSERT_LOCUS_COUNT == 0:
+                        insert_site_results(site_result_cache, mutations_dataframe, mutational_feature_table,
+                                            done_indices, pipeline_profiler)
+                        done_indices = []
+        finally:
+            case_sites.close()
+            control_sites.close()
+    if done_indices:
+        insert_site_results(site_result_cache, mutations_dataframe, mutational_feature_table, done_indices,
+                            pipeline_profiler)
+
+    with pipeline_profiler.stage("fisher_exact_test"):
+        mutational_feature_table.test()
+    with pipeline_profiler.stage("row_assembly"):
+        return mutational_feature_table.retrieve_dataframe()
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    # FFPEAritfactFinder.py [scatter|gather] [options]; without a subcommand, runs the mutations as before
+    if len(sys.argv) > 1 and sys.argv[1] == "scatter":
+        scatter(sys.argv[2:])
+    elif len(sys.argv) > 1 and sys.argv[1] == "gather":
+        gather(sys.argv[2:])
+    else:
+        main()
@@ -0,0 +1,140 @@
+import os
+import numpy
+import pandas
+from MutationalFeatureTable import MutationalFeatureTable
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:  # only needed for the feature table output
+    pyarrow = None
+
+
+class FeatureTableWriter(object):
+
+    # Writes the annotated mutations as a compressed Parquet file or Arrow IPC file, one row group (record batch)
+    # per pair, so that rows are on disk while later pairs are still being computed; the groups of rows written for
+    # one pair (e.g. the chunks of a streamed MAF) are merged, up to max_row_group_row_count rows. The features are
+    # typed (counts as int64, the rest as float64), positions as int64 and the contig as a dictionary (categorical)
+    # column over the reference's contigs; every other MAF column is written as text, as it reads in the MAF. The
+    # columns of the first written pair fix the schema for the whole file.
+    PARQUET_FORMAT = "parquet"
+    ARROW_FORMAT = "arrow"
+    FORMATS = [PARQUET_FORMAT, ARROW_FORMAT]
+    ARROW_EXTENSIONS = [".arrow", ".feather", ".ipc"]
+    DEFAULT_COMPRESSION = "zstd"
+    DEFAULT_MAX_ROW_GROUP_ROW_COUNT = 1 << 17
+    CONTIG_COLUMN = "Chromosome"
+    POSITION_COLUMNS = ["Start_position", "End_position"]
+
+    def __init__(self, feature_table_filename, contigs, feature_table_format=None, compression=None,
+                 max_row_group_row_count=None):
+        # contigs: the reference's, in its order; feature_table_format defaults to the one the extension names
+        if pyarrow is None:
+            raise ImportError("Writing %s needs pyarrow." % feature_table_filename)
+        self._feature_table_filename = feature_table_filename
+        self._contigs = list(contigs)
+        self._contig_indices = dict([(contig, contig_index) for contig_index, contig in enumerate(self._contigs)])
+        self._feature_table_format = FeatureTableWriter.retrieve_format(feature_table_filename) \
+            if feature_table_format is None else feature_table_format
+        if self._feature_table_format not in FeatureTableWriter.FORMATS:
+            raise ValueError("%s is not a feature table format." % self._feature_table_format)
+        self._compression = FeatureTableWriter.DEFAULT_COMPRESSION if compression is None else compression
+        self._max_row_group_row_count = FeatureTableWriter.DEFAULT_MAX_ROW_GROUP_ROW_COUNT \
+            if max_row_group_row_count is None else max_row_group_row_count
+        self._schema = None
+        self._writer = None
+        self._row_count = 0
+        # the tables of the pair's row group not yet written
+        self._pair_key = None
+        self._pair_tables = []
+        self._pair_row_count = 0
+
+    @property
+    def feature_table_format(self):
+        return self._feature_table_format
+
+    @property
+    def row_count(self):
+        return self._row_count
+
+    @staticmethod
+    def is_available():
+        return pyarrow is not None
+
+    @staticmethod
+    def retrieve_format(feature_table_filename):
+        if os.path.splitext(feature_table_filename)[1].lower() in FeatureTableWriter.ARROW_EXTENSIONS:
+            return FeatureTableWriter.ARROW_FORMAT
+        return FeatureTableWriter.PARQUET_FORMAT
+
+    @staticmethod
+    def retrieve_type(column_name):
+        if column_name == FeatureTableWriter.CONTIG_COLUMN:
+            return pyarrow.dictionary(pyarrow.int32(), pyarrow.string())
+        if column_name in FeatureTableWriter.POSITION_COLUMNS or MutationalFeatureTable.is_count_feature(column_name):
+            return pyarrow.int64()
+        if MutationalFeatureTable.is_feature(column_name):
+            return pyarrow.float64()
+        return pyarrow.string()
+
+    def _retrieve_array(self, column, arrow_type):
+        if pyarrow.types.is_dictionary(arrow_type):
+            # indices into the reference's contigs, so that every row group shares one dictionary
+            contig_indices = [self._contig_indices.get(str(contig)) for contig in column]
+            return pyarrow.DictionaryArray.from_arrays(pyarrow.array(contig_indices, type=pyarrow.int32()),
+                                                       pyarrow.array(self._contigs, type=pyarrow.string()))
+        if pyarrow.types.is_string(arrow_type):
+            return pyarrow.array([None if pandas.isnull(value) else str(value) for value in column],
+                                 type=arrow_type)
+        # the features come as float64; whole numbers cast safely, a missing value becomes null
+        return pyarrow.array(numpy.asarray(column, dtype=numpy.float64), from_pandas=True).cast(arrow_type)
+
+    def _create_writer(self):
+        if self._feature_table_format == FeatureTableWriter.PARQUET_FORMAT:
+            return pyarrow.parquet.ParquetWriter(self._feature_table_filename, self._schema,
+                                                 compression=self._compression)
+        return pyarrow.ipc.new_file(self._feature_table_filename, self._schema,
+                                    options=pyarrow.ipc.IpcWriteOptions(compression=self._compression))
+
+    def _write_row_group(self):
+        if not self._pair_tables:
+            return
+        # one chunk per column, so a single row group (record batch)
+        table = pyarrow.concat_tables(self._pair_tables).combine_chunks()
+        if self._feature_table_format == FeatureTableWriter.PARQUET_FORMAT:
+            self._writer.write_table(table, row_group_size=len(table))
+        else:
+            self._writer.write_table(table)
+        self._pair_tables = []
+        self._pair_row_count = 0
+
+    def write(self, mutation_group, pair_key=None):
+        # mutation_group: annotated mutations, as written to the output MAF; consecutive groups of the same pair_key
+        # share a row group, a group without one gets its own
+        if len(mutation_group) == 0:
+            return
+        if pair_key is None or pair_key != self._pair_key:
+            self._write_row_group()
+        if self._schema is None:
+            self._schema = pyarrow.schema([(str(column_name),
+                                            FeatureTableWriter.retrieve_type(str(column_name)))
+                                           for column_name in mutation_group.columns])
+            self._writer = self._create_writer()
+        arrays = []
+        for field in self._schema:
+            column = mutation_group[field.name] if field.name in mutation_group.columns else \
+                pandas.Series([None] * len(mutation_group), dtype=object)
+            arrays += [self._retrieve_array(column.values, field.type)]
+        self._pair_key = pair_key
+        self._pair_tables += [pyarrow.Table.from_arrays(arrays, schema=self._schema)]
+        self._pair_row_count += len(mutation_group)
+        self._row_count += len(mutation_group)
+        if pair_key is None or self._pair_row_count >= self._max_row_group_row_count:
+            self._write_row_group()
+
+    def close(self):
+        # no file is written when no pair had any rows
+        if self._writer is not None:
+            self._write_row_group()
+            self._writer.close()
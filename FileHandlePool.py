@@ -0,0 +1,95 @@
+import itertools
+import os
+from collections import OrderedDict
+from pysam import FastaFile
+from PackedReferenceGenome import PackedReferenceGenome
+
+
+class FileHandlePool(object):
+
+    # Keeps the bams, crams and references a process is done with open, keyed by path (and how they were opened), so
+    # that the next pair reading the same file reuses the handle and its loaded index instead of opening it again. A
+    # handle is lent to one user at a time (case and control may be the same bam); at most max_open_files handles,
+    # lent or idle, stay open and the least recently released idle ones are closed first. With max_open_files 0 every
+    # handle is closed as soon as it is released.
+    DEFAULT_MAX_OPEN_FILES = 16
+
+    def __init__(self, max_open_files=None):
+        self._max_open_files = FileHandlePool.DEFAULT_MAX_OPEN_FILES if max_open_files is None else max_open_files
+        self._idle_handles = OrderedDict()  # token -> (key, handle), least recently released first
+        self._idle_tokens = {}  # key -> [token, ...]
+        # handle -> key; keyed by the handle itself (hashed by identity), which it keeps alive until it is released,
+        # so that a collected handle's id can never be mistaken for a new one's
+        self._lent_keys = {}
+        self._tokens = itertools.count()
+        self._hit_count = 0
+        self._miss_count = 0
+        self._eviction_count = 0
+
+    @property
+    def max_open_files(self):
+        return self._max_open_files
+
+    @property
+    def hit_count(self):
+        return self._hit_count
+
+    @property
+    def miss_count(self):
+        return self._miss_count
+
+    @property
+    def eviction_count(self):
+        return self._eviction_count
+
+    @property
+    def open_file_count(self):
+        return len(self._idle_handles) + len(self._lent_keys)
+
+    def retrieve_counts(self):
+        return dict(hits=self._hit_count, misses=self._miss_count, evictions=self._eviction_count)
+
+    def acquire_alignment_file(self, alignment_file_opener, sample_bam_filename):
+        # crams decode against the opener's reference, so that is part of the key as well
+        key = ("alignment", os.path.abspath(sample_bam_filename), alignment_file_opener.ref_seq_filename,
+               alignment_file_opener.io_threads, alignment_file_opener.ref_cache_dirname)
+        return self._acquire(key, lambda: alignment_file_opener.open(sample_bam_filename))
+
+    def acquire_ref_seq_file(self, ref_seq_filename, packed_ref_seq_filename=None):
+        if packed_ref_seq_filename is not None:
+            return self._acquire(("packed_ref_seq", os.path.abspath(packed_ref_seq_filename)),
+                                 lambda: PackedReferenceGenome(packed_ref_seq_filename))
+        return self._acquire(("ref_seq", os.path.abspath(ref_seq_filename)), lambda: FastaFile(ref_seq_filename))
+
+    def _acquire(self, key, open_handle):
+        idle_tokens = self._idle_tokens.get(key)
+        if idle_tokens:
+            _, handle = self._idle_handles.pop(idle_tokens.pop())
+            self._hit_count += 1
+        else:
+            handle = open_handle()
+            self._miss_count += 1
+        self._lent_keys[handle] = key
+        return handle
+
+    def release(self, handle):
+        key = self._lent_keys.pop(handle)
+        token = next(self._tokens)
+        self._idle_handles[token] = (key, handle)
+        self._idle_tokens.setdefault(key, [])
+        self._idle_tokens[key] += [token]
+        self._evict()
+
+    def _evict(self):
+        while self._idle_handles and self.open_file_count > self._max_open_files:
+            token, (key, handle) = self._idle_handles.popitem(last=False)
+            self._idle_tokens[key].remove(token)
+            handle.close()
+            self._eviction_count += 1
+
+    def close(self):
+        # closes the idle handles; lent ones stay with their users
+        while self._idle_handles:
+            _, (_, handle) = self._idle_handles.popitem(last=False)
+            handle.close()
+        self._idle_tokens = {}
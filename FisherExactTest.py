@@ -0,0 +1,86 @@
+import numpy
+import scipy.special
+
+
+class FisherExactTest(object):
+
+    # Fisher's exact test of a whole batch of 2x2 tables at once. The batch's distinct tables are found with
+    # numpy.unique, so each is worked out once per batch, and their hypergeometric pmfs are laid end to end in one
+    # array, so that the p-values of all of them come out of a few vectorized reductions.
+    # tables whose probability is within this relative tolerance of the observed one count as equally extreme;
+    # scipy.stats.fisher_exact uses 1e-14, which the log-factorial sums cannot resolve for totals in the thousands
+    RELATIVE_TOLERANCE = 1e-9
+    # pmf values laid end to end at a time; the tables of a larger batch are worked out in parts
+    MAX_SUPPORT_LENGTH = 1 << 22
+
+    def __init__(self):
+        self._log_factorials = numpy.zeros(1)  # log(k!) for k = 0..len-1, grown on demand
+
+    def _retrieve_log_factorials(self, total):
+        if total >= len(self._log_factorials):
+            size = max(total + 1, 2 * len(self._log_factorials))
+            self._log_factorials = scipy.special.gammaln(numpy.arange(size, dtype=numpy.float64) + 1)
+        return self._log_factorials
+
+    def _compute_p_values(self, a, b, c, d):
+        # the top left cells and the margins of tables [[a, b], [c, d]], none of them empty -> (two sided p-values,
+        # greater p-values), as scipy.stats.fisher_exact
+        row1, row2 = a + b, c + d
+        col1 = a + c
+        total = row1 + row2
+        log_factorials = self._retrieve_log_factorials(int(total.max()))
+
+        # hypergeometric pmf of the top left cell over its whole support, table after table
+        low = numpy.maximum(0, col1 - row2)
+        lengths = numpy.minimum(row1, col1) - low + 1
+        offsets = numpy.concatenate([[0], numpy.cumsum(lengths)[:-1]])
+        table_ids = numpy.repeat(numpy.arange(len(a)), lengths)
+        x = numpy.arange(lengths.sum()) - offsets[table_ids] + low[table_ids]
+        log_pmf = (log_factorials[row1] + log_factorials[row2] + log_factorials[col1] +
+                   log_factorials[total - col1] - log_factorials[total])[table_ids] - log_factorials[x] - \
+            log_factorials[row1[table_ids] - x] - log_factorials[col1[table_ids] - x] - \
+            log_factorials[row2[table_ids] - col1[table_ids] + x]
+        pmf = numpy.exp(log_pmf)
+
+        greater_p_values = numpy.minimum(numpy.add.reduceat(numpy.where(x >= a[table_ids], pmf, 0.0), offsets), 1.0)
+
+        p_exact = pmf[offsets + a - low]
+        p_mode = numpy.maximum.reduceat(pmf, offsets)
+        is_mode = numpy.abs(p_exact - p_mode) / numpy.maximum(p_exact, p_mode) <= FisherExactTest.RELATIVE_TOLERANCE
+        two_sided_p_values = numpy.minimum(numpy.add.reduceat(
+            numpy.where(pmf <= (p_exact * (1 + FisherExactTest.RELATIVE_TOLERANCE))[table_ids], pmf, 0.0), offsets),
+            1.0)
+        two_sided_p_values[is_mode] = 1.0
+        return two_sided_p_values, greater_p_values
+
+    def retrieve_p_values(self, contingency_tables):
+        # [2x2 table, ...] (or an (n x 2 x 2) array) -> (array of two sided p-values, array of greater p-values)
+        tables = numpy.asarray(contingency_tables, dtype=numpy.int64).reshape(-1, 4)
+        two_sided_p_values = numpy.ones(len(tables))
+        greater_p_values = numpy.ones(len(tables))
+        if len(tables) == 0:
+            return two_sided_p_values, greater_p_values
+        unique_tables, inverse = numpy.unique(tables, axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        a, b, c, d = [unique_tables[:, column] for column in range(4)]
+        unique_two_sided_p_values = numpy.ones(len(unique_tables))
+        unique_greater_p_values = numpy.ones(len(unique_tables))
+
+        # a table with an empty margin has a single possible top left cell
+        tested = numpy.flatnonzero((a + b > 0) & (c + d > 0) & (a + c > 0) & (b + d > 0))
+        support_ends = numpy.cumsum(numpy.minimum(a + b, a + c)[tested] -
+                                    numpy.maximum(0, a + c - c - d)[tested] + 1)
+        part_start = 0
+        while part_start < len(tested):
+            # as many tables as fit, and at least one
+            part_end = max(int(numpy.searchsorted(support_ends, (support_ends[part_start - 1] if part_start else 0) +
+                                                  FisherExactTest.MAX_SUPPORT_LENGTH, side="right")),
+                           part_start + 1)
+            part = tested[part_start:part_end]
+            unique_two_sided_p_values[part], unique_greater_p_values[part] = \
+                self._compute_p_values(a[part], b[part], c[part], d[part])
+            part_start = part_end
+
+        two_sided_p_values[:] = unique_two_sided_p_values[inverse]
+        greater_p_values[:] = unique_greater_p_values[inverse]
+        return two_sided_p_values, greater_p_values
@@ -0,0 +1,45 @@
+import hashlib
+import heapq
+import struct
+
+
+class FragmentDownsampler(object):
+
+    # Caps the read fragments (query names, so both mates stay together) used at a site. Every fragment gets a
+    # priority from a seeded hash of its query name and the max_depth lowest priorities are kept: a reservoir sample
+    # that does not depend on read order, is the same for every sample and every run with the same seed, and keeps a
+    # fragment at every site where it is sampled.
+    DEFAULT_SEED = 0
+    PRIORITY_FORMAT = ">Q"
+
+    def __init__(self, max_depth, seed=None):
+        if max_depth < 1:
+            raise ValueError("max_depth must be at least 1, not %d." % max_depth)
+        self._max_depth = max_depth
+        self._seed = FragmentDownsampler.DEFAULT_SEED if seed is None else seed
+
+    @property
+    def max_depth(self):
+        return self._max_depth
+
+    @property
+    def seed(self):
+        return self._seed
+
+    def retrieve_fragment_priority(self, query_name):
+        digest = hashlib.md5(("%d:%s" % (self._seed, query_name)).encode("utf-8")).digest()
+        return struct.unpack(FragmentDownsampler.PRIORITY_FORMAT,
+                             digest[:struct.calcsize(FragmentDownsampler.PRIORITY_FORMAT)])[0]
+
+    def downsample(self, pileupreads):
+        # -> (the pileupreads of the sampled fragments, their query names or None when nothing was dropped,
+        # sampled fraction of the fragments)
+        query_names = set([pileupread.alignment.query_name for pileupread in pileupreads])
+        if len(query_names) <= self._max_depth:
+            return pileupreads, None, 1.0
+        # query names break priority ties, since set order changes between runs
+        sampled_query_names = set(heapq.nsmallest(self._max_depth, query_names,
+                                                  key=lambda query_name: (self.retrieve_fragment_priority(query_name),
+                                                                          query_name)))
+        return [pileupread for pileupread in pileupreads if pileupread.alignment.query_name in sampled_query_names], \
+            sampled_query_names, float(self._max_depth) / len(query_names)
@@ -0,0 +1,116 @@
+import json
+import mmap
+import os
+import struct
+import numpy
+from pysam import FastaFile
+
+
+class GenomeMask(object):
+
+    # A genome wide bitset of masked positions (e.g. known germline or problematic sites from a BED), one bit per
+    # base, bit (position & 7) of byte (position >> 3) of the contig. File layout: MAGIC, header length (little
+    # endian uint64), JSON header, then every contig's bytes. The file is memory-mapped read only, so lookups are O(1)
+    # and worker processes share one page-cached copy.
+    MAGIC = b"REBCMASK"
+    HEADER_LENGTH_FORMAT = "<Q"
+
+    def __init__(self, genome_mask_filename):
+        self._genome_mask_filename = genome_mask_filename
+        self._file = open(genome_mask_filename, "rb")
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic_length = len(GenomeMask.MAGIC)
+        if self._mmap[:magic_length] != GenomeMask.MAGIC:
+            self.close()
+            raise ValueError("%s is not a genome mask." % genome_mask_filename)
+        header_length_size = struct.calcsize(GenomeMask.HEADER_LENGTH_FORMAT)
+        header_length, = struct.unpack(GenomeMask.HEADER_LENGTH_FORMAT,
+                                       self._mmap[magic_length:magic_length + header_length_size])
+        header_start = magic_length + header_length_size
+        header = json.loads(self._mmap[header_start:header_start + header_length].decode("ascii"))
+        data_start = header_start + header_length
+
+        self._contigs = dict([(contig["name"], (data_start + contig["offset"], contig["length"]))
+                              for contig in header["contigs"]])
+
+    @property
+    def filename(self):
+        return self._genome_mask_filename
+
+    def is_masked(self, chrom, position):
+        # positions outside the known contigs are not masked
+        contig = self._contigs.get(chrom)
+        if contig is None or not 0 <= position < contig[1]:
+            return False
+        return bool(bytearray(self._mmap[contig[0] + (position >> 3):contig[0] + (position >> 3) + 1])[0] >>
+                    (position & 7) & 1)
+
+    def close(self):
+        self._mmap.close()
+        self._file.close()
+
+    @staticmethod
+    def _insert_interval(packed, start, end):
+        # sets bits [start, end) of a contig's bytes
+        first_byte, last_byte = start >> 3, (end - 1) >> 3
+        first_bits = (0xFF << (start & 7)) & 0xFF
+        last_bits = 0xFF >> (7 - ((end - 1) & 7))
+        if first_byte == last_byte:
+            packed[first_byte] |= first_bits & last_bits
+            return
+        packed[first_byte] |= first_bits
+        packed[first_byte + 1:last_byte] = 0xFF
+        packed[last_byte] |= last_bits
+
+    @staticmethod
+    def create(bed_filename, ref_seq_filename, genome_mask_filename):
+        # contig lengths come from the reference; intervals on contigs it does not know are ignored
+        ref_seq_file = FastaFile(ref_seq_filename)
+        contig_lengths = [(reference, ref_seq_file.get_reference_length(reference))
+                          for reference in ref_seq_file.references]
+        ref_seq_file.close()
+        contig_bitsets = dict([(reference, numpy.zeros((length + 7) >> 3, dtype=numpy.uint8))
+                               for reference, length in contig_lengths])
+        contig_lengths_by_name = dict(contig_lengths)
+
+        with open(bed_filename) as bed_file:
+            for line in bed_file:
+                if not line.strip() or line.startswith(("#", "track", "browser")):
+                    continue
+                fields = line.split("\t") if "\t" in line else line.split()
+                chrom, start, end = fields[0], int(fields[1]), int(fields[2])
+                if chrom not in contig_bitsets:
+                    continue
+                start, end = max(start, 0), min(end, contig_lengths_by_name[chrom])
+                if start < end:
+                    GenomeMask._insert_interval(contig_bitsets[chrom], start, end)
+
+        contigs = []
+        offset = 0
+        for reference, length in contig_lengths:
+            contigs += [dict(name=reference, length=length, offset=offset)]
+            offset += len(contig_bitsets[reference])
+        header = json.dumps(dict(bed_filename=os.path.abspath(bed_filename), contigs=contigs)).encode("ascii")
+
+        # written under a temporary name and renamed so that concurrent readers never see a partial file
+        temporary_filename = "%s.%d.tmp" % (genome_mask_filename, os.getpid())
+        try:
+            with open(temporary_filename, "wb") as genome_mask_file:
+                genome_mask_file.write(GenomeMask.MAGIC)
+                genome_mask_file.write(struct.pack(GenomeMask.HEADER_LENGTH_FORMAT, len(header)))
+                genome_mask_file.write(header)
+                for reference, _ in contig_lengths:
+                    genome_mask_file.write(contig_bitsets[reference].tobytes())
+            os.rename(temporary_filename, genome_mask_filename)
+        finally:
+            if os.path.exists(temporary_filename):
+                os.remove(temporary_filename)
+
+    @staticmethod
+    def retrieve(bed_filename, ref_seq_filename, genome_mask_filename):
+        # (re)builds the mask when it is missing or older than the BED
+        if not os.path.exists(genome_mask_filename) or \
+                os.path.getmtime(genome_mask_filename) < os.path.getmtime(bed_filename):
+            GenomeMask.create(bed_filename, ref_seq_filename, genome_mask_filename)
+        return genome_mask_filename
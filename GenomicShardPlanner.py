@@ -0,0 +1,93 @@
+from pysam import AlignmentFile
+
+
+class GenomicShardPlanner(object):
+
+    # every site pays for its knapsack, tables and tests regardless of coverage
+    SITE_BASE_COST = 1.0
+    # more, smaller shards than workers so that the workers finishing first pick up the remaining shards
+    DEFAULT_SHARDS_PER_WORKER = 4
+
+    def __init__(self, sample_bam_filenames):
+        self._read_densities = GenomicShardPlanner.retrieve_read_densities(sample_bam_filenames)
+
+        # densities are only compared with each other; the average contig scales to one
+        densities = [read_density for read_density in self._read_densities.values() if read_density > 0]
+        self._mean_read_density = sum(densities) / len(densities) if densities else 0.0
+
+    @property
+    def read_densities(self):
+        return self._read_densities
+
+    @staticmethod
+    def retrieve_read_densities(sample_bam_filenames):
+        # contig -> mapped reads per base summed over the bams; only the bam index is read (a cram index has no
+        # read counts, so crams add nothing)
+        read_densities = {}
+        for sample_bam_filename in sample_bam_filenames:
+            sample_bam_file = AlignmentFile(sample_bam_filename, "r")
+            for index_statistic in sample_bam_file.get_index_statistics():
+                contig_length = sample_bam_file.get_reference_length(index_statistic.contig)
+                read_densities[index_statistic.contig] = read_densities.get(index_statistic.contig, 0.0) + \
+                    float(index_statistic.mapped) / max(contig_length, 1)
+            sample_bam_file.close()
+        return read_densities
+
+    def retrieve_site_cost(self, chrom):
+        if self._mean_read_density == 0:
+            return GenomicShardPlanner.SITE_BASE_COST
+        return GenomicShardPlanner.SITE_BASE_COST + self._read_densities.get(chrom, 0.0) / self._mean_read_density
+
+    def retrieve_cost(self, mutations_dataframe):
+        chroms = mutations_dataframe["Chromosome"].astype(str)
+        return sum([self.retrieve_site_cost(chrom) * count for chrom, count in chroms.value_counts().items()])
+
+    def create_shards(self, mutations_dataframe, target_cost):
+        # contigs are cut into sub-regions once a shard reaches target_cost; sites sharing a position stay together
+        genomic_shards = []
+        for chrom, chrom_mutations_dataframe in \
+                mutations_dataframe.groupby(mutations_dataframe["Chromosome"].astype(str)):
+            site_cost = self.retrieve_site_cost(chrom)
+            chrom_mutations_dataframe = chrom_mutations_dataframe.sort_values("Start_position", kind="mergesort")
+
+            genomic_shard = None
+            for index, start in zip(chrom_mutations_dataframe.index, chrom_mutations_dataframe["Start_position"]):
+                if genomic_shard is None or (genomic_shard.cost >= target_cost and start != genomic_shard.end):
+                    genomic_shard = GenomicShardPlanner.GenomicShard(chrom, start)
+                    genomic_shards += [genomic_shard]
+                genomic_shard.insert(index, start, site_cost)
+        return genomic_shards
+
+    class GenomicShard(object):
+
+        def __init__(self, chrom, start):
+            self._chrom = chrom
+            self._start = start
+            self._end = start
+            self._indices = []
+            self._cost = 0.0
+
+        @property
+        def chrom(self):
+            return self._chrom
+
+        @property
+        def start(self):
+            return self._start
+
+        @property
+        def end(self):
+            return self._end
+
+        @property
+        def indices(self):
+            return self._indices
+
+        @property
+        def cost(self):
+            return self._cost
+
+        def insert(self, index, start, site_cost):
+            self._indices += [index]
+            self._end = start
+            self._cost += site_cost
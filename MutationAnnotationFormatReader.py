@@ -0,0 +1,66 @@
+import pandas
+
+
+class MutationAnnotationFormatReader(object):
+
+    # columns the feature extraction and the pair grouping rely on; always parsed
+    REQUIRED_COLUMNS = ["Chromosome", "Start_position", "End_position", "Variant_Classification", "Variant_Type",
+                        "Reference_Allele", "Tumor_Seq_Allele2", "Tumor_Sample_Barcode", "Matched_Norm_Sample_Barcode"]
+    # positions are integers, every other column is kept as text so that chunks never disagree on a column's type
+    # (e.g. Chromosome being int in one chunk and str in the next)
+    POSITION_COLUMNS = ["Start_position", "End_position"]
+    DEFAULT_CHUNK_SIZE = 100000
+
+    def __init__(self, maf_filename, variant_types=None, variant_classifications=None, columns=None, chunk_size=None):
+        # columns: subset of the MAF columns to keep (None keeps all of them)
+        self._maf_filename = maf_filename
+        self._variant_types = None if variant_types is None else set(variant_types)
+        self._variant_classifications = None if variant_classifications is None else set(variant_classifications)
+        self._columns = None if columns is None else \
+            list(columns) + [column for column in MutationAnnotationFormatReader.REQUIRED_COLUMNS
+                             if column not in columns]
+        self._chunk_size = MutationAnnotationFormatReader.DEFAULT_CHUNK_SIZE if chunk_size is None else chunk_size
+
+    @property
+    def columns(self):
+        return self._columns
+
+    @property
+    def chunk_size(self):
+        return self._chunk_size
+
+    def _retrieve_dtypes(self, columns):
+        return dict([(column, "int64" if column in MutationAnnotationFormatReader.POSITION_COLUMNS else str)
+                     for column in columns])
+
+    def _retrieve_columns(self):
+        # the kept columns, in file order
+        columns = pandas.read_csv(self._maf_filename, sep="\t", header=0, comment="#", nrows=0).columns.tolist()
+        if self._columns is not None:
+            columns = [column for column in columns if column in set(self._columns)]
+        return columns
+
+    def _filter(self, mutations_dataframe):
+        if self._variant_types is not None:
+            mutations_dataframe = mutations_dataframe[mutations_dataframe["Variant_Type"].isin(self._variant_types)]
+        if self._variant_classifications is not None:
+            mutations_dataframe = \
+                mutations_dataframe[mutations_dataframe["Variant_Classification"].isin(self._variant_classifications)]
+        return mutations_dataframe
+
+    def read_chunks(self):
+        # yields the filtered rows chunk by chunk, indexed by their row number in the file as read_csv would
+        columns = self._retrieve_columns()
+        for mutations_dataframe in pandas.read_csv(self._maf_filename, sep="\t", header=0, comment="#",
+                                                   usecols=columns, dtype=self._retrieve_dtypes(columns),
+                                                   chunksize=self._chunk_size):
+            mutations_dataframe = self._filter(mutations_dataframe)
+            if len(mutations_dataframe) > 0:
+                yield mutations_dataframe
+
+    def read(self):
+        columns = self._retrieve_columns()
+        mutations_dataframes = list(self.read_chunks())
+        if not mutations_dataframes:
+            return pandas.DataFrame(columns=columns)
+        return pandas.concat(mutations_dataframes)
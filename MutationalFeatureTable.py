@@ -0,0 +1,200 @@
+from collections import OrderedDict
+import numpy
+import pandas
+from ArtifactAnalysisTableUtils import ArtifactAnalysisTableUtils
+from FisherExactTest import FisherExactTest
+
+
+class MutationalFeatureTable(object):
+
+    # The features of one pair's mutations, one preallocated row per mutation and one column per count or p-value
+    # kept, for each sample prefix. Sites fill their rows' counts as they are done, in any order; the contingency
+    # tables of all filled rows are then tested in one FisherExactTest batch (see test()), the expected counts and the
+    # log p-values are worked out for all rows at once and the DataFrame is built a single time. Its columns are
+    # those of ArtifactAnalysisTableUtils.retrieve_table_as_series, then the log p-values (and sampling fraction) of
+    # each prefix in turn.
+    COUNT_NAMES = ["alt_non_ref_pileupread_bp_count", "alt_ref_pileupread_bp_count", "ref_non_ref_pileupread_bp_count",
+                   "ref_ref_pileupread_bp_count", "alt_soft_clipped_pileupread_bp_count",
+                   "ref_soft_clipped_pileupread_bp_count", "alt_overlapping_aligned_segment_count",
+                   "ref_overlapping_aligned_segment_count"]
+    P_VALUE_NAMES = ["two_sided_p_value", "greater_p_value", "soft_clipped_two_sided_p_value",
+                     "soft_clipped_greater_p_value"]
+    SAMPLING_FRACTION_NAME = "sampling_fraction"
+    PREFIXES = ["case_", "control_"]
+    # every prefix' columns, in order; the counts and overlapping segment counts are whole numbers, the rest is not
+    FEATURE_NAMES = ["alt_non_ref_pileupread_bp_count", "alt_ref_pileupread_bp_count",
+                     "expected_alt_non_ref_pileupread_bp_count", "expected_alt_ref_pileupread_bp_count",
+                     "alt_non_ref_soft_clipped_pileupread_bp_count", "alt_ref_soft_clipped_pileupread_bp_count",
+                     "expected_alt_non_ref_soft_clipped_pileupread_bp_count",
+                     "expected_alt_ref_soft_clipped_pileupread_bp_count", "alt_soft_clipped_pileupread_bp_count",
+                     "alt_overlapping_aligned_segment_count", "ref_non_ref_pileupread_bp_count",
+                     "ref_ref_pileupread_bp_count", "expected_ref_non_ref_pileupread_bp_count",
+                     "expected_ref_ref_pileupread_bp_count", "ref_non_ref_soft_clipped_pileupread_bp_count",
+                     "ref_ref_soft_clipped_pileupread_bp_count",
+                     "expected_ref_non_ref_soft_clipped_pileupread_bp_count",
+                     "expected_ref_ref_soft_clipped_pileupread_bp_count", "ref_soft_clipped_pileupread_bp_count",
+                     "ref_overlapping_aligned_segment_count", "log_two_sided_p_value", "log_greater_p_value",
+                     "soft_clipped_log_two_sided_p_value", "soft_clipped_log_greater_p_value",
+                     SAMPLING_FRACTION_NAME]
+
+    def __init__(self, index, prefixes=None, has_sampling_fraction=False, fisher_exact_test=None):
+        self._index = index
+        self._fisher_exact_test = FisherExactTest() if fisher_exact_test is None else fisher_exact_test
+        self._prefixes = MutationalFeatureTable.PREFIXES if prefixes is None else prefixes
+        self._has_sampling_fraction = has_sampling_fraction
+        self._row_positions = dict([(row_index, row_position) for row_position, row_index in enumerate(index)])
+        column_names = MutationalFeatureTable.COUNT_NAMES + MutationalFeatureTable.P_VALUE_NAMES + \
+            [MutationalFeatureTable.SAMPLING_FRACTION_NAME]
+        self._column_positions = dict([(column_name, column_position)
+                                       for column_position, column_name in enumerate(column_names)])
+        # prefix -> (rows x columns); rows no site filled stay nan
+        self._values = dict([(prefix, numpy.full((len(index), len(column_names)), numpy.nan))
+                             for prefix in self._prefixes])
+        # prefix -> whether the row's counts are in and its p-values not yet
+        self._is_untested = dict([(prefix, numpy.zeros(len(index), dtype=bool)) for prefix in self._prefixes])
+
+    @property
+    def index(self):
+        return self._index
+
+    def _retrieve_row_positions(self, row_indices=None):
+        if row_indices is None:
+            return numpy.arange(len(self._index))
+        return numpy.array([self._row_positions[row_index] for row_index in row_indices], dtype=numpy.int64)
+
+    def insert(self, row_indices, prefix, data_table, sampling_fraction=None):
+        # the same counts in every row of row_indices; the p-values follow in test()
+        row_positions = self._retrieve_row_positions(row_indices)
+        self._values[prefix][row_positions] = \
+            [data_table.alt_non_ref_pileupread_bp_count, data_table.alt_ref_pileupread_bp_count,
+             data_table.ref_non_ref_pileupread_bp_count, data_table.ref_ref_pileupread_bp_count,
+             data_table.alt_soft_clipped_pileupread_bp_count, data_table.ref_soft_clipped_pileupread_bp_count,
+             data_table.alt_overlapping_aligned_segment_count, data_table.ref_overlapping_aligned_segment_count,
+             numpy.nan, numpy.nan, numpy.nan, numpy.nan,
+             numpy.nan if sampling_fraction is None else sampling_fraction]
+        self._is_untested[prefix][row_positions] = True
+
+    def test(self, row_indices=None):
+        # tests the contingency table and its soft clipped counterpart (see ArtifactAnalysisTableUtils) of every
+        # filled, untested row of row_indices (all rows by default), all prefixes in one batch
+        row_positions = self._retrieve_row_positions(row_indices)
+        prefix_row_positions = [(prefix, row_positions[self._is_untested[prefix][row_positions]])
+                                for prefix in self._prefixes]
+        contingency_tables = []
+        for prefix, untested_row_positions in prefix_row_positions:
+            values = self._values[prefix][untested_row_positions]
+            columns = dict([(column_name, values[:, self._column_positions[column_name]].astype(numpy.int64))
+                            for column_name in MutationalFeatureTable.COUNT_NAMES])
+            # [[alt non ref, ref non ref], [alt ref, ref ref]]; soft clipped bases count as non ref in the second
+            contingency_tables += [numpy.stack([columns["alt_non_ref_pileupread_bp_count"],
+                                                columns["ref_non_ref_pileupread_bp_count"],
+                                                columns["alt_ref_pileupread_bp_count"],
+                                                columns["ref_ref_pileupread_bp_count"]], axis=1),
+                                   numpy.stack([columns["alt_non_ref_pileupread_bp_count"] +
+                                                columns["alt_soft_clipped_pileupread_bp_count"],
+                                                columns["ref_non_ref_pileupread_bp_count"] +
+                                                columns["ref_soft_clipped_pileupread_bp_count"],
+                                                columns["alt_ref_pileupread_bp_count"],
+                                                columns["ref_ref_pileupread_bp_count"]], axis=1)]
+        two_sided_p_values, greater_p_values = \
+            self._fisher_exact_test.retrieve_p_values(numpy.concatenate(contingency_tables).reshape(-1, 2, 2))
+
+        table_start = 0
+        for prefix, untested_row_positions in prefix_row_positions:
+            row_count = len(untested_row_positions)
+            values = self._values[prefix]
+            for column_name, table_offset in [("two_sided_p_value", 0), ("greater_p_value", 0),
+                                              ("soft_clipped_two_sided_p_value", row_count),
+                                              ("soft_clipped_greater_p_value", row_count)]:
+                p_values = two_sided_p_values if "two_sided" in column_name else greater_p_values
+                values[untested_row_positions, self._column_positions[column_name]] = \
+                    p_values[table_start + table_offset:table_start + table_offset + row_count]
+            self._is_untested[prefix][untested_row_positions] = False
+            table_start += 2 * row_count
+
+    @staticmethod
+    def _retrieve_expected_counts(alt_non_ref_counts, alt_ref_counts, ref_non_ref_counts, ref_ref_counts):
+        # -> expected counts of the four cells under independence, as ArtifactAnalysisTable works them out
+        log_total_alt_col_counts = numpy.log(alt_non_ref_counts + alt_ref_counts + ArtifactAnalysisTableUtils.EPS)
+        log_total_ref_col_counts = numpy.log(ref_non_ref_counts + ref_ref_counts + ArtifactAnalysisTableUtils.EPS)
+        log_total_non_ref_row_counts = numpy.log(alt_non_ref_counts + ref_non_ref_counts +
+                                                 ArtifactAnalysisTableUtils.EPS)
+        log_total_ref_row_counts = numpy.log(alt_ref_counts + ref_ref_counts + ArtifactAnalysisTableUtils.EPS)
+        log_total_counts = numpy.log(alt_non_ref_counts + alt_ref_counts + ref_non_ref_counts + ref_ref_counts +
+                                     ArtifactAnalysisTableUtils.EPS)
+        return numpy.exp(log_total_alt_col_counts + log_total_non_ref_row_counts - log_total_counts), \
+            numpy.exp(log_total_alt_col_counts + log_total_ref_row_counts - log_total_counts), \
+            numpy.exp(log_total_ref_col_counts + log_total_non_ref_row_counts - log_total_counts), \
+            numpy.exp(log_total_ref_col_counts + log_total_ref_row_counts - log_total_counts)
+
+    def _retrieve_columns(self, prefix, row_positions):
+        values = self._values[prefix][row_positions]
+        columns = dict([(column_name, values[:, column_position])
+                        for column_name, column_position in self._column_positions.items()])
+
+        alt_non_ref_soft_clipped_counts = \
+            columns["alt_non_ref_pileupread_bp_count"] + columns["alt_soft_clipped_pileupread_bp_count"]
+        ref_non_ref_soft_clipped_counts = \
+            columns["ref_non_ref_pileupread_bp_count"] + columns["ref_soft_clipped_pileupread_bp_count"]
+        expected_alt_non_ref_counts, expected_alt_ref_counts, expected_ref_non_ref_counts, expected_ref_ref_counts = \
+            MutationalFeatureTable._retrieve_expected_counts(columns["alt_non_ref_pileupread_bp_count"],
+                                                             columns["alt_ref_pileupread_bp_count"],
+                                                             columns["ref_non_ref_pileupread_bp_count"],
+                                                             columns["ref_ref_pileupread_bp_count"])
+        expected_alt_non_ref_soft_clipped_counts, expected_alt_ref_soft_clipped_counts, \
+            expected_ref_non_ref_soft_clipped_counts, expected_ref_ref_soft_clipped_counts = \
+            MutationalFeatureTable._retrieve_expected_counts(alt_non_ref_soft_clipped_counts,
+                                                             columns["alt_ref_pileupread_bp_count"],
+                                                             ref_non_ref_soft_clipped_counts,
+                                                             columns["ref_ref_pileupread_bp_count"])
+
+        data = OrderedDict()
+        data["alt_non_ref_pileupread_bp_count"] = columns["alt_non_ref_pileupread_bp_count"]
+        data["alt_ref_pileupread_bp_count"] = columns["alt_ref_pileupread_bp_count"]
+        data["expected_alt_non_ref_pileupread_bp_count"] = expected_alt_non_ref_counts
+        data["expected_alt_ref_pileupread_bp_count"] = expected_alt_ref_counts
+        data["alt_non_ref_soft_clipped_pileupread_bp_count"] = alt_non_ref_soft_clipped_counts
+        data["alt_ref_soft_clipped_pileupread_bp_count"] = columns["alt_ref_pileupread_bp_count"]
+        data["expected_alt_non_ref_soft_clipped_pileupread_bp_count"] = expected_alt_non_ref_soft_clipped_counts
+        data["expected_alt_ref_soft_clipped_pileupread_bp_count"] = expected_alt_ref_soft_clipped_counts
+        data["alt_soft_clipped_pileupread_bp_count"] = columns["alt_soft_clipped_pileupread_bp_count"]
+        data["alt_overlapping_aligned_segment_count"] = columns["alt_overlapping_aligned_segment_count"]
+        data["ref_non_ref_pileupread_bp_count"] = columns["ref_non_ref_pileupread_bp_count"]
+        data["ref_ref_pileupread_bp_count"] = columns["ref_ref_pileupread_bp_count"]
+        data["expected_ref_non_ref_pileupread_bp_count"] = expected_ref_non_ref_counts
+        data["expected_ref_ref_pileupread_bp_count"] = expected_ref_ref_counts
+        data["ref_non_ref_soft_clipped_pileupread_bp_count"] = ref_non_ref_soft_clipped_counts
+        data["ref_ref_soft_clipped_pileupread_bp_count"] = columns["ref_ref_pileupread_bp_count"]
+        data["expected_ref_non_ref_soft_clipped_pileupread_bp_count"] = expected_ref_non_ref_soft_clipped_counts
+        data["expected_ref_ref_soft_clipped_pileupread_bp_count"] = expected_ref_ref_soft_clipped_counts
+        data["ref_soft_clipped_pileupread_bp_count"] = columns["ref_soft_clipped_pileupread_bp_count"]
+        data["ref_overlapping_aligned_segment_count"] = columns["ref_overlapping_aligned_segment_count"]
+        data["log_two_sided_p_value"] = numpy.log10(columns["two_sided_p_value"] + ArtifactAnalysisTableUtils.EPS)
+        data["log_greater_p_value"] = numpy.log10(columns["greater_p_value"] + ArtifactAnalysisTableUtils.EPS)
+        data["soft_clipped_log_two_sided_p_value"] = \
+            numpy.log10(columns["soft_clipped_two_sided_p_value"] + ArtifactAnalysisTableUtils.EPS)
+        data["soft_clipped_log_greater_p_value"] = \
+            numpy.log10(columns["soft_clipped_greater_p_value"] + ArtifactAnalysisTableUtils.EPS)
+        if self._has_sampling_fraction:  # counts were taken on this fraction of the site's fragments
+            data[MutationalFeatureTable.SAMPLING_FRACTION_NAME] = columns[MutationalFeatureTable.SAMPLING_FRACTION_NAME]
+        return [(prefix + name, column) for name, column in data.items()]
+
+    @staticmethod
+    def is_feature(column_name, prefixes=None):
+        return any([column_name.startswith(prefix) and column_name[len(prefix):] in MutationalFeatureTable.FEATURE_NAMES
+                    for prefix in (MutationalFeatureTable.PREFIXES if prefixes is None else prefixes)])
+
+    @staticmethod
+    def is_count_feature(column_name, prefixes=None):
+        return MutationalFeatureTable.is_feature(column_name, prefixes) and column_name.endswith("_count") and \
+            "expected_" not in column_name
+
+    def retrieve_dataframe(self, row_indices=None):
+        # the rows of row_indices (all rows by default), tested first if need be
+        self.test(row_indices)
+        row_positions = self._retrieve_row_positions(row_indices)
+        columns = []
+        for prefix in self._prefixes:
+            columns += self._retrieve_columns(prefix, row_positions)
+        return pandas.DataFrame(OrderedDict(columns),
+                                index=self._index if row_indices is None else self._index[row_positions])
@@ -0,0 +1,245 @@
+import json
+import mmap
+import os
+import struct
+import numpy
+from pysam import FastaFile
+
+
+class PackedReferenceGenome(object):
+
+    # File layout: MAGIC, header length (little endian uint64), JSON header, then every contig packed at 4 bases per
+    # byte (2 bits per base, first base in the high bits). Bases that are not ACGT (N runs, IUPAC codes) are kept as
+    # exception runs and lower case (soft masked) stretches as mask runs, so fetch() returns exactly what
+    # FastaFile.fetch() would. The runs of a contig are little endian int64 arrays after its bases, one row of run
+    # starts, one of run ends (and one of exception bases); the header only holds their offsets and lengths. The file
+    # is memory-mapped read only: worker processes share one page-cached copy, runs included.
+    MAGIC = b"REBC2BIT"
+    VERSION = 2
+    HEADER_LENGTH_FORMAT = "<Q"
+    RUN_DTYPE = numpy.dtype("<i8")
+    BASES = b"TCAG"
+
+    _BASE_CODES = numpy.full(256, 255, dtype=numpy.uint8)
+    for _code, _base in enumerate(bytearray(BASES)):
+        _BASE_CODES[_base] = _code
+        _BASE_CODES[_base | 0x20] = _code
+    del _code, _base
+    _CODE_BASES = numpy.frombuffer(BASES, dtype=numpy.uint8)
+    _SHIFTS = numpy.array([6, 4, 2, 0], dtype=numpy.uint8)
+
+    def __init__(self, packed_ref_seq_filename):
+        self._packed_ref_seq_filename = packed_ref_seq_filename
+        self._file = open(packed_ref_seq_filename, "rb")
+        try:
+            header, data_start = PackedReferenceGenome._read_header(self._file)
+            if header.get("version") != PackedReferenceGenome.VERSION:
+                raise ValueError("%s is a packed reference genome of another version; pack it again." %
+                                 packed_ref_seq_filename)
+        except ValueError:
+            self._file.close()
+            raise
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        self._ref_seq_filename = header["ref_seq_filename"]
+        self._contigs = {}
+        self._references = []
+        for contig in header["contigs"]:
+            self._references += [contig["name"]]
+            self._contigs[contig["name"]] = PackedReferenceGenome.PackedContig(
+                length=contig["length"], offset=data_start + contig["offset"],
+                exception_run_offset=data_start + contig["exception_runs"]["offset"],
+                exception_run_count=contig["exception_runs"]["length"],
+                mask_run_offset=data_start + contig["mask_runs"]["offset"],
+                mask_run_count=contig["mask_runs"]["length"])
+
+    @staticmethod
+    def _read_header(packed_ref_seq_file):
+        # -> (header, offset of the data); ValueError for a file that is not a packed reference genome
+        if packed_ref_seq_file.read(len(PackedReferenceGenome.MAGIC)) != PackedReferenceGenome.MAGIC:
+            raise ValueError("%s is not a packed reference genome." % packed_ref_seq_file.name)
+        header_length, = struct.unpack(PackedReferenceGenome.HEADER_LENGTH_FORMAT, packed_ref_seq_file.read(
+            struct.calcsize(PackedReferenceGenome.HEADER_LENGTH_FORMAT)))
+        header = json.loads(packed_ref_seq_file.read(header_length).decode("ascii"))
+        return header, packed_ref_seq_file.tell()
+
+    @property
+    def filename(self):
+        return self._packed_ref_seq_filename
+
+    @property
+    def ref_seq_filename(self):
+        return self._ref_seq_filename
+
+    @property
+    def references(self):
+        return tuple(self._references)
+
+    @property
+    def lengths(self):
+        return tuple([self._contigs[reference].length for reference in self._references])
+
+    def get_reference_length(self, reference):
+        return self._contigs[reference].length
+
+    def _retrieve_runs(self, run_offset, run_count, row_count, start, end):
+        # -> [(start, end[, base]), ...] of the runs overlapping [start, end); runs are sorted and disjoint, so both
+        # their starts and their ends are, and each is a contiguous row of the mmap'd array
+        runs = numpy.frombuffer(self._mmap, dtype=PackedReferenceGenome.RUN_DTYPE, count=row_count * run_count,
+                                offset=run_offset).reshape(row_count, run_count)
+        first_run = numpy.searchsorted(runs[1], start, side="right")
+        last_run = numpy.searchsorted(runs[0], end, side="left")
+        return runs[:, first_run:last_run].T.tolist()  # copied, so that no view outlives the call
+
+    def fetch(self, reference, start=None, end=None):
+        # same clipping as FastaFile.fetch; KeyError for an unknown contig
+        contig = self._contigs[reference]
+        start = 0 if start is None else max(0, min(start, contig.length))
+        end = contig.length if end is None else max(start, min(end, contig.length))
+        if start == end:
+            return ""
+
+        first_byte = start // 4
+        packed = numpy.frombuffer(self._mmap, dtype=numpy.uint8, count=(end + 3) // 4 - first_byte,
+                                  offset=contig.offset + first_byte)
+        codes = ((packed[:, None] >> PackedReferenceGenome._SHIFTS) & 0x03).ravel()
+        bases = PackedReferenceGenome._CODE_BASES[codes[start - 4 * first_byte:end - 4 * first_byte]]
+
+        for run_start, run_end, base in self._retrieve_runs(contig.exception_run_offset, contig.exception_run_count,
+                                                            3, start, end):
+            bases[max(run_start, start) - start:min(run_end, end) - start] = base
+        for run_start, run_end in self._retrieve_runs(contig.mask_run_offset, contig.mask_run_count, 2, start, end):
+            bases[max(run_start, start) - start:min(run_end, end) - start] |= 0x20
+        return bases.tobytes().decode("ascii")
+
+    def close(self):
+        self._mmap.close()
+        self._file.close()
+
+    @staticmethod
+    def _retrieve_runs_array(selection, is_break=None):
+        # boolean array -> (2 x runs) int64 array of the starts and ends of its True stretches, also broken before
+        # the positions of is_break
+        is_break = numpy.zeros(len(selection), dtype=bool) if is_break is None else is_break
+        is_start = selection & (is_break | ~numpy.concatenate(([False], selection[:-1])))
+        is_end = selection & (numpy.concatenate((is_break[1:], [True])) | ~numpy.concatenate((selection[1:], [False])))
+        return numpy.array([numpy.flatnonzero(is_start), numpy.flatnonzero(is_end) + 1],
+                           dtype=PackedReferenceGenome.RUN_DTYPE).reshape(2, -1)
+
+    @staticmethod
+    def _pack_contig(sequence):
+        # contig sequence -> (packed bytes, (3 x runs) exception runs, (2 x runs) mask runs)
+        bases = numpy.frombuffer(sequence.encode("ascii"), dtype=numpy.uint8)
+        codes = PackedReferenceGenome._BASE_CODES[bases]
+
+        is_exception = codes == 255
+        upper_bases = numpy.where(bases >= ord("a"), bases & 0xDF, bases)
+        # break runs where the exception base changes, e.g. N followed by R
+        is_changed = numpy.concatenate(([True], upper_bases[1:] != upper_bases[:-1]))
+        exception_runs = PackedReferenceGenome._retrieve_runs_array(is_exception, is_changed)
+        exception_runs = numpy.concatenate((exception_runs, upper_bases[exception_runs[0]][None, :].astype(
+            PackedReferenceGenome.RUN_DTYPE)))
+        codes = numpy.where(is_exception, 0, codes).astype(numpy.uint8)
+
+        mask_runs = PackedReferenceGenome._retrieve_runs_array(bases >= ord("a"))
+
+        codes = numpy.concatenate((codes, numpy.zeros(-len(codes) % 4, dtype=numpy.uint8))).reshape(-1, 4)
+        packed = (codes[:, 0] << 6) | (codes[:, 1] << 4) | (codes[:, 2] << 2) | codes[:, 3]
+        return packed.astype(numpy.uint8).tobytes(), exception_runs, mask_runs
+
+    @staticmethod
+    def create(ref_seq_filename, packed_ref_seq_filename):
+        # packs a fasta one contig at a time; written under a temporary name and renamed so that concurrent readers
+        # never see a partial file
+        ref_seq_file = FastaFile(ref_seq_filename)
+        temporary_filename = "%s.%d.tmp" % (packed_ref_seq_filename, os.getpid())
+        contigs = []
+        offset = 0
+        try:
+            with open(temporary_filename + ".data", "wb") as data_file:
+                for reference in ref_seq_file.references:
+                    packed, exception_runs, mask_runs = \
+                        PackedReferenceGenome._pack_contig(ref_seq_file.fetch(reference))
+                    contig = dict(name=reference, length=ref_seq_file.get_reference_length(reference), offset=offset)
+                    data_file.write(packed)
+                    offset += len(packed)
+                    for name, runs in [("exception_runs", exception_runs), ("mask_runs", mask_runs)]:
+                        padding = -offset % PackedReferenceGenome.RUN_DTYPE.itemsize  # aligned for numpy.frombuffer
+                        data_file.write(b"\0" * padding)
+                        offset += padding
+                        contig[name] = dict(offset=offset, length=runs.shape[1])
+                        data_file.write(numpy.ascontiguousarray(runs).tobytes())
+                        offset += runs.nbytes
+                    contigs += [contig]
+
+            header = json.dumps(dict(version=PackedReferenceGenome.VERSION,
+                                     ref_seq_filename=os.path.abspath(ref_seq_filename),
+                                     contigs=contigs)).encode("ascii")
+            header += b" " * (-len(header) % 8)  # keeps the data 8 byte aligned
+            with open(temporary_filename, "wb") as packed_ref_seq_file:
+                packed_ref_seq_file.write(PackedReferenceGenome.MAGIC)
+                packed_ref_seq_file.write(struct.pack(PackedReferenceGenome.HEADER_LENGTH_FORMAT, len(header)))
+                packed_ref_seq_file.write(header)
+                with open(temporary_filename + ".data", "rb") as data_file:
+                    for chunk in iter(lambda: data_file.read(1 << 20), b""):
+                        packed_ref_seq_file.write(chunk)
+            os.rename(temporary_filename, packed_ref_seq_filename)
+        finally:
+            ref_seq_file.close()
+            for filename in [temporary_filename, temporary_filename + ".data"]:
+                if os.path.exists(filename):
+                    os.remove(filename)
+
+    @staticmethod
+    def is_current(ref_seq_filename, packed_ref_seq_filename):
+        if not os.path.exists(packed_ref_seq_filename) or \
+                os.path.getmtime(packed_ref_seq_filename) < os.path.getmtime(ref_seq_filename):
+            return False
+        with open(packed_ref_seq_filename, "rb") as packed_ref_seq_file:
+            try:
+                header, _ = PackedReferenceGenome._read_header(packed_ref_seq_file)
+            except ValueError:
+                return False
+        return header.get("version") == PackedReferenceGenome.VERSION
+
+    @staticmethod
+    def retrieve(ref_seq_filename, packed_ref_seq_filename):
+        # (re)builds the packed file when it is missing or older than the fasta
+        if not PackedReferenceGenome.is_current(ref_seq_filename, packed_ref_seq_filename):
+            PackedReferenceGenome.create(ref_seq_filename, packed_ref_seq_filename)
+        return packed_ref_seq_filename
+
+    class PackedContig(object):
+        # where a contig's bases and runs are in the mmap
+
+        def __init__(self, length, offset, exception_run_offset, exception_run_count, mask_run_offset, mask_run_count):
+            self._length = length
+            self._offset = offset
+            self._exception_run_offset = exception_run_offset
+            self._exception_run_count = exception_run_count
+            self._mask_run_offset = mask_run_offset
+            self._mask_run_count = mask_run_count
+
+        @property
+        def length(self):
+            return self._length
+
+        @property
+        def offset(self):
+            return self._offset
+
+        @property
+        def exception_run_offset(self):
+            return self._exception_run_offset
+
+        @property
+        def exception_run_count(self):
+            return self._exception_run_count
+
+        @property
+        def mask_run_offset(self):
+            return self._mask_run_offset
+
+        @property
+        def mask_run_count(self):
+            return self._mask_run_count
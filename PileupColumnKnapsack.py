@@ -1,17 +1,24 @@
+from AlignedSegmentCache import AlignedSegmentCache
 from BasePairUtils import BasePairUtils
 from PileupReadKnapsack import PileupReadKnapsack
+from PileupReadFilter import PileupReadFilter
 from collections import OrderedDict
 
 
 class PileupColumnKnapsack():
 
-    def __init__(self, pileupread_knapsacks):
+    def __init__(self, pileupread_knapsacks, aligned_segment_cache=None):
         self._pileupread_knapsacks = pileupread_knapsacks
+        self._aligned_segment_cache = aligned_segment_cache
 
     @property
     def pileupread_knapsacks(self):
         return self._pileupread_knapsacks
 
+    @property
+    def aligned_segment_cache(self):
+        return self._aligned_segment_cache
+
     @property
     def pileupcolumn_names(self):
         return self._pileupread_knapsacks.keys()
@@ -31,21 +38,49 @@ class PileupColumnKnapsack():
             ref_allele = self._pileupread_knapsacks[pileupcolumn_name].ref_allele
         return ref_allele
 
+    @staticmethod
+    def _insert_pileupread_knapsack(pileupread_knapsacks, chrom, ref_allele, pileupcolumn, aligned_segment_cache=None,
+                                    pileup_read_filter=None):
+        pileupcolumn_start = pileupcolumn.pos
+        pileupcolumn_end = pileupcolumn.pos+1
+
+        pileupcolumn_name = BasePairUtils.retrieve_pileupcolumn_name(chrom, pileupcolumn_start, pileupcolumn_end)
+        pileupread_knapsacks[pileupcolumn_name] = \
+            PileupReadKnapsack.create(chrom, pileupcolumn_start, pileupcolumn_end, ref_allele, pileupcolumn,
+                                      aligned_segment_cache, pileup_read_filter)
+
     @classmethod
-    def create(cls, chrom, start, end, sample_bam_file, ref_seq_file):
+    def create(cls, chrom, start, end, sample_bam_file, ref_seq_file, aligned_segment_cache=None, genome_mask=None,
+               pileup_read_filter=None):
+        # columns masked by genome_mask (a GenomeMask) are skipped before their reads are materialized; reads are
+        # filtered by pileup_read_filter (a PileupReadFilter) inside the pileup
+        pileup_read_filter = PileupReadFilter.DEFAULT if pileup_read_filter is None else pileup_read_filter
         pileupread_knapsacks = OrderedDict()
+        # every read spans many columns; its alignment is indexed once and shared by all of them
+        aligned_segment_cache = AlignedSegmentCache() if aligned_segment_cache is None else aligned_segment_cache
 
-        for pileupcolumn in sample_bam_file.pileup(chrom, start, end, truncate=False):
-            pileupcolumn_chrom = chrom
-            pileupcolumn_start = pileupcolumn.pos
-            pileupcolumn_end = pileupcolumn.pos+1
+        for pileupcolumn in sample_bam_file.pileup(chrom, start, end, truncate=False,
+                                                   **pileup_read_filter.retrieve_pileup_options()):
+            if pileupcolumn.pos != start and \
+                    (genome_mask is None or not genome_mask.is_masked(chrom, pileupcolumn.pos)):
+                ref_allele = ref_seq_file.fetch(chrom, pileupcolumn.pos, pileupcolumn.pos+1)  # [start,end) region
+                PileupColumnKnapsack._insert_pileupread_knapsack(pileupread_knapsacks, chrom, ref_allele, pileupcolumn,
+                                                                 aligned_segment_cache, pileup_read_filter)
+
+        return PileupColumnKnapsack(pileupread_knapsacks=pileupread_knapsacks,
+                                    aligned_segment_cache=aligned_segment_cache)
+
+    @classmethod
+    def create_from_pileupcolumn_snapshots(cls, chrom, start, pileupcolumn_snapshots, aligned_segment_cache=None):
+        # snapshots already carry their reference allele (see PileupSweepEngine)
+        pileupread_knapsacks = OrderedDict()
+        aligned_segment_cache = AlignedSegmentCache() if aligned_segment_cache is None else aligned_segment_cache
 
-            pileupcolumn_name = BasePairUtils.retrieve_pileupcolumn_name(pileupcolumn_chrom, pileupcolumn_start,
-                                                                         pileupcolumn_end)
-            if pileupcolumn.pos != start:
-                ref_allele = ref_seq_file.fetch(chrom, pileupcolumn_start, pileupcolumn_end)  # [start,end) region
-                pileupread_knapsacks[pileupcolumn_name] = \
-                    PileupReadKnapsack.create(pileupcolumn_chrom, pileupcolumn_start, pileupcolumn_end, ref_allele,
-                                              pileupcolumn)
+        for pileupcolumn_snapshot in pileupcolumn_snapshots:
+            if pileupcolumn_snapshot.pos != start:
+                PileupColumnKnapsack._insert_pileupread_knapsack(pileupread_knapsacks, chrom,
+                                                                 pileupcolumn_snapshot.ref_allele,
+                                                                 pileupcolumn_snapshot, aligned_segment_cache)
 
-        return PileupColumnKnapsack(pileupread_knapsacks=pileupread_knapsacks)
\ No newline at end of file
+        return PileupColumnKnapsack(pileupread_knapsacks=pileupread_knapsacks,
+                                    aligned_segment_cache=aligned_segment_cache)
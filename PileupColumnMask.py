@@ -19,7 +19,7 @@ class PileupColumnMask(object):
     def create(pileupcolumn_knapsack):
         mask = OrderedDict()
 
-        for pileupcolumn_name in pileupcolumn_knapsack.pileupread_knapsacks:
+        for pileupcolumn_name in pileupcolumn_knapsack.pileupcolumn_names:
             # aggregate_counts = pileupread_knapsack.base_pair_aggregate_counts
             # TODO: using aggregate counts, determine whether the base pair should be masked or not
             # TODO: ensure that mask for insertions is at the base before and after (used later)
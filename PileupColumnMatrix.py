@@ -0,0 +1,197 @@
+from ArtifactAnalysisTableUtils import ArtifactAnalysisTableUtils
+from BasePairUtils import BasePairUtils
+from PileupReadFilter import PileupReadFilter
+from collections import OrderedDict
+import numpy
+
+
+class PileupColumnMatrix(object):
+
+    # A (columns x reads) int8 matrix standing in for PileupColumnKnapsack. Each cell packs what the table counts
+    # for one read at one column, so that no pysam objects are kept once the matrix is built:
+    #   bit 0     read is present at the column
+    #   bit 1     read carries the column's reference allele
+    #   bits 2-3  binarized non-reference length (SNP and/or indel, 0-2)
+    #   bits 4-5  binarized soft clipped length (number of soft clipped regions of the read, 0-2)
+    PRESENT = 0x01
+    REF = 0x02
+    NON_REF_SHIFT = 2
+    SOFT_CLIPPED_SHIFT = 4
+    FIELD_MASK = 0x03
+
+    def __init__(self, chrom, start, column_offsets, ref_alleles, read_ids, codes):
+        self._chrom = chrom
+        self._start = start
+        self._column_offsets = column_offsets  # column position - start
+        self._ref_alleles = ref_alleles
+        self._read_ids = read_ids  # query name -> read id (matrix column)
+        self._codes = codes
+
+        self._pileupcolumn_names = [BasePairUtils.retrieve_pileupcolumn_name(chrom, start + column_offset,
+                                                                             start + column_offset + 1)
+                                    for column_offset in column_offsets]
+
+    @property
+    def chrom(self):
+        return self._chrom
+
+    @property
+    def start(self):
+        return self._start
+
+    @property
+    def column_offsets(self):
+        return self._column_offsets
+
+    @property
+    def read_ids(self):
+        return self._read_ids
+
+    @property
+    def codes(self):
+        return self._codes
+
+    @property
+    def aligned_segment_cache(self):
+        return None
+
+    @property
+    def pileupcolumn_names(self):
+        return self._pileupcolumn_names
+
+    def retrieve_ref_allele(self, pileupcolumn_name):
+        ref_allele = None
+        if pileupcolumn_name in self._ref_alleles:
+            ref_allele = self._ref_alleles[pileupcolumn_name]
+        return ref_allele
+
+    def retrieve_indexed_pileupreads(self, pileupread_alignment_query_names, pileupcolumn_mask):
+        # counterpart of ArtifactAnalysisTableUtils.retrieve_indexed_pileupreads: the unmasked columns, restricted
+        # to the given reads
+        column_selection = numpy.array([not pileupcolumn_mask.get(pileupcolumn_name, True)
+                                        for pileupcolumn_name in self._pileupcolumn_names], dtype=bool)
+        read_selection = self.retrieve_read_selection(pileupread_alignment_query_names)
+        return PileupColumnMatrix.IndexedPileupColumnMatrix(self._codes[column_selection][:, read_selection],
+                                                            self._select_read_ids(read_selection))
+
+    def retrieve_read_selection(self, pileupread_alignment_query_names):
+        read_selection = numpy.zeros(len(self._read_ids), dtype=bool)
+        read_ids = [self._read_ids[pileupread_alignment_query_name]
+                    for pileupread_alignment_query_name in set(pileupread_alignment_query_names or [])
+                    if pileupread_alignment_query_name in self._read_ids]
+        read_selection[read_ids] = True
+        return read_selection
+
+    def _select_read_ids(self, read_selection):
+        selected_read_ids = OrderedDict()
+        for pileupread_alignment_query_name, read_id in self._read_ids.items():
+            if read_selection[read_id]:
+                selected_read_ids[pileupread_alignment_query_name] = len(selected_read_ids)
+        return selected_read_ids
+
+    @staticmethod
+    def encode_pileupread(pileupread, ref_allele):
+        non_ref_length = ArtifactAnalysisTableUtils._retrieve_non_ref_length(pileupread, ref_allele)
+        soft_clipped_length = ArtifactAnalysisTableUtils._retrieve_soft_clipped_length(pileupread)
+        code = PileupColumnMatrix.PRESENT
+        if ArtifactAnalysisTableUtils.pileupread_has_ref_allele(pileupread, ref_allele):
+            code |= PileupColumnMatrix.REF
+        code |= min(non_ref_length, PileupColumnMatrix.FIELD_MASK) << PileupColumnMatrix.NON_REF_SHIFT
+        code |= min(soft_clipped_length, PileupColumnMatrix.FIELD_MASK) << PileupColumnMatrix.SOFT_CLIPPED_SHIFT
+        return code
+
+    @classmethod
+    def _create(cls, chrom, start, pileupcolumns, retrieve_ref_allele, pileup_read_filter=None):
+        # pileupcolumns in position order; retrieve_ref_allele(pileupcolumn) -> reference allele at the column
+        column_offsets = []
+        ref_alleles = OrderedDict()
+        read_ids = OrderedDict()
+        column_codes = []
+
+        for pileupcolumn in pileupcolumns:
+            if pileupcolumn.pos == start:
+                continue
+            ref_allele = retrieve_ref_allele(pileupcolumn)
+            column_offsets += [pileupcolumn.pos - start]
+            ref_alleles[BasePairUtils.retrieve_pileupcolumn_name(chrom, pileupcolumn.pos, pileupcolumn.pos+1)] = \
+                ref_allele
+
+            codes = OrderedDict()  # read id -> code; as in PileupReadKnapsack, a later mate replaces an earlier one
+            for pileupread in pileupcolumn.pileups if pileup_read_filter is None else \
+                    pileup_read_filter.filter_pileupreads(pileupcolumn.pileups):
+                pileupread_alignment_query_name = pileupread.alignment.query_name
+                read_id = read_ids.setdefault(pileupread_alignment_query_name, len(read_ids))
+                codes[read_id] = PileupColumnMatrix.encode_pileupread(pileupread, ref_allele)
+            column_codes += [codes]
+
+        matrix = numpy.zeros((len(column_offsets), len(read_ids)), dtype=numpy.int8)
+        for column_index, codes in enumerate(column_codes):
+            if codes:
+                matrix[column_index, list(codes.keys())] = list(codes.values())
+
+        return PileupColumnMatrix(chrom=chrom, start=start,
+                                  column_offsets=numpy.array(column_offsets, dtype=numpy.int32),
+                                  ref_alleles=ref_alleles, read_ids=read_ids, codes=matrix)
+
+    @classmethod
+    def create(cls, chrom, start, end, sample_bam_file, ref_seq_file, aligned_segment_cache=None, genome_mask=None,
+               pileup_read_filter=None):
+        # same columns as PileupColumnKnapsack.create; pileupcolumns are encoded while the iterator is on them
+        pileup_read_filter = PileupReadFilter.DEFAULT if pileup_read_filter is None else pileup_read_filter
+        pileupcolumns = sample_bam_file.pileup(chrom, start, end, truncate=False,
+                                               **pileup_read_filter.retrieve_pileup_options())
+        if genome_mask is not None:
+            pileupcolumns = (pileupcolumn for pileupcolumn in pileupcolumns
+                             if not genome_mask.is_masked(chrom, pileupcolumn.pos))
+        return PileupColumnMatrix._create(chrom, start, pileupcolumns,
+                                          lambda pileupcolumn: ref_seq_file.fetch(chrom, pileupcolumn.pos,
+                                                                                  pileupcolumn.pos+1),
+                                          pileup_read_filter)
+
+    @classmethod
+    def create_from_pileupcolumn_snapshots(cls, chrom, start, pileupcolumn_snapshots, aligned_segment_cache=None):
+        return PileupColumnMatrix._create(chrom, start, pileupcolumn_snapshots,
+                                          lambda pileupcolumn_snapshot: pileupcolumn_snapshot.ref_allele)
+
+    class IndexedPileupColumnMatrix(object):
+        # unmasked columns x selected reads; answers the ArtifactAnalysisTableUtils counts as masked reductions
+
+        def __init__(self, codes, read_ids):
+            self._codes = codes
+            self._read_ids = read_ids
+
+        @property
+        def codes(self):
+            return self._codes
+
+        def _select(self, pileupread_alignment_query_names):
+            read_ids = [self._read_ids[pileupread_alignment_query_name]
+                        for pileupread_alignment_query_name in set(pileupread_alignment_query_names or [])
+                        if pileupread_alignment_query_name in self._read_ids]
+            return self._codes[:, read_ids]
+
+        def retrieve_ref_bp_count(self, pileupread_alignment_query_names=None):
+            return int(numpy.count_nonzero(self._select(pileupread_alignment_query_names) & PileupColumnMatrix.REF))
+
+        def retrieve_non_ref_bp_count(self, pileupread_alignment_query_names=None, binarize_length=True):
+            if not binarize_length:
+                raise ValueError("PileupColumnMatrix only keeps binarized lengths.")
+            codes = self._select(pileupread_alignment_query_names)
+            return int(((codes >> PileupColumnMatrix.NON_REF_SHIFT) & PileupColumnMatrix.FIELD_MASK).sum())
+
+        def retrieve_soft_clipped_bp_count(self, pileupread_alignment_query_names=None, binarize_length=True):
+            if not binarize_length:
+                raise ValueError("PileupColumnMatrix only keeps binarized lengths.")
+            codes = self._select(pileupread_alignment_query_names)
+            return int(((codes >> PileupColumnMatrix.SOFT_CLIPPED_SHIFT) & PileupColumnMatrix.FIELD_MASK).sum())
+
+        def retrieve_bp_counts(self, ref_supporting_pileupread_alignment_query_names,
+                               alt_supporting_pileupread_alignment_query_names, binarize_length=True):
+            return (self.retrieve_ref_bp_count(ref_supporting_pileupread_alignment_query_names),
+                    self.retrieve_non_ref_bp_count(ref_supporting_pileupread_alignment_query_names, binarize_length),
+                    self.retrieve_soft_clipped_bp_count(ref_supporting_pileupread_alignment_query_names,
+                                                        binarize_length),
+                    self.retrieve_ref_bp_count(alt_supporting_pileupread_alignment_query_names),
+                    self.retrieve_non_ref_bp_count(alt_supporting_pileupread_alignment_query_names, binarize_length),
+                    self.retrieve_soft_clipped_bp_count(alt_supporting_pileupread_alignment_query_names,
+                                                        binarize_length))
@@ -0,0 +1,81 @@
+class PileupReadFilter(object):
+
+    # Read filters shared by every pileup of every sample. Flags and base quality are handed to htslib through
+    # pileup(), so failing reads never become Python objects. pysam's "all" stepper ignores min_mapping_quality and
+    # htslib has no mismatch filter, so mapping quality and the NM tag are checked on the pileupreads that come back
+    # (reads without the tag are kept). A filter restricted to a set of query names (see restrict) keeps only those
+    # reads, e.g. the fragments sampled at a site.
+    BAM_FUNMAP = 0x4
+    BAM_FSECONDARY = 0x100
+    BAM_FQCFAIL = 0x200
+    BAM_FDUP = 0x400
+    BAM_FSUPPLEMENTARY = 0x800
+    DEFAULT_FLAG_FILTER = BAM_FUNMAP | BAM_FSECONDARY | BAM_FQCFAIL | BAM_FDUP  # pysam's pileup default
+    DEFAULT_MIN_MAPPING_QUALITY = 0
+    DEFAULT_MIN_BASE_QUALITY = 13  # pysam's pileup default
+    MISMATCH_TAG = "NM"
+
+    def __init__(self, flag_filter=None, min_mapping_quality=None, min_base_quality=None, max_mismatches=None,
+                 query_names=None):
+        self._flag_filter = PileupReadFilter.DEFAULT_FLAG_FILTER if flag_filter is None else flag_filter
+        self._min_mapping_quality = PileupReadFilter.DEFAULT_MIN_MAPPING_QUALITY if min_mapping_quality is None \
+            else min_mapping_quality
+        self._min_base_quality = PileupReadFilter.DEFAULT_MIN_BASE_QUALITY if min_base_quality is None else \
+            min_base_quality
+        self._max_mismatches = max_mismatches
+        self._query_names = query_names
+
+    @property
+    def flag_filter(self):
+        return self._flag_filter
+
+    @property
+    def min_mapping_quality(self):
+        return self._min_mapping_quality
+
+    @property
+    def min_base_quality(self):
+        return self._min_base_quality
+
+    @property
+    def max_mismatches(self):
+        return self._max_mismatches
+
+    @property
+    def query_names(self):
+        return self._query_names
+
+    @property
+    def is_aligned_segment_filtered(self):
+        # whether is_aligned_segment_included can reject anything
+        return self._min_mapping_quality > 0 or self._max_mismatches is not None or self._query_names is not None
+
+    def restrict(self, query_names):
+        # -> the same filter, further keeping only the reads named in query_names (None keeps them all)
+        if query_names is None:
+            return self
+        return PileupReadFilter(self._flag_filter, self._min_mapping_quality, self._min_base_quality,
+                                self._max_mismatches, query_names)
+
+    def retrieve_pileup_options(self, min_base_quality=None):
+        # keyword arguments of AlignmentFile.pileup; min_base_quality overrides the filter's own (e.g. with 0 when
+        # base qualities are judged later)
+        return dict(stepper="all", flag_filter=self._flag_filter, min_mapping_quality=self._min_mapping_quality,
+                    min_base_quality=self._min_base_quality if min_base_quality is None else min_base_quality)
+
+    def is_aligned_segment_included(self, aligned_segment):
+        if aligned_segment.mapping_quality < self._min_mapping_quality:
+            return False
+        if self._query_names is not None and aligned_segment.query_name not in self._query_names:
+            return False
+        if self._max_mismatches is None or not aligned_segment.has_tag(PileupReadFilter.MISMATCH_TAG):
+            return True
+        return aligned_segment.get_tag(PileupReadFilter.MISMATCH_TAG) <= self._max_mismatches
+
+    def filter_pileupreads(self, pileupreads):
+        if not self.is_aligned_segment_filtered:
+            return pileupreads
+        return [pileupread for pileupread in pileupreads if self.is_aligned_segment_included(pileupread.alignment)]
+
+
+PileupReadFilter.DEFAULT = PileupReadFilter()
@@ -1,3 +1,4 @@
+from AlignedSegmentCache import AlignedSegmentCache
 from BasePairUtils import BasePairUtils
 from collections import OrderedDict
 
@@ -6,23 +7,20 @@ class PileupReadKnapsack(object):
 
     # TODO: What to do about overlapping reads? Because I am using a dictionary, it should not matter.
 
-    def __init__(self, chrom, start, end, ref_allele, pileupreads):
+    def __init__(self, chrom, start, end, ref_allele, pileupreads, aligned_segment_cache=None):
         self._chrom = chrom
         self._start = start
         self._end = end
         self._ref_allele = ref_allele
         self._pileupreads = pileupreads
-        self._alignment_sequence_base_descriptors = OrderedDict()
-
-        # Create and insert base pair descriptors from each pileup read
-        for pileupread_alignment_query_name in pileupreads:
-            pileupread = pileupreads[pileupread_alignment_query_name]
-            self._alignment_sequence_base_descriptors[pileupread_alignment_query_name] = \
-                PileupReadKnapsack.AlignmentSequenceBaseDescriptor.create(start, ref_allele, pileupread)
+        self._aligned_segment_cache = aligned_segment_cache
+        # query name -> packed descriptor (see AlignmentSequenceBaseDescriptor.encode); only built once the
+        # aggregate counts are asked for, since nothing else reads them
+        self._alignment_sequence_base_descriptor_codes = None
 
     @property
     def pileupread_alignment_query_names(self):
-        return self._alignment_sequence_base_descriptors.keys()
+        return self._pileupreads.keys()
 
     @property
     def chrom(self):
@@ -44,82 +42,105 @@ class PileupReadKnapsack(object):
     def pileupreads(self):
         return self._pileupreads
 
+    @property
+    def alignment_sequence_base_descriptor_codes(self):
+        if self._alignment_sequence_base_descriptor_codes is None:
+            self._alignment_sequence_base_descriptor_codes = OrderedDict()
+            for pileupread_alignment_query_name, pileupread in self._pileupreads.items():
+                self._alignment_sequence_base_descriptor_codes[pileupread_alignment_query_name] = \
+                    PileupReadKnapsack.AlignmentSequenceBaseDescriptor.encode(self._start, self._ref_allele,
+                                                                              pileupread, self._aligned_segment_cache)
+        return self._alignment_sequence_base_descriptor_codes
+
+    @property
+    def alignment_sequence_base_descriptors(self):
+        return OrderedDict([(pileupread_alignment_query_name,
+                             PileupReadKnapsack.AlignmentSequenceBaseDescriptor.decode(self._ref_allele, code))
+                            for pileupread_alignment_query_name, code in
+                            self.alignment_sequence_base_descriptor_codes.items()])
+
     @property
     def base_pair_aggregate_counts(self):
-        return PileupReadKnapsack.BasePairAggregateCounts.create(self._pileupreads,
-                                                                 self._alignment_sequence_base_descriptors)
+        return PileupReadKnapsack.BasePairAggregateCounts.create(self._start, self._ref_allele, self._pileupreads,
+                                                                 self.alignment_sequence_base_descriptors)
 
     @classmethod
-    def create(cls, chrom, start, end, ref_allele, pileupcolumn):
+    def create(cls, chrom, start, end, ref_allele, pileupcolumn, aligned_segment_cache=None, pileup_read_filter=None):
         pileupreads = OrderedDict()
-        for pileupread in pileupcolumn.pileups:
+        for pileupread in pileupcolumn.pileups if pileup_read_filter is None else \
+                pileup_read_filter.filter_pileupreads(pileupcolumn.pileups):
             pileupreads[pileupread.alignment.query_name] = pileupread
-        return PileupReadKnapsack(chrom=chrom, start=start, end=end, ref_allele=ref_allele, pileupreads=pileupreads)
-
+        return PileupReadKnapsack(chrom=chrom, start=start, end=end, ref_allele=ref_allele, pileupreads=pileupreads,
+                                  aligned_segment_cache=aligned_segment_cache)
 
+    class AlignmentSequenceBaseDescriptor(object):
 
+        # A descriptor packs into one small int:
+        #   bits 0-4  is_ref, is_alt, is_ins, is_del, is_soft_clipped
+        #   bits 5-6  alt allele (index into ALT_ALLELES), meaningful when is_alt is set
+        #   bit 7     alt allele is not one of ALT_ALLELES (e.g. N); decode() then reports it as "N"
+        IS_REF = 0x01
+        IS_ALT = 0x02
+        IS_INS = 0x04
+        IS_DEL = 0x08
+        IS_SOFT_CLIPPED = 0x10
+        ALT_ALLELE_SHIFT = 5
+        ALT_ALLELE_MASK = 0x03
+        IS_OTHER_ALT_ALLELE = 0x80
+        ALT_ALLELES = "ACGT"
+        OTHER_ALT_ALLELE = "N"
+
+        __slots__ = ("_ref_allele", "_code")
+
+        def __init__(self, ref_allele, code):
+            self._ref_allele = ref_allele
+            self._code = code
 
+        @staticmethod
+        def encode(position, ref_allele, pileupread, aligned_segment_cache=None):
+            descriptor = PileupReadKnapsack.AlignmentSequenceBaseDescriptor
+            aligned_segment_descriptor = \
+                AlignedSegmentCache.AlignedSegmentDescriptor.create(pileupread.alignment) \
+                if aligned_segment_cache is None else aligned_segment_cache.retrieve(pileupread.alignment)
 
+            # soft clips appear either at the beginning or at the end of the aligned read
+            if aligned_segment_descriptor.is_soft_clipped(position):
+                return descriptor.IS_SOFT_CLIPPED
 
+            if pileupread.is_del:  # deletions' positions are NOT included in the aligned read
+                return descriptor.IS_DEL
 
+            # insertions appear as gaps between the query positions around position
+            if aligned_segment_descriptor.is_ins_adjacent(position):
+                return descriptor.IS_INS
 
+            query_position = aligned_segment_descriptor.retrieve_query_position(position)
+            if query_position is None:  # reference skip
+                return 0
 
+            base = aligned_segment_descriptor.retrieve_base(query_position)
+            if base == ref_allele:
+                return descriptor.IS_REF
 
-    class AlignmentSequenceBaseDescriptor(object):
-        def __init__(self, ref_allele, alt_allele, is_ref, is_alt, is_ins, is_del, is_soft_clipped):
-            self._ref_allele = ref_allele
-            self._alt_allele = alt_allele
-            self._is_alt = is_alt
-            self._is_ref = is_ref
-            self._is_ins = is_ins
-            self._is_del = is_del
-            self._is_soft_clipped = is_soft_clipped
+            alt_allele_index = descriptor.ALT_ALLELES.find(base)
+            if alt_allele_index < 0:
+                return descriptor.IS_ALT | descriptor.IS_OTHER_ALT_ALLELE
+            return descriptor.IS_ALT | (alt_allele_index << descriptor.ALT_ALLELE_SHIFT)
 
         @staticmethod
-        def create(position, ref_allele, pileupread):
-            alt_allele = None
-            is_ref = is_alt = is_ins = is_del = is_soft_clipped = False
+        def decode(ref_allele, code):
+            return PileupReadKnapsack.AlignmentSequenceBaseDescriptor(ref_allele, code)
 
-            # soft clips appear either at the beginning or at the end of the aligned read
-            if pileupread.alignment.aligned_pairs[0][1] > position or \
-                    pileupread.alignment.aligned_pairs[-1][1] < position:
-                is_soft_clipped = True
-                return PileupReadKnapsack.AlignmentSequenceBaseDescriptor(ref_allele=ref_allele, alt_allele=alt_allele,
-                                                                          is_ref=is_ref, is_alt=is_alt, is_ins=is_ins,
-                                                                          is_del=is_del,
-                                                                          is_soft_clipped=is_soft_clipped)
+        @staticmethod
+        def create(position, ref_allele, pileupread, aligned_segment_cache=None):
+            return PileupReadKnapsack.AlignmentSequenceBaseDescriptor.decode(
+                ref_allele,
+                PileupReadKnapsack.AlignmentSequenceBaseDescriptor.encode(position, ref_allele, pileupread,
+                                                                          aligned_segment_cache))
 
-            if pileupread.is_del:  # deletions' positions are NOT included in the aligned read
-                is_del = True
-                return PileupReadKnapsack.AlignmentSequenceBaseDescriptor(ref_allele=ref_allele, alt_allele=alt_allele,
-                                                                          is_ref=is_ref, is_alt=is_alt, is_ins=is_ins,
-                                                                          is_del=is_del,
-                                                                          is_soft_clipped=is_soft_clipped)
-
-            # insertions appear as "None"'s w.r.t. position (positions around the ins are inserts)
-            aligned_pair_positions = [aligned_pair[1] for aligned_pair in pileupread.alignment.aligned_pairs]
-            aligned_pair_position_index = aligned_pair_positions.index(position)
-            if not (aligned_pair_position_index+1 < len(aligned_pair_positions) and
-                    not aligned_pair_positions[aligned_pair_position_index+1]) or \
-                    (aligned_pair_position_index-1 > 0 and not aligned_pair_positions[aligned_pair_position_index-1]):
-                is_ins = True
-                return PileupReadKnapsack.AlignmentSequenceBaseDescriptor(ref_allele=ref_allele, alt_allele=alt_allele,
-                                                                          is_ref=is_ref, is_alt=is_alt, is_ins=is_ins,
-                                                                          is_del=is_del,
-                                                                          is_soft_clipped=is_soft_clipped)
-
-            if pileupread.alignment.query_sequence[pileupread.query_position] == ref_allele:
-                is_ref = True
-                return PileupReadKnapsack.AlignmentSequenceBaseDescriptor(ref_allele=ref_allele, alt_allele=alt_allele,
-                                                                          is_ref=is_ref, is_alt=is_alt, is_ins=is_ins,
-                                                                          is_del=is_del,
-                                                                          is_soft_clipped=is_soft_clipped)
-
-            alt_allele = pileupread.alignment.query_sequence[pileupread.query_position]
-            is_alt = True
-            return PileupReadKnapsack.AlignmentSequenceBaseDescriptor(ref_allele=ref_allele, alt_allele=alt_allele,
-                                                                      is_ref=is_ref, is_alt=is_alt, is_ins=is_ins,
-                                                                      is_del=is_del, is_soft_clipped=is_soft_clipped)
+        @property
+        def code(self):
+            return self._code
 
         @property
         def ref_allele(self):
@@ -127,27 +148,32 @@ class PileupReadKnapsack(object):
 
         @property
         def alt_allele(self):
-            return self._alt_allele
+            descriptor = PileupReadKnapsack.AlignmentSequenceBaseDescriptor
+            if not self._code & descriptor.IS_ALT:
+                return None
+            if self._code & descriptor.IS_OTHER_ALT_ALLELE:
+                return descriptor.OTHER_ALT_ALLELE
+            return descriptor.ALT_ALLELES[(self._code >> descriptor.ALT_ALLELE_SHIFT) & descriptor.ALT_ALLELE_MASK]
 
         @property
         def is_soft_clipped(self):
-            return self._is_soft_clipped
+            return bool(self._code & PileupReadKnapsack.AlignmentSequenceBaseDescriptor.IS_SOFT_CLIPPED)
 
         @property
         def is_alt(self):
-            return self._is_alt
+            return bool(self._code & PileupReadKnapsack.AlignmentSequenceBaseDescriptor.IS_ALT)
 
         @property
         def is_ref(self):
-            return self._is_ref
+            return bool(self._code & PileupReadKnapsack.AlignmentSequenceBaseDescriptor.IS_REF)
 
         @property
         def is_ins(self):
-            return self._is_ins
+            return bool(self._code & PileupReadKnapsack.AlignmentSequenceBaseDescriptor.IS_INS)
 
         @property
         def is_del(self):
-            return self._is_del
+            return bool(self._code & PileupReadKnapsack.AlignmentSequenceBaseDescriptor.IS_DEL)
 
     class BasePairAggregateCounts():
         def __init__(self, num_ref, num_alt, num_ins, num_del, num_soft_clipped):
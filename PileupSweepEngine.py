@@ -0,0 +1,234 @@
+from collections import deque
+from AlignedSegmentCache import AlignedSegmentCache
+from BasePairUtils import BasePairUtils
+from PileupColumnKnapsack import PileupColumnKnapsack
+from PileupColumnMatrix import PileupColumnMatrix
+from PileupReadFilter import PileupReadFilter
+
+
+class PileupSweepEngine(object):
+
+    # Sites closer than this (in bp) share a single forward pileup; roughly two read lengths
+    DEFAULT_MERGE_DISTANCE = 300
+
+    def __init__(self, sample_bam_file, ref_seq_file, merge_distance=None, columnar=False, genome_mask=None,
+                 pileup_read_filter=None, fragment_downsampler=None):
+        self._sample_bam_file = sample_bam_file
+        self._ref_seq_file = ref_seq_file
+        self._merge_distance = PileupSweepEngine.DEFAULT_MERGE_DISTANCE if merge_distance is None else \
+            merge_distance
+        self._pileupcolumn_knapsack_class = PileupColumnMatrix if columnar else PileupColumnKnapsack
+        self._genome_mask = genome_mask  # masked context columns are never snapshotted
+        # flags and mapping quality are left to htslib; base quality and mismatches are judged per site (see
+        # _filter_pileupreads), so that reads filtered at one column still delimit the site's context
+        self._pileup_read_filter = PileupReadFilter.DEFAULT if pileup_read_filter is None else pileup_read_filter
+        self._fragment_downsampler = fragment_downsampler  # caps the fragments of each site, see _release
+
+    @property
+    def merge_distance(self):
+        return self._merge_distance
+
+    @staticmethod
+    def merge_site_positions(site_positions, merge_distance):
+        # sorted, unique site positions -> [(window_start, window_end, [site positions]), ...]
+        windows = []
+        for site_position in sorted(set(site_positions)):
+            if windows and site_position - windows[-1][1] < merge_distance:
+                windows[-1][1] = site_position + 1
+                windows[-1][2].append(site_position)
+            else:
+                windows.append([site_position, site_position + 1, [site_position]])
+        return [(window_start, window_end, positions) for window_start, window_end, positions in windows]
+
+    def retrieve(self, chrom, site_positions):
+        # yields (site position, site pileupcolumn snapshot, pileupcolumn knapsack) in coordinate order
+        for window_start, window_end, positions in \
+                PileupSweepEngine.merge_site_positions(site_positions, self._merge_distance):
+            for site in self._sweep(chrom, window_start, window_end, positions):
+                yield site
+
+    def _sweep(self, chrom, window_start, window_end, site_positions):
+        site_position_set = set(site_positions)
+        pending_site_positions = deque(site_positions)
+        site_pileupcolumn_snapshots = {}  # site position -> snapshot of the site column
+        site_ends = {}  # site position -> right-most reference end of the reads covering the site
+        pileupcolumn_snapshots = deque()  # sliding column buffer
+        mate_base_qualities = {}  # query name -> base qualities of overlapping mates, shared by the window's sites
+        aligned_segment_cache = AlignedSegmentCache()  # shared by the knapsacks of the window's sites
+        max_reference_length = 0
+
+        if hasattr(self._ref_seq_file, "prefetch"):
+            # one reference fetch for the whole region, also serving the other sample's engine when shared
+            self._ref_seq_file.prefetch(chrom, window_start, window_end)
+
+        # Base qualities are filtered per site (see _release): a merged window loads mates that a pileup restricted
+        # to the site would never see, so htslib's own mate overlap handling is redone there for the site's reads.
+        for pileupcolumn in self._sample_bam_file.pileup(chrom, window_start, window_end, truncate=False,
+                                                         ignore_overlaps=False,
+                                                         **self._pileup_read_filter.retrieve_pileup_options(
+                                                             min_base_quality=0)):
+            position = pileupcolumn.pos
+            is_masked = self._genome_mask is not None and self._genome_mask.is_masked(chrom, position)
+            if not is_masked or position in site_position_set:  # a masked site is still needed for its own table
+                pileupreads = pileupcolumn.pileups
+                base_qualities = pileupcolumn.get_query_qualities()
+                read_spans = [(pileupread.alignment.reference_start, pileupread.alignment.reference_end)
+                              for pileupread in pileupreads]
+                max_reference_length = max([max_reference_length] + [end - start for start, end in read_spans])
+
+                ref_allele = self._ref_seq_file.fetch(chrom, position, position+1)
+                pileupcolumn_snapshot = PileupSweepEngine.PileupColumnSnapshot(position, ref_allele, pileupreads,
+                                                                               base_qualities, read_spans, is_masked)
+                pileupcolumn_snapshots.append(pileupcolumn_snapshot)
+
+                if position in site_position_set:
+                    site_pileupcolumn_snapshots[position] = pileupcolumn_snapshot
+                    site_ends[position] = max([end for _, end in read_spans] + [position + 1])
+
+            # hand out every site whose reads have been fully swept
+            while pending_site_positions and PileupSweepEngine._is_site_swept(pending_site_positions[0], position,
+                                                                              site_ends):
+                yield PileupSweepEngine._release(chrom, pending_site_positions.popleft(), pileupcolumn_snapshots,
+                                                 site_pileupcolumn_snapshots, site_ends, mate_base_qualities,
+                                                 aligned_segment_cache, self._pileupcolumn_knapsack_class,
+                                                 self._pileup_read_filter, self._fragment_downsampler)
+
+            # drop columns and reads that no pending site can reach anymore
+            lowest_position = pending_site_positions[0] - max_reference_length if pending_site_positions else \
+                position + 1
+            while pileupcolumn_snapshots and pileupcolumn_snapshots[0].pos < lowest_position:
+                pileupcolumn_snapshots.popleft()
+            aligned_segment_cache.evict(lowest_position)
+
+        while pending_site_positions:
+            yield PileupSweepEngine._release(chrom, pending_site_positions.popleft(), pileupcolumn_snapshots,
+                                             site_pileupcolumn_snapshots, site_ends, mate_base_qualities,
+                                             aligned_segment_cache, self._pileupcolumn_knapsack_class,
+                                             self._pileup_read_filter, self._fragment_downsampler)
+
+    @staticmethod
+    def _is_site_swept(site_position, position, site_ends):
+        if site_position in site_ends:
+            return position + 1 >= site_ends[site_position]
+        return position > site_position  # site column never showed up (no coverage)
+
+    @staticmethod
+    def _filter_pileupreads(site_position, pileupcolumn_snapshot, site_mate_base_qualities,
+                            pileup_read_filter=PileupReadFilter.DEFAULT):
+        # -> (whether any read overlaps the site, the overlapping reads passing the base quality and mismatch
+        # filters)
+        is_overlapped = False
+        pileupreads = []
+        for pileupread, base_quality, (start, end) in zip(pileupcolumn_snapshot.pileups,
+                                                          pileupcolumn_snapshot.base_qualities,
+                                                          pileupcolumn_snapshot.read_spans):
+            if not start <= site_position < end:
+                continue
+            is_overlapped = True
+
+            if site_mate_base_qualities:
+                base_qualities = \
+                    site_mate_base_qualities.get(BasePairUtils.retrieve_read_key(pileupread.alignment))
+                if base_qualities is not None:
+                    # mirrors pysam: deletions are judged on the base that follows them
+                    query_position = pileupread.query_position_or_next
+                    base_quality = base_qualities[query_position] if query_position < len(base_qualities) else 0
+
+            if base_quality >= pileup_read_filter.min_base_quality and \
+                    pileup_read_filter.is_aligned_segment_included(pileupread.alignment):
+                pileupreads += [pileupread]
+        return is_overlapped, pileupreads
+
+    @staticmethod
+    def _release(chrom, site_position, pileupcolumn_snapshots, site_pileupcolumn_snapshots, site_ends,
+                 mate_base_qualities, aligned_segment_cache=None, pileupcolumn_knapsack_class=PileupColumnKnapsack,
+                 pileup_read_filter=PileupReadFilter.DEFAULT, fragment_downsampler=None):
+        site_pileupcolumn_snapshot = site_pileupcolumn_snapshots.pop(site_position, None)
+        site_ends.pop(site_position, None)
+
+        if site_pileupcolumn_snapshot is None:
+            return site_position, PileupSweepEngine.PileupColumnSnapshot(site_position, None, []), \
+                pileupcolumn_knapsack_class.create_from_pileupcolumn_snapshots(chrom, site_position, [],
+                                                                               aligned_segment_cache)
+
+        # pileupreads at the site are in load order, as are the mates htslib pairs up when only the site is piled up
+        site_mate_base_qualities = \
+            BasePairUtils.retrieve_overlapping_mate_base_qualities([pileupread.alignment for pileupread in
+                                                                    site_pileupcolumn_snapshot.pileups],
+                                                                   mate_base_qualities)
+        _, site_pileupreads = PileupSweepEngine._filter_pileupreads(site_position, site_pileupcolumn_snapshot,
+                                                                    site_mate_base_qualities, pileup_read_filter)
+        sampling_fraction = 1.0
+        if fragment_downsampler is not None:
+            # the context columns keep only the sampled fragments too
+            site_pileupreads, sampled_query_names, sampling_fraction = \
+                fragment_downsampler.downsample(site_pileupreads)
+            pileup_read_filter = pileup_read_filter.restrict(sampled_query_names)
+
+        # only the reads overlapping the site, as a pileup restricted to the site would return; a column is kept
+        # even when all of its reads fail the base quality filter
+        overlapping_pileupcolumn_snapshots = []
+        for pileupcolumn_snapshot in pileupcolumn_snapshots:
+            if pileupcolumn_snapshot.is_masked:  # kept for its own site only
+                continue
+            is_overlapped, pileupreads = PileupSweepEngine._filter_pileupreads(site_position, pileupcolumn_snapshot,
+                                                                               site_mate_base_qualities,
+                                                                               pileup_read_filter)
+            if is_overlapped:
+                overlapping_pileupcolumn_snapshots += \
+                    [PileupSweepEngine.PileupColumnSnapshot(pileupcolumn_snapshot.pos,
+                                                            pileupcolumn_snapshot.ref_allele, pileupreads)]
+
+        pileupcolumn_knapsack = \
+            pileupcolumn_knapsack_class.create_from_pileupcolumn_snapshots(chrom, site_position,
+                                                                           overlapping_pileupcolumn_snapshots,
+                                                                           aligned_segment_cache)
+        return site_position, \
+            PileupSweepEngine.PileupColumnSnapshot(site_position, site_pileupcolumn_snapshot.ref_allele,
+                                                   site_pileupreads, sampling_fraction=sampling_fraction), \
+            pileupcolumn_knapsack
+
+    class PileupColumnSnapshot(object):
+        # stands in for a pysam PileupColumn once the pileup iterator has moved past it
+
+        def __init__(self, pos, ref_allele, pileups, base_qualities=None, read_spans=None, is_masked=False,
+                     sampling_fraction=1.0):
+            self._pos = pos
+            self._ref_allele = ref_allele
+            self._pileups = pileups
+            self._base_qualities = base_qualities
+            self._read_spans = read_spans
+            self._is_masked = is_masked
+            self._sampling_fraction = sampling_fraction  # of the column's fragments, see FragmentDownsampler
+
+        @property
+        def pos(self):
+            return self._pos
+
+        @property
+        def reference_pos(self):
+            return self._pos
+
+        @property
+        def ref_allele(self):
+            return self._ref_allele
+
+        @property
+        def pileups(self):
+            return self._pileups
+
+        @property
+        def base_qualities(self):
+            return self._base_qualities
+
+        @property
+        def read_spans(self):
+            return self._read_spans
+
+        @property
+        def is_masked(self):
+            return self._is_masked
+
+        @property
+        def sampling_fraction(self):
+            return self._sampling_fraction
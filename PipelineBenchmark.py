@@ -0,0 +1,196 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+import numpy
+import pandas
+import pysam
+from pysam import AlignmentFile
+from pysam import FastaFile
+from ArtifactAnalysisTable import ArtifactAnalysisTable
+from BasePairUtils import BasePairUtils
+from FisherExactTest import FisherExactTest
+from MutationalFeatureTable import MutationalFeatureTable
+from PileupColumnKnapsack import PileupColumnKnapsack
+from PileupColumnMask import PileupColumnMask
+from PileupColumnMatrix import PileupColumnMatrix
+from SyntheticFixtureGenerator import SyntheticFixtureGenerator
+import FFPEAritfactFinder
+
+STAGES = ["site_pileupcolumn", "knapsack_create", "mask_create", "table_create", "fisher_exact_test",
+          "row_assembly"]
+
+
+class PipelineBenchmark(object):
+
+    # Times the stages of retrieve_mutational_features one by one on a fixture (the site by site path, as in the
+    # default run), and the whole call end to end.
+
+    def __init__(self, filenames, feature_options=None, repeats=1):
+        # filenames as returned by SyntheticFixtureGenerator.create
+        self._filenames = filenames
+        self._feature_options = dict(feature_options or {})
+        self._repeats = repeats
+        self._mutations_dataframe = pandas.read_csv(filenames["maf_filename"], sep="\t", header=0, comment="#")
+
+    @property
+    def site_count(self):
+        return len(self._mutations_dataframe)
+
+    def time_stages(self):
+        # -> {stage: {"seconds": total, "calls": count}}
+        stage_timings = dict([(stage, dict(seconds=0.0, calls=0)) for stage in STAGES])
+
+        def time_stage(stage, function, *args):
+            start_time = time.time()
+            result = function(*args)
+            stage_timings[stage]["seconds"] += time.time() - start_time
+            stage_timings[stage]["calls"] += 1
+            return result
+
+        case_sample_bam_file = AlignmentFile(self._filenames["case_sample_bam_filename"], "rb")
+        control_sample_bam_file = AlignmentFile(self._filenames["control_sample_bam_filename"], "rb")
+        ref_seq_file = FastaFile(self._filenames["ref_seq_filename"])
+        fisher_exact_test = FisherExactTest()
+        pileupcolumn_knapsack_class = PileupColumnMatrix if self._feature_options.get("columnar") else \
+            PileupColumnKnapsack
+        mutational_feature_table = MutationalFeatureTable(self._mutations_dataframe.index,
+                                                          fisher_exact_test=fisher_exact_test)
+
+        for index, mutation_row in self._mutations_dataframe.iterrows():
+            chrom = str(mutation_row["Chromosome"])
+            start = mutation_row["Start_position"] - 1
+            end = mutation_row["End_position"]
+            ref_allele = mutation_row["Reference_Allele"]
+            alt_allele = mutation_row["Tumor_Seq_Allele2"]
+
+            sample_bam_files = [("case_", case_sample_bam_file), ("control_", control_sample_bam_file)]
+            pileupcolumn_knapsacks = [time_stage("knapsack_create", pileupcolumn_knapsack_class.create, chrom, start,
+                                                 end, sample_bam_file, ref_seq_file)
+                                      for _, sample_bam_file in sample_bam_files]
+            pileupcolumn_names_mask = time_stage(
+                "mask_create", lambda: BasePairUtils.intersect_pileupcolumn_masks(
+                    *[PileupColumnMask.create(pileupcolumn_knapsack)
+                      for pileupcolumn_knapsack in pileupcolumn_knapsacks]))
+
+            for (prefix, sample_bam_file), pileupcolumn_knapsack in zip(sample_bam_files, pileupcolumn_knapsacks):
+                pileupcolumn = time_stage("site_pileupcolumn", FFPEAritfactFinder.retrieve_pileupcolumn, chrom,
+                                          start, end, sample_bam_file)
+                data_table = time_stage("table_create", ArtifactAnalysisTable.create, ref_allele, alt_allele,
+                                        pileupcolumn, pileupcolumn_knapsack, pileupcolumn_names_mask)
+                time_stage("row_assembly", mutational_feature_table.insert, [index], prefix, data_table)
+        time_stage("fisher_exact_test", mutational_feature_table.test)
+        time_stage("row_assembly", mutational_feature_table.retrieve_dataframe)
+
+        case_sample_bam_file.close()
+        control_sample_bam_file.close()
+        ref_seq_file.close()
+        return stage_timings
+
+    def time_end_to_end(self):
+        # best of the repeats, in seconds
+        seconds = []
+        for _ in range(self._repeats):
+            start_time = time.time()
+            FFPEAritfactFinder.retrieve_mutational_features(
+                self._mutations_dataframe, self._filenames["case_sample_bam_filename"],
+                self._filenames["control_sample_bam_filename"], self._filenames["ref_seq_filename"],
+                **self._feature_options)
+            seconds += [time.time() - start_time]
+        return min(seconds)
+
+
+def retrieve_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.STDOUT).decode("ascii").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare_benchmarks(benchmark, baseline_benchmark):
+    # -> [(depth, site count, seconds, baseline seconds, ratio), ...] for the grid points both runs share
+    baseline_results = dict([((result["parameters"]["depth"], result["parameters"]["site_count"]), result)
+                             for result in baseline_benchmark["results"]])
+    comparisons = []
+    for result in benchmark["results"]:
+        key = (result["parameters"]["depth"], result["parameters"]["site_count"])
+        if key in baseline_results:
+            baseline_seconds = baseline_results[key]["end_to_end_seconds"]
+            comparisons += [key + (result["end_to_end_seconds"], baseline_seconds,
+                                   result["end_to_end_seconds"] / baseline_seconds if baseline_seconds else None)]
+    return comparisons
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline stages on synthetic fixtures.", epilog="")
+    parser.add_argument("--output_json_filename", dest="output_json_filename", action="store", required=True,
+                        help="Benchmark results are written here as JSON.")
+    parser.add_argument("--baseline_json_filename", dest="baseline_json_filename", action="store", required=False,
+                        default=None, help="Earlier results to print the end to end ratios against.")
+    parser.add_argument("--depths", dest="depths", action="store", required=False, default="20,50,100",
+                        help="Comma separated read depths of the scaling grid.")
+    parser.add_argument("--site_counts", dest="site_counts", action="store", required=False, default="25,100",
+                        help="Comma separated site counts of the scaling grid.")
+    parser.add_argument("--read_length", dest="read_length", action="store", type=int, required=False,
+                        default=None, help="Read length of the fixtures.")
+    parser.add_argument("--indel_rate", dest="indel_rate", action="store", type=float, required=False,
+                        default=None, help="Fraction of reads carrying an insertion or a deletion.")
+    parser.add_argument("--soft_clip_rate", dest="soft_clip_rate", action="store", type=float, required=False,
+                        default=None, help="Fraction of reads with a leading soft clip.")
+    parser.add_argument("--repeats", dest="repeats", action="store", type=int, required=False, default=1,
+                        help="End to end runs per grid point; the fastest is kept.")
+    parser.add_argument("--fixture_dirname", dest="fixture_dirname", action="store", required=False, default=None,
+                        help="Where fixtures are written and kept; a temporary directory otherwise.")
+    parser.add_argument("--sweep", dest="sweep", action="store_true", required=False,
+                        help="Benchmark the end to end run with --sweep.")
+    parser.add_argument("--columnar", dest="columnar", action="store_true", required=False,
+                        help="Benchmark with --columnar.")
+
+    args, _ = parser.parse_known_args()
+
+    feature_options = dict(sweep=args.sweep, columnar=args.columnar)
+    fixture_dirname = args.fixture_dirname if args.fixture_dirname is not None else tempfile.mkdtemp()
+
+    results = []
+    try:
+        for depth in [int(depth) for depth in args.depths.split(",")]:
+            for site_count in [int(site_count) for site_count in args.site_counts.split(",")]:
+                synthetic_fixture_generator = SyntheticFixtureGenerator(depth=depth, read_length=args.read_length,
+                                                                        indel_rate=args.indel_rate,
+                                                                        soft_clip_rate=args.soft_clip_rate,
+                                                                        site_count=site_count)
+                filenames = synthetic_fixture_generator.create(
+                    os.path.join(fixture_dirname, "depth_%d_sites_%d" % (depth, site_count)))
+                pipeline_benchmark = PipelineBenchmark(filenames, feature_options, args.repeats)
+                end_to_end_seconds = pipeline_benchmark.time_end_to_end()
+                results += [dict(parameters=synthetic_fixture_generator.parameters,
+                                 end_to_end_seconds=end_to_end_seconds,
+                                 seconds_per_site=end_to_end_seconds / max(pipeline_benchmark.site_count, 1),
+                                 stages=pipeline_benchmark.time_stages())]
+                print("depth %d, %d sites: %.3fs" % (depth, site_count, end_to_end_seconds))
+    finally:
+        if args.fixture_dirname is None:
+            shutil.rmtree(fixture_dirname)
+
+    benchmark = dict(commit=retrieve_commit(), timestamp=time.strftime("%Y-%m-%dT%H:%M:%S"),
+                     environment=dict(python=platform.python_version(), pysam=pysam.__version__,
+                                      numpy=numpy.__version__, pandas=pandas.__version__),
+                     feature_options=feature_options, results=results)
+    with open(args.output_json_filename, "w") as output_json_file:
+        json.dump(benchmark, output_json_file, indent=2)
+
+    if args.baseline_json_filename is not None:
+        with open(args.baseline_json_filename) as baseline_json_file:
+            for depth, site_count, seconds, baseline_seconds, ratio in \
+                    compare_benchmarks(benchmark, json.load(baseline_json_file)):
+                print("depth %d, %d sites: %.3fs vs %.3fs (x%.2f)" % (depth, site_count, seconds, baseline_seconds,
+                                                                      ratio if ratio is not None else float("nan")))
+
+
+if __name__ == "__main__":
+    main()
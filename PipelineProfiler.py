@@ -0,0 +1,190 @@
+from collections import OrderedDict
+import heapq
+import itertools
+import time
+try:
+    import tracemalloc
+except ImportError:  # Python 2
+    tracemalloc = None
+
+
+class PipelineProfiler(object):
+
+    # Wall time, call counts and traced peak memory per stage, plus per site work, the slowest sites and summed
+    # counters (e.g. handle pool hits). Stages are not nested. PipelineProfiler.DISABLED stands in when profiling is
+    # off, so instrumented code needs no branches. Other threads record into profilers of their own (see
+    # create_thread_profiler); tracemalloc traces the whole process, so once they run the peaks also hold their
+    # allocations, which the report states as its peak_memory_scope.
+    DEFAULT_SLOWEST_SITE_COUNT = 10
+
+    def __init__(self, slowest_site_count=None, trace_memory=True):
+        self._slowest_site_count = PipelineProfiler.DEFAULT_SLOWEST_SITE_COUNT if slowest_site_count is None else \
+            slowest_site_count
+        self._trace_memory = trace_memory and tracemalloc is not None
+        self._stages = OrderedDict()  # stage -> {"seconds", "calls", "peak_memory_bytes"}
+        self._site_count = 0
+        self._pileupcolumn_count = 0
+        self._pileupread_count = 0
+        self._slowest_sites = []  # min heap of (seconds, order, site)
+        self._order = itertools.count()
+        self._counters = OrderedDict()  # counter -> {name: count}
+        self._has_threads = False  # whether other threads allocated while stages were traced
+
+    @property
+    def is_enabled(self):
+        return True
+
+    def start(self):
+        if self._trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def stop(self):
+        if self._trace_memory and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    def stage(self, name):
+        return PipelineProfiler.StageTimer(self, name)
+
+    def create_thread_profiler(self):
+        # -> a profiler for another thread, e.g. a SitePrefetcher's, merged into this one once the thread is done;
+        # it traces no memory itself
+        self._has_threads = True
+        return PipelineProfiler(slowest_site_count=0, trace_memory=False)
+
+    def _insert_stage(self, name, seconds, calls=1, peak_memory_bytes=None):
+        stage = self._stages.setdefault(name, dict(seconds=0.0, calls=0, peak_memory_bytes=None))
+        stage["seconds"] += seconds
+        stage["calls"] += calls
+        if peak_memory_bytes is not None:
+            stage["peak_memory_bytes"] = max(stage["peak_memory_bytes"] or 0, peak_memory_bytes)
+
+    def _insert_site(self, site):
+        entry = (site["seconds"], next(self._order), site)
+        if len(self._slowest_sites) < self._slowest_site_count:
+            heapq.heappush(self._slowest_sites, entry)
+        elif self._slowest_sites and entry[0] > self._slowest_sites[0][0]:
+            heapq.heapreplace(self._slowest_sites, entry)
+
+    def record_site(self, chrom, position, seconds, pileupcolumn_knapsacks):
+        # pileupcolumn_knapsacks: the site's case and control knapsacks; columns and reads visited are summed
+        pileupcolumn_count = 0
+        pileupread_count = 0
+        for pileupcolumn_knapsack in pileupcolumn_knapsacks:
+            knapsack_pileupcolumn_count, knapsack_pileupread_count = \
+                PipelineProfiler.retrieve_knapsack_size(pileupcolumn_knapsack)
+            pileupcolumn_count += knapsack_pileupcolumn_count
+            pileupread_count += knapsack_pileupread_count
+        self._site_count += 1
+        self._pileupcolumn_count += pileupcolumn_count
+        self._pileupread_count += pileupread_count
+        self._insert_site(dict(chrom=chrom, position=int(position), seconds=seconds,
+                               pileupcolumns=pileupcolumn_count, pileupreads=pileupread_count))
+
+    def record_counts(self, counter, counts):
+        # counts: {name: count}, added to the counter's
+        counter_counts = self._counters.setdefault(counter, OrderedDict())
+        for name, count in counts.items():
+            counter_counts[name] = counter_counts.get(name, 0) + count
+
+    @staticmethod
+    def retrieve_knapsack_size(pileupcolumn_knapsack):
+        # -> (columns, read/column pairs) of a PileupColumnKnapsack or a PileupColumnMatrix, (columns, reads) of a
+        # ReadFetchEngine knapsack, (columns, class/column counts) of a ControlFeatureStore knapsack
+        if hasattr(pileupcolumn_knapsack, "stored_count_length"):
+            return len(pileupcolumn_knapsack.pileupcolumn_names), pileupcolumn_knapsack.stored_count_length
+        if hasattr(pileupcolumn_knapsack, "aligned_segments"):
+            return len(pileupcolumn_knapsack.pileupcolumn_names), \
+                sum([len(aligned_segments) for aligned_segments in pileupcolumn_knapsack.aligned_segments.values()])
+        if hasattr(pileupcolumn_knapsack, "codes"):
+            return len(pileupcolumn_knapsack.pileupcolumn_names), int((pileupcolumn_knapsack.codes != 0).sum())
+        return len(pileupcolumn_knapsack.pileupcolumn_names), \
+            sum([len(pileupread_knapsack.pileupreads)
+                 for pileupread_knapsack in pileupcolumn_knapsack.pileupread_knapsacks.values()])
+
+    def merge(self, report):
+        # folds in the report of another profiler, e.g. one run in a pool worker
+        for name, stage in report["stages"].items():
+            self._insert_stage(name, stage["seconds"], stage["calls"], stage["peak_memory_bytes"])
+        self._site_count += report["sites"]["count"]
+        self._pileupcolumn_count += report["sites"]["pileupcolumns"]
+        self._pileupread_count += report["sites"]["pileupreads"]
+        for site in report["slowest_sites"]:
+            self._insert_site(site)
+        for counter, counts in report.get("counters", {}).items():
+            self.record_counts(counter, counts)
+        if report.get("peak_memory_scope") == "process":
+            self._has_threads = True
+
+    def retrieve_report(self):
+        # peak_memory_scope: "stage" when the peaks are the stages' own allocations, "process" when they include
+        # those of threads running alongside
+        return dict(stages=self._stages, peak_memory_scope="process" if self._has_threads else "stage",
+                    sites=dict(count=self._site_count, pileupcolumns=self._pileupcolumn_count,
+                               pileupreads=self._pileupread_count),
+                    counters=self._counters,
+                    slowest_sites=[site for _, _, site in sorted(self._slowest_sites, key=lambda entry: -entry[0])])
+
+    class StageTimer(object):
+
+        def __init__(self, pipeline_profiler, name):
+            self._pipeline_profiler = pipeline_profiler
+            self._name = name
+            self._start_time = None
+            self._start_memory_bytes = None
+
+        def __enter__(self):
+            if self._pipeline_profiler._trace_memory and tracemalloc.is_tracing():
+                if hasattr(tracemalloc, "reset_peak"):
+                    tracemalloc.reset_peak()
+                self._start_memory_bytes = tracemalloc.get_traced_memory()[0]
+            self._start_time = time.time()
+            return self
+
+        def __exit__(self, exc_type, exc_value, traceback):
+            seconds = time.time() - self._start_time
+            peak_memory_bytes = None
+            if self._start_memory_bytes is not None:
+                peak_memory_bytes = max(tracemalloc.get_traced_memory()[1] - self._start_memory_bytes, 0)
+            self._pipeline_profiler._insert_stage(self._name, seconds, peak_memory_bytes=peak_memory_bytes)
+            return False
+
+    class DisabledPipelineProfiler(object):
+        # same interface, does nothing
+
+        class DisabledStageTimer(object):
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, exc_type, exc_value, traceback):
+                return False
+
+        _DISABLED_STAGE_TIMER = DisabledStageTimer()
+
+        @property
+        def is_enabled(self):
+            return False
+
+        def start(self):
+            pass
+
+        def stop(self):
+            pass
+
+        def stage(self, name):
+            return PipelineProfiler.DisabledPipelineProfiler._DISABLED_STAGE_TIMER
+
+        def create_thread_profiler(self):
+            return self
+
+        def record_site(self, chrom, position, seconds, pileupcolumn_knapsacks):
+            pass
+
+        def record_counts(self, counter, counts):
+            pass
+
+        def merge(self, report):
+            pass
+
+
+PipelineProfiler.DISABLED = PipelineProfiler.DisabledPipelineProfiler()
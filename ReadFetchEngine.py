@@ -0,0 +1,442 @@
+from BasePairUtils import BasePairUtils
+from PileupReadFilter import PileupReadFilter
+from PileupSweepEngine import PileupSweepEngine
+from ReferenceSequenceWindow import ReferenceSequenceWindow
+from collections import OrderedDict
+import re
+import numpy
+
+
+class ReadFetchEngine(object):
+
+    # Builds a site's table inputs from the reads overlapping the site alone: one fetch(), then each read's calls on
+    # every column it spans straight from its CIGAR and MD tag (reads without MD are compared to the reference; NM is
+    # not trusted, as CRAM decoding regenerates MD yet keeps whatever NM was stored). Nothing is piled up, yet the
+    # counts are the pileup engines': the same flag, base quality and mate overlap rules as htslib, a read counts at a
+    # column only where it would be in that column's pileup, and where two mates share a column the later one wins,
+    # as in PileupReadKnapsack. Unlike pileup(), depth is not capped.
+    MD_TAG = "MD"
+    MD_PATTERN = re.compile(r"(\d+)|\^([A-Za-z]+)|([A-Za-z])")
+    MATCH_OPERATIONS = (BasePairUtils.BAM_CMATCH, BasePairUtils.BAM_CEQUAL, BasePairUtils.BAM_CDIFF)
+    SKIP_OPERATIONS = (BasePairUtils.BAM_CDEL, BasePairUtils.BAM_CREF_SKIP)
+    QUERY_OPERATIONS = (BasePairUtils.BAM_CINS, BasePairUtils.BAM_CSOFT_CLIP)
+    MISSING_BASE_QUALITY = 0xFF  # what htslib stores for reads without base qualities
+
+    def __init__(self, sample_bam_file, ref_seq_file, genome_mask=None, pileup_read_filter=None,
+                 fragment_downsampler=None):
+        self._sample_bam_file = sample_bam_file
+        self._ref_seq_file = ref_seq_file
+        self._genome_mask = genome_mask
+        self._pileup_read_filter = PileupReadFilter.DEFAULT if pileup_read_filter is None else pileup_read_filter
+        self._fragment_downsampler = fragment_downsampler
+
+    def retrieve(self, chrom, position):
+        # -> (site pileupcolumn snapshot, knapsack of the site's reads)
+        pileup_read_filter = self._pileup_read_filter
+        # the reads htslib would pile up: they all delimit columns and take part in mate overlaps, even those the
+        # other filters drop later
+        flag_filter = pileup_read_filter.flag_filter | PileupReadFilter.BAM_FUNMAP
+        aligned_segments = [aligned_segment for aligned_segment in self._sample_bam_file.fetch(chrom, position,
+                                                                                                position+1)
+                            if not aligned_segment.flag & flag_filter and aligned_segment.cigartuples]
+        mate_base_qualities = BasePairUtils.retrieve_overlapping_mate_base_qualities(aligned_segments)
+        base_qualities = [ReadFetchEngine.retrieve_base_qualities(aligned_segment, mate_base_qualities)
+                          for aligned_segment in aligned_segments]
+
+        site_pileupreads = []
+        for aligned_segment, aligned_segment_base_qualities in zip(aligned_segments, base_qualities):
+            site_pileupread = ReadFetchEngine.FetchedPileupRead.create(aligned_segment, position)
+            if site_pileupread is None:
+                continue
+            query_position = site_pileupread.query_position_or_next
+            # mirrors pysam: deletions are judged on the base that follows them
+            base_quality = aligned_segment_base_qualities[query_position] \
+                if query_position < len(aligned_segment_base_qualities) else 0
+            if base_quality >= pileup_read_filter.min_base_quality and \
+                    pileup_read_filter.is_aligned_segment_included(aligned_segment):
+                site_pileupreads += [site_pileupread]
+
+        sampling_fraction = 1.0
+        if self._fragment_downsampler is not None:
+            site_pileupreads, sampled_query_names, sampling_fraction = \
+                self._fragment_downsampler.downsample(site_pileupreads)
+            pileup_read_filter = pileup_read_filter.restrict(sampled_query_names)
+
+        ref_allele = self._ref_seq_file.fetch(chrom, position, position+1)
+        return PileupSweepEngine.PileupColumnSnapshot(position, ref_allele, site_pileupreads,
+                                                      sampling_fraction=sampling_fraction), \
+            ReadFetchEngine.AlignedSegmentKnapsack.create(chrom, position, aligned_segments, base_qualities,
+                                                          self._ref_seq_file, self._genome_mask, pileup_read_filter)
+
+    @staticmethod
+    def retrieve_base_qualities(aligned_segment, mate_base_qualities):
+        base_qualities = mate_base_qualities.get(BasePairUtils.retrieve_read_key(aligned_segment))
+        if base_qualities is None:
+            base_qualities = aligned_segment.query_qualities
+        if base_qualities is None:
+            return numpy.full(aligned_segment.query_length, ReadFetchEngine.MISSING_BASE_QUALITY, dtype=numpy.int32)
+        return numpy.asarray(base_qualities, dtype=numpy.int32)
+
+    class FetchedPileupRead(object):
+        # stands in for a pysam PileupRead at the site
+
+        __slots__ = ("_alignment", "_query_position_or_next", "_is_del", "_is_refskip", "_indel")
+
+        def __init__(self, alignment, query_position_or_next, is_del, is_refskip, indel):
+            self._alignment = alignment
+            self._query_position_or_next = query_position_or_next
+            self._is_del = is_del
+            self._is_refskip = is_refskip
+            self._indel = indel
+
+        @property
+        def alignment(self):
+            return self._alignment
+
+        @property
+        def query_position(self):
+            return None if self._is_del or self._is_refskip else self._query_position_or_next
+
+        @property
+        def query_position_or_next(self):
+            return self._query_position_or_next
+
+        @property
+        def is_del(self):
+            return self._is_del
+
+        @property
+        def is_refskip(self):
+            return self._is_refskip
+
+        @property
+        def indel(self):
+            return self._indel
+
+        @staticmethod
+        def create(aligned_segment, position):
+            # None when the read does not span position
+            cigartuples = aligned_segment.cigartuples
+            reference_offset = position - aligned_segment.reference_start
+            query_position = 0
+            for cigar_index, (operation, length) in enumerate(cigartuples):
+                if operation in ReadFetchEngine.MATCH_OPERATIONS:
+                    if 0 <= reference_offset < length:
+                        indel = 0
+                        if reference_offset == length - 1 and cigar_index + 1 < len(cigartuples):
+                            # as in htslib, the indel following the last base of a match
+                            next_operation, next_length = cigartuples[cigar_index + 1]
+                            if next_operation == BasePairUtils.BAM_CDEL:
+                                indel = -next_length
+                            elif next_operation == BasePairUtils.BAM_CINS:
+                                indel = next_length
+                        return ReadFetchEngine.FetchedPileupRead(aligned_segment, query_position + reference_offset,
+                                                                 False, False, indel)
+                    reference_offset -= length
+                    query_position += length
+                elif operation in ReadFetchEngine.SKIP_OPERATIONS:
+                    if 0 <= reference_offset < length:
+                        return ReadFetchEngine.FetchedPileupRead(aligned_segment, query_position,
+                                                                 operation == BasePairUtils.BAM_CDEL,
+                                                                 operation == BasePairUtils.BAM_CREF_SKIP, 0)
+                    reference_offset -= length
+                elif operation in ReadFetchEngine.QUERY_OPERATIONS:
+                    query_position += length
+            return None
+
+    class AlignedSegmentColumns(object):
+        # one read's calls on each column of its aligned span, as arrays indexed by position - reference_start
+
+        def __init__(self, reference_start, is_present, is_ref, non_ref_lengths, binarized_non_ref_lengths,
+                     soft_clipped_length, soft_clipped_region_count):
+            self._reference_start = reference_start
+            self._is_present = is_present  # the read would be in the column's pileup
+            self._is_ref = is_ref
+            self._non_ref_lengths = non_ref_lengths
+            self._binarized_non_ref_lengths = binarized_non_ref_lengths
+            self._soft_clipped_length = soft_clipped_length
+            self._soft_clipped_region_count = soft_clipped_region_count
+
+        @property
+        def reference_start(self):
+            return self._reference_start
+
+        @property
+        def reference_end(self):
+            return self._reference_start + len(self._is_present)
+
+        @property
+        def is_present(self):
+            return self._is_present
+
+        def retrieve_bp_counts(self, is_selected, binarize_length=True):
+            # is_selected: the columns to count, indexed like the arrays -> (ref, non ref, soft clipped)
+            is_counted = self._is_present & is_selected
+            column_count = int(numpy.count_nonzero(is_counted))
+            non_ref_lengths = self._binarized_non_ref_lengths if binarize_length else self._non_ref_lengths
+            return int(numpy.count_nonzero(self._is_ref & is_counted)), int(non_ref_lengths[is_counted].sum()), \
+                column_count * (self._soft_clipped_region_count if binarize_length else self._soft_clipped_length)
+
+        def retrieve_column_bp_counts(self, is_selected, binarize_length=True):
+            # retrieve_bp_counts column by column -> (ref, non ref, soft clipped) arrays indexed like the arrays
+            is_counted = self._is_present & is_selected
+            non_ref_lengths = self._binarized_non_ref_lengths if binarize_length else self._non_ref_lengths
+            return (self._is_ref & is_counted).astype(numpy.int64), numpy.where(is_counted, non_ref_lengths, 0), \
+                is_counted * (self._soft_clipped_region_count if binarize_length else self._soft_clipped_length)
+
+        @staticmethod
+        def _retrieve_md_mismatches(md, cigartuples, length):
+            # MD walks the matched and deleted reference bases; -> mismatch flags by reference offset
+            md_offsets = []
+            reference_offset = 0
+            for operation, operation_length in cigartuples:
+                if operation in ReadFetchEngine.MATCH_OPERATIONS or operation == BasePairUtils.BAM_CDEL:
+                    md_offsets += range(reference_offset, reference_offset + operation_length)
+                if operation in ReadFetchEngine.MATCH_OPERATIONS or operation in ReadFetchEngine.SKIP_OPERATIONS:
+                    reference_offset += operation_length
+
+            mismatches = numpy.zeros(length, dtype=bool)
+            md_index = 0
+            for match_length, deleted_bases, mismatched_base in ReadFetchEngine.MD_PATTERN.findall(md):
+                if match_length:
+                    md_index += int(match_length)
+                elif deleted_bases:
+                    md_index += len(deleted_bases)
+                else:
+                    if md_index < len(md_offsets):
+                        mismatches[md_offsets[md_index]] = True
+                    md_index += 1
+            return mismatches
+
+        @staticmethod
+        def create(chrom, aligned_segment, base_qualities, min_base_quality, ref_seq_file):
+            reference_start = aligned_segment.reference_start
+            length = aligned_segment.reference_end - reference_start
+            cigartuples = aligned_segment.cigartuples
+
+            # query position of each column, the next one for deletions and reference skips
+            query_positions = numpy.zeros(length, dtype=numpy.int64)
+            is_match = numpy.zeros(length, dtype=bool)
+            indels = numpy.zeros(length, dtype=numpy.int64)
+            soft_clipped_length = soft_clipped_region_count = 0
+            reference_offset = query_position = 0
+            for cigar_index, (operation, operation_length) in enumerate(cigartuples):
+                if operation in ReadFetchEngine.MATCH_OPERATIONS:
+                    query_positions[reference_offset:reference_offset + operation_length] = \
+                        numpy.arange(query_position, query_position + operation_length)
+                    is_match[reference_offset:reference_offset + operation_length] = True
+                    if cigar_index + 1 < len(cigartuples):
+                        next_operation, next_length = cigartuples[cigar_index + 1]
+                        if next_operation == BasePairUtils.BAM_CDEL:
+                            indels[reference_offset + operation_length - 1] = -next_length
+                        elif next_operation == BasePairUtils.BAM_CINS:
+                            indels[reference_offset + operation_length - 1] = next_length
+                    reference_offset += operation_length
+                    query_position += operation_length
+                elif operation in ReadFetchEngine.SKIP_OPERATIONS:
+                    query_positions[reference_offset:reference_offset + operation_length] = query_position
+                    reference_offset += operation_length
+                elif operation in ReadFetchEngine.QUERY_OPERATIONS:
+                    query_position += operation_length
+                    if operation != BasePairUtils.BAM_CINS:
+                        soft_clipped_length += operation_length
+                        soft_clipped_region_count += 1
+
+            # as pysam's pileup, a read leaves a column whose base (or next base) fails min_base_quality
+            is_within_query = query_positions < len(base_qualities)
+            is_present = numpy.zeros(length, dtype=bool)
+            is_present[is_within_query] = base_qualities[query_positions[is_within_query]] >= min_base_quality
+
+            if aligned_segment.has_tag(ReadFetchEngine.MD_TAG):
+                md = aligned_segment.get_tag(ReadFetchEngine.MD_TAG)
+                if md.isdigit():  # neither mismatches nor deletions
+                    mismatches = numpy.zeros(length, dtype=bool)
+                else:
+                    mismatches = ReadFetchEngine.AlignedSegmentColumns._retrieve_md_mismatches(md, cigartuples,
+                                                                                               length)
+                mismatches &= is_match
+            else:
+                ref_bases = numpy.frombuffer(ref_seq_file.fetch(chrom, reference_start,
+                                                                reference_start + length).encode("ascii"),
+                                             dtype=numpy.uint8)
+                query_bases = numpy.frombuffer(aligned_segment.query_sequence.encode("ascii"), dtype=numpy.uint8)
+                mismatches = numpy.zeros(length, dtype=bool)
+                mismatches[is_match] = query_bases[query_positions[is_match]] != ref_bases[is_match]
+
+            # as ArtifactAnalysisTableUtils: a ref call needs no following insertion, a non ref length adds the
+            # mismatch to the following indel
+            is_ref = is_match & ~mismatches & (indels <= 0)
+            non_ref_lengths = numpy.where(is_match, numpy.abs(indels) + mismatches, 0)
+            binarized_non_ref_lengths = numpy.where(is_match, (indels != 0).astype(numpy.int64) + mismatches, 0)
+            return ReadFetchEngine.AlignedSegmentColumns(reference_start, is_present, is_ref, non_ref_lengths,
+                                                         binarized_non_ref_lengths, soft_clipped_length,
+                                                         soft_clipped_region_count)
+
+    class AlignedSegmentKnapsack(object):
+        # stands in for PileupColumnKnapsack: the site's columns and, on demand, its reads' calls on them
+
+        def __init__(self, chrom, start, column_positions, aligned_segments, ref_seq_file, min_base_quality):
+            self._chrom = chrom
+            self._start = start
+            self._column_positions = column_positions
+            self._aligned_segments = aligned_segments  # query name -> [(aligned segment, base qualities), ...]
+            self._ref_seq_file = ref_seq_file
+            self._min_base_quality = min_base_quality
+            self._pileupcolumn_positions = None  # pileupcolumn name -> position, built on first use
+
+        @property
+        def chrom(self):
+            return self._chrom
+
+        @property
+        def start(self):
+            return self._start
+
+        @property
+        def aligned_segments(self):
+            return self._aligned_segments
+
+        @property
+        def aligned_segment_cache(self):
+            return None
+
+        @property
+        def pileupcolumn_names(self):
+            return self._retrieve_pileupcolumn_positions().keys()
+
+        def _retrieve_pileupcolumn_positions(self):
+            if self._pileupcolumn_positions is None:
+                self._pileupcolumn_positions = OrderedDict([
+                    (BasePairUtils.retrieve_pileupcolumn_name(self._chrom, position, position+1), position)
+                    for position in self._column_positions])
+            return self._pileupcolumn_positions
+
+        def retrieve_ref_allele(self, pileupcolumn_name):
+            ref_allele = None
+            pileupcolumn_positions = self._retrieve_pileupcolumn_positions()
+            if pileupcolumn_name in pileupcolumn_positions:
+                position = pileupcolumn_positions[pileupcolumn_name]
+                ref_allele = self._ref_seq_file.fetch(self._chrom, position, position+1)
+            return ref_allele
+
+        @property
+        def column_positions(self):
+            return self._column_positions
+
+        def detach(self):
+            # loads the reference bases its reads span into a window of its own; the reads' calls are then worked out
+            # without the engine's reference, e.g. in another thread while the engine moves on to the next sites
+            aligned_segments = [aligned_segment for query_aligned_segments in self._aligned_segments.values()
+                                for aligned_segment, _ in query_aligned_segments]
+            ref_seq_file = ReferenceSequenceWindow(self._ref_seq_file, padding=0)
+            if aligned_segments:
+                ref_seq_file.prefetch(self._chrom, min([aligned_segment.reference_start
+                                                        for aligned_segment in aligned_segments]),
+                                      max([aligned_segment.reference_end for aligned_segment in aligned_segments]))
+            self._ref_seq_file = ref_seq_file
+            return self
+
+        def retrieve_aligned_segment_columns(self, pileupread_alignment_query_name):
+            # -> [AlignedSegmentColumns, ...] of the fragment's reads, in load order
+            return [ReadFetchEngine.AlignedSegmentColumns.create(self._chrom, aligned_segment, base_qualities,
+                                                                 self._min_base_quality, self._ref_seq_file)
+                    for aligned_segment, base_qualities in
+                    self._aligned_segments.get(pileupread_alignment_query_name, [])]
+
+        def retrieve_indexed_pileupreads(self, pileupread_alignment_query_names, pileupcolumn_mask):
+            # counterpart of ArtifactAnalysisTableUtils.retrieve_indexed_pileupreads
+            unmasked_positions = [position for pileupcolumn_name, position in
+                                  self._retrieve_pileupcolumn_positions().items()
+                                  if not pileupcolumn_mask.get(pileupcolumn_name, True)]
+            aligned_segment_columns = OrderedDict()
+            for pileupread_alignment_query_name in pileupread_alignment_query_names or []:
+                if self._aligned_segments.get(pileupread_alignment_query_name):
+                    aligned_segment_columns[pileupread_alignment_query_name] = \
+                        self.retrieve_aligned_segment_columns(pileupread_alignment_query_name)
+            return ReadFetchEngine.IndexedAlignedSegmentKnapsack(aligned_segment_columns, unmasked_positions)
+
+        @staticmethod
+        def create(chrom, start, aligned_segments, base_qualities, ref_seq_file, genome_mask=None,
+                   pileup_read_filter=None):
+            # aligned_segments: every read htslib would pile up at start, in load order
+            pileup_read_filter = PileupReadFilter.DEFAULT if pileup_read_filter is None else pileup_read_filter
+
+            # columns: whatever any of the reads spans, but the site itself and the masked positions
+            column_positions = []
+            column_end = None
+            for reference_start, reference_end in sorted([(aligned_segment.reference_start,
+                                                           aligned_segment.reference_end)
+                                                          for aligned_segment in aligned_segments]):
+                column_start = reference_start if column_end is None else max(reference_start, column_end)
+                column_end = reference_end if column_end is None else max(reference_end, column_end)
+                column_positions += range(column_start, column_end)
+            column_positions = [position for position in column_positions
+                                if position != start and
+                                (genome_mask is None or not genome_mask.is_masked(chrom, position))]
+
+            # the reads that make it into pileups, by query name in load order
+            included_aligned_segments = OrderedDict()
+            for aligned_segment, aligned_segment_base_qualities in zip(aligned_segments, base_qualities):
+                if pileup_read_filter.is_aligned_segment_included(aligned_segment):
+                    included_aligned_segments.setdefault(aligned_segment.query_name, [])
+                    included_aligned_segments[aligned_segment.query_name] += \
+                        [(aligned_segment, aligned_segment_base_qualities)]
+
+            return ReadFetchEngine.AlignedSegmentKnapsack(chrom, start, column_positions, included_aligned_segments,
+                                                          ref_seq_file, pileup_read_filter.min_base_quality)
+
+    class IndexedAlignedSegmentKnapsack(object):
+        # the selected reads' calls on the unmasked columns; answers the ArtifactAnalysisTableUtils counts
+
+        def __init__(self, aligned_segment_columns, unmasked_positions):
+            self._aligned_segment_columns = aligned_segment_columns  # query name -> [AlignedSegmentColumns, ...]
+            self._unmasked_positions = numpy.array(sorted(unmasked_positions), dtype=numpy.int64)
+
+        @staticmethod
+        def retrieve_fragment_selections(aligned_segment_columns):
+            # -> per read of a fragment, the columns where it is counted: a later mate present at a column replaces
+            # it there
+            selections = []
+            for index, columns in enumerate(aligned_segment_columns):
+                is_selected = numpy.ones(len(columns.is_present), dtype=bool)
+                for later_columns in aligned_segment_columns[index + 1:]:
+                    overlap_start = max(columns.reference_start, later_columns.reference_start)
+                    overlap_end = min(columns.reference_end, later_columns.reference_end)
+                    if overlap_start < overlap_end:
+                        is_selected[overlap_start - columns.reference_start:
+                                    overlap_end - columns.reference_start] &= \
+                            ~later_columns.is_present[overlap_start - later_columns.reference_start:
+                                                      overlap_end - later_columns.reference_start]
+                selections += [is_selected]
+            return selections
+
+        def _retrieve_bp_counts(self, pileupread_alignment_query_names, binarize_length=True):
+            counts = [0, 0, 0]
+            for pileupread_alignment_query_name in set(pileupread_alignment_query_names or []):
+                aligned_segment_columns = self._aligned_segment_columns.get(pileupread_alignment_query_name, [])
+                for columns, is_selected in zip(aligned_segment_columns,
+                                                ReadFetchEngine.IndexedAlignedSegmentKnapsack.
+                                                retrieve_fragment_selections(aligned_segment_columns)):
+                    is_unmasked = numpy.zeros(len(columns.is_present), dtype=bool)
+                    unmasked_positions = self._unmasked_positions[
+                        numpy.searchsorted(self._unmasked_positions, columns.reference_start):
+                        numpy.searchsorted(self._unmasked_positions, columns.reference_end)]
+                    is_unmasked[unmasked_positions - columns.reference_start] = True
+                    for count_index, count in enumerate(columns.retrieve_bp_counts(is_selected & is_unmasked,
+                                                                                   binarize_length)):
+                        counts[count_index] += count
+            return counts
+
+        def retrieve_ref_bp_count(self, pileupread_alignment_query_names=None):
+            return self._retrieve_bp_counts(pileupread_alignment_query_names)[0]
+
+        def retrieve_non_ref_bp_count(self, pileupread_alignment_query_names=None, binarize_length=True):
+            return self._retrieve_bp_counts(pileupread_alignment_query_names, binarize_length)[1]
+
+        def retrieve_soft_clipped_bp_count(self, pileupread_alignment_query_names=None, binarize_length=True):
+            return self._retrieve_bp_counts(pileupread_alignment_query_names, binarize_length)[2]
+
+        def retrieve_bp_counts(self, ref_supporting_pileupread_alignment_query_names,
+                               alt_supporting_pileupread_alignment_query_names, binarize_length=True):
+            return tuple(self._retrieve_bp_counts(ref_supporting_pileupread_alignment_query_names, binarize_length) +
+                         self._retrieve_bp_counts(alt_supporting_pileupread_alignment_query_names, binarize_length))
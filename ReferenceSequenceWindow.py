@@ -0,0 +1,47 @@
+class ReferenceSequenceWindow(object):
+
+    # bases loaded on either side of a missed position; covers a site's pileup context with room to spare
+    DEFAULT_PADDING = 1024
+
+    def __init__(self, ref_seq_file, padding=None):
+        # stands in for ref_seq_file (FastaFile or PackedReferenceGenome) wherever only fetch() is used
+        self._ref_seq_file = ref_seq_file
+        self._padding = ReferenceSequenceWindow.DEFAULT_PADDING if padding is None else padding
+        self._chrom = None
+        self._start = 0
+        self._sequence = ""
+
+    @property
+    def ref_seq_file(self):
+        return self._ref_seq_file
+
+    @property
+    def chrom(self):
+        return self._chrom
+
+    @property
+    def start(self):
+        return self._start
+
+    @property
+    def end(self):
+        return self._start + len(self._sequence)
+
+    def is_covered(self, chrom, start, end):
+        return chrom == self._chrom and self._start <= start and end <= self.end
+
+    def prefetch(self, chrom, start, end):
+        # loads [start - padding, end + padding) in a single fetch unless the window already covers [start, end)
+        if not self.is_covered(chrom, start, end):
+            self._chrom = chrom
+            self._start = max(0, start - self._padding)
+            self._sequence = self._ref_seq_file.fetch(chrom, self._start, end + self._padding)
+
+    def fetch(self, chrom, start, end):
+        self.prefetch(chrom, start, end)
+        if not self.is_covered(chrom, start, end):  # runs past the end of the contig
+            return self._ref_seq_file.fetch(chrom, start, end)
+        return self._sequence[start - self._start:end - self._start]
+
+    def close(self):
+        self._ref_seq_file.close()
@@ -0,0 +1,187 @@
+import os
+import threading
+from collections import OrderedDict
+
+
+class SampleSiteCache(object):
+
+    # Keeps the sites (site pileupcolumn, pileupcolumn knapsack) of a bam that more than one pair reads, e.g. a normal
+    # shared by several tumors at a recurrent hotspot, so that the pileup and knapsack are built once per process and
+    # then handed to every pair reading that locus; each pair still builds its own mask and tables from them. The
+    # plan (see plan()) says how many pairs read each such locus; a site is dropped once the last of them took it,
+    # and the kept sites' estimated size is capped at max_site_bytes (the least recently used go first). Sites are
+    # read and kept from the prefetch threads as well, hence the lock. Each process keeps its own sites, so with a
+    # pool the pairs (shards) reading the same loci are run together (see group()) and each such task gets the plan
+    # of its own pairs.
+    DEFAULT_MAX_SITE_BYTES = 256 * 1024 * 1024
+    # estimated Python heap of a site, knapsack and pileupcolumn, per unit of its knapsack (measured at 300x on
+    # SyntheticFixtureGenerator's fixtures): a PileupColumnKnapsack's pileupread, a PileupColumnMatrix's code byte, a
+    # ReadFetchEngine knapsack's aligned segment
+    PILEUPREAD_BYTES = 400
+    CODE_BYTES = 4
+    ALIGNED_SEGMENT_BYTES = 1280
+
+    def __init__(self, planned_site_uses=None, max_site_bytes=None):
+        # planned_site_uses: {(bam filename, chrom, position): number of pairs reading it}
+        self._remaining_site_uses = dict([(SampleSiteCache.retrieve_key(sample_bam_filename, chrom, position), uses)
+                                          for (sample_bam_filename, chrom, position), uses in
+                                          (planned_site_uses or {}).items()])
+        self._sample_keys = set([key[0] for key in self._remaining_site_uses])
+        self._max_site_bytes = SampleSiteCache.DEFAULT_MAX_SITE_BYTES if max_site_bytes is None else max_site_bytes
+        self._sites = OrderedDict()  # key -> (site, estimated bytes), least recently used first
+        self._site_bytes = 0
+        self._lock = threading.Lock()
+        self._hit_count = 0
+        self._miss_count = 0
+        self._eviction_count = 0
+
+    @property
+    def max_site_bytes(self):
+        return self._max_site_bytes
+
+    @property
+    def site_bytes(self):
+        return self._site_bytes
+
+    @property
+    def site_count(self):
+        return len(self._sites)
+
+    def retrieve_counts(self):
+        return dict(hits=self._hit_count, misses=self._miss_count, evictions=self._eviction_count)
+
+    @staticmethod
+    def retrieve_key(sample_bam_filename, chrom, position):
+        return os.path.abspath(sample_bam_filename), str(chrom), int(position)
+
+    @staticmethod
+    def _retrieve_site_keys(mutations_dataframe, case_sample_bam_filename, control_sample_bam_filename):
+        # -> set of the (bam filename, chrom, position) the pair reads
+        loci = set([(str(chrom), int(start_position) - 1) for chrom, start_position in
+                    zip(mutations_dataframe["Chromosome"], mutations_dataframe["Start_position"])])
+        return set([(sample_bam_filename, chrom, position) for chrom, position in loci
+                    for sample_bam_filename in set([case_sample_bam_filename, control_sample_bam_filename])])
+
+    @staticmethod
+    def plan(pairs):
+        # pairs: [(mutations dataframe, case bam, control bam), ...] -> {(bam filename, chrom, position): number of
+        # pairs reading it} for the loci more than one pair reads from the same bam
+        site_uses = {}
+        for mutations_dataframe, case_sample_bam_filename, control_sample_bam_filename in pairs:
+            for key in SampleSiteCache._retrieve_site_keys(mutations_dataframe, case_sample_bam_filename,
+                                                           control_sample_bam_filename):
+                site_uses[key] = site_uses.get(key, 0) + 1
+        return dict([(key, uses) for key, uses in site_uses.items() if uses > 1])
+
+    @staticmethod
+    def group(pairs, costs, max_group_cost):
+        # pairs as plan's, costs: their estimated costs -> [[pair index, ...], ...] in the order of their first pairs;
+        # pairs reading the same locus of a bam are put in one group (the most read loci first) as long as the
+        # group's cost stays within max_group_cost, so that the groups can still be spread over a pool
+        pair_indices = list(range(len(pairs)))
+        parent_indices = list(pair_indices)  # union find forest
+        group_costs = list(costs)
+
+        def find(pair_index):
+            while parent_indices[pair_index] != pair_index:
+                parent_indices[pair_index] = parent_indices[parent_indices[pair_index]]
+                pair_index = parent_indices[pair_index]
+            return pair_index
+
+        key_pair_indices = OrderedDict()  # (bam filename, chrom, position) -> [pair index, ...]
+        for pair_index, (mutations_dataframe, case_sample_bam_filename, control_sample_bam_filename) in \
+                enumerate(pairs):
+            for key in sorted(SampleSiteCache._retrieve_site_keys(mutations_dataframe, case_sample_bam_filename,
+                                                                  control_sample_bam_filename)):
+                key_pair_indices.setdefault(key, [])
+                key_pair_indices[key] += [pair_index]
+        for key_indices in sorted([key_indices for key_indices in key_pair_indices.values() if len(key_indices) > 1],
+                                  key=lambda key_indices: -len(key_indices)):
+            for pair_index in key_indices[1:]:
+                group_index, other_group_index = find(key_indices[0]), find(pair_index)
+                if group_index != other_group_index and \
+                        group_costs[group_index] + group_costs[other_group_index] <= max_group_cost:
+                    parent_indices[other_group_index] = group_index
+                    group_costs[group_index] += group_costs[other_group_index]
+
+        groups = OrderedDict()
+        for pair_index in pair_indices:
+            groups.setdefault(find(pair_index), [])
+            groups[find(pair_index)] += [pair_index]
+        return list(groups.values())
+
+    @staticmethod
+    def retrieve_site_bytes(site):
+        _, pileupcolumn_knapsack = site
+        if hasattr(pileupcolumn_knapsack, "codes"):
+            return pileupcolumn_knapsack.codes.nbytes * SampleSiteCache.CODE_BYTES
+        if hasattr(pileupcolumn_knapsack, "aligned_segments"):
+            return sum([len(aligned_segments) for aligned_segments in
+                        pileupcolumn_knapsack.aligned_segments.values()]) * SampleSiteCache.ALIGNED_SEGMENT_BYTES
+        return sum([len(pileupread_knapsack.pileupreads)
+                    for pileupread_knapsack in pileupcolumn_knapsack.pileupread_knapsacks.values()]) * \
+            SampleSiteCache.PILEUPREAD_BYTES
+
+    def retrieve_sample(self, sample_bam_filename):
+        # -> the bam's view of the cache, or None when no locus of it is planned
+        if os.path.abspath(sample_bam_filename) not in self._sample_keys:
+            return None
+        return SampleSiteCache.CachedSample(self, sample_bam_filename)
+
+    def _retrieve(self, key):
+        # one use of the locus -> its site, or None when it was not kept (yet)
+        with self._lock:
+            if key not in self._remaining_site_uses:
+                return None
+            self._remaining_site_uses[key] -= 1
+            site, site_bytes = self._sites.pop(key, (None, 0))
+            if site is None:
+                self._miss_count += 1
+            else:
+                self._hit_count += 1
+                if self._remaining_site_uses[key] > 0:
+                    self._sites[key] = (site, site_bytes)
+                else:
+                    self._site_bytes -= site_bytes
+            if self._remaining_site_uses[key] <= 0:
+                del self._remaining_site_uses[key]
+            return site
+
+    def _is_planned(self, key):
+        # whether a pair reads the locus later on
+        with self._lock:
+            return key in self._remaining_site_uses
+
+    def _insert(self, key, site):
+        site_bytes = SampleSiteCache.retrieve_site_bytes(site)
+        with self._lock:
+            # a site larger than the whole cap is not kept at all
+            if key not in self._remaining_site_uses or site_bytes > self._max_site_bytes:
+                return
+            _, replaced_site_bytes = self._sites.pop(key, (None, 0))
+            self._sites[key] = (site, site_bytes)
+            self._site_bytes += site_bytes - replaced_site_bytes
+            while self._site_bytes > self._max_site_bytes:
+                _, (_, evicted_site_bytes) = self._sites.popitem(last=False)
+                self._site_bytes -= evicted_site_bytes
+                self._eviction_count += 1
+
+    class CachedSample(object):
+
+        # one bam's sites; looked up and kept by (chrom, position) like ControlFeatureStore.StoredSample
+
+        def __init__(self, sample_site_cache, sample_bam_filename):
+            self._sample_site_cache = sample_site_cache
+            self._sample_bam_filename = sample_bam_filename
+
+        def retrieve(self, chrom, position):
+            return self._sample_site_cache._retrieve(SampleSiteCache.retrieve_key(self._sample_bam_filename, chrom,
+                                                                                  position))
+
+        def is_planned(self, chrom, position):
+            return self._sample_site_cache._is_planned(SampleSiteCache.retrieve_key(self._sample_bam_filename, chrom,
+                                                                                    position))
+
+        def insert(self, chrom, position, site):
+            self._sample_site_cache._insert(SampleSiteCache.retrieve_key(self._sample_bam_filename, chrom, position),
+                                            site)
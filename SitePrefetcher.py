@@ -0,0 +1,79 @@
+import sys
+import threading
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
+from PipelineProfiler import PipelineProfiler
+
+
+class SitePrefetcher(object):
+
+    # Runs one sample's site iterator (its pileup columns and knapsacks, site after site) in a thread of its own and
+    # hands the sites over through a bounded queue. htslib releases the GIL while it inflates and decodes, so the
+    # case and control bams are read ahead at the same time while the tables of the current site are computed. A full
+    # queue blocks the thread, so at most queue_size sites are ever held ahead of the consumer. Iterates like the
+    # wrapped iterator; an exception raised in the thread is raised again by next(). The stages the iterator records
+    # into thread_pipeline_profiler (see PipelineProfiler.create_thread_profiler) are merged into pipeline_profiler
+    # once the thread is done.
+    DEFAULT_QUEUE_SIZE = 4
+    POLL_SECONDS = 0.1  # how often a blocked thread checks whether the consumer is gone
+    _END = object()
+
+    def __init__(self, sites, queue_size=None, pipeline_profiler=None, thread_pipeline_profiler=None):
+        # the iterator and whatever it reads (bam handle, reference window) must not be used by any other thread
+        self._queue = queue.Queue(maxsize=SitePrefetcher.DEFAULT_QUEUE_SIZE if queue_size is None else queue_size)
+        self._pipeline_profiler = PipelineProfiler.DISABLED if pipeline_profiler is None else pipeline_profiler
+        self._thread_pipeline_profiler = PipelineProfiler.DISABLED if thread_pipeline_profiler is None else \
+            thread_pipeline_profiler
+        self._is_closed = threading.Event()
+        self._is_exhausted = False
+        self._thread = threading.Thread(target=self._produce, args=(sites,))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _produce(self, sites):
+        try:
+            for site in sites:
+                if not self._put((True, site)):
+                    return
+            self._put((True, SitePrefetcher._END))
+        except BaseException:
+            self._put((False, sys.exc_info()[1]))
+
+    def _put(self, item):
+        # blocks while the queue is full -> False when the consumer closed the prefetcher meanwhile
+        while not self._is_closed.is_set():
+            try:
+                self._queue.put(item, timeout=SitePrefetcher.POLL_SECONDS)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._is_exhausted:
+            raise StopIteration
+        with self._pipeline_profiler.stage("prefetch_wait"):  # time the consumer starves
+            is_site, site = self._queue.get()
+        if not is_site:
+            self._is_exhausted = True
+            self.close()
+            raise site
+        if site is SitePrefetcher._END:
+            self._is_exhausted = True
+            self.close()
+            raise StopIteration
+        return site
+
+    next = __next__  # Python 2
+
+    def close(self):
+        self._is_closed.set()
+        self._thread.join()
+        if self._thread_pipeline_profiler.is_enabled:  # merged once
+            self._pipeline_profiler.merge(self._thread_pipeline_profiler.retrieve_report())
+            self._thread_pipeline_profiler = PipelineProfiler.DISABLED
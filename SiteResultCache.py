@@ -0,0 +1,103 @@
+import hashlib
+import json
+import os
+import sqlite3
+from collections import OrderedDict
+import pandas
+
+
+class SiteResultCache(object):
+
+    # bump whenever the features computed for a site change, so that older entries are no longer matched
+    VERSION = 1
+    # feature options that do not change a site's features; every engine (sweep, columnar, read_fetch or the
+    # default) computes the same ones
+    IGNORED_FEATURE_OPTIONS = ["site_result_cache_filename", "packed_ref_seq_filename", "io_threads",
+                               "ref_cache_dirname", "control_feature_store_filename", "prefetch_sites", "sweep",
+                               "sweep_merge_distance", "columnar", "read_fetch"]
+    # loci a pair computes between inserts, so that a pair that fails (or is stopped) keeps most of its work
+    INSERT_LOCUS_COUNT = 256
+    SITE_KEY_COLUMNS = ["chrom", "start", "end", "ref_allele", "alt_allele"]
+    # seconds to wait on another process (e.g. a pool worker) holding the database lock
+    TIMEOUT = 600.0
+
+    def __init__(self, site_result_cache_filename, case_sample_bam_filename, control_sample_bam_filename,
+                 ref_seq_filename, feature_options=None):
+        # one cache file serves any number of pairs, references and settings; each gets its own fingerprint
+        self._site_result_cache_filename = site_result_cache_filename
+        self._fingerprint = SiteResultCache.retrieve_fingerprint(case_sample_bam_filename,
+                                                                 control_sample_bam_filename, ref_seq_filename,
+                                                                 feature_options)
+        self._connection = sqlite3.connect(site_result_cache_filename, timeout=SiteResultCache.TIMEOUT)
+        self._connection.execute("CREATE TABLE IF NOT EXISTS site_results (fingerprint TEXT NOT NULL, "
+                                 "chrom TEXT NOT NULL, start INTEGER NOT NULL, end INTEGER NOT NULL, "
+                                 "ref_allele TEXT NOT NULL, alt_allele TEXT NOT NULL, features TEXT NOT NULL, "
+                                 "PRIMARY KEY (fingerprint, chrom, start, end, ref_allele, alt_allele))")
+        self._connection.commit()
+
+    @property
+    def fingerprint(self):
+        return self._fingerprint
+
+    @staticmethod
+    def retrieve_file_identity(filename):
+        # path, size and modification time; a rewritten bam or reference gets a new identity
+        file_stat = os.stat(filename)
+        return [os.path.abspath(filename), file_stat.st_size, int(file_stat.st_mtime)]
+
+    @staticmethod
+    def retrieve_fingerprint(case_sample_bam_filename, control_sample_bam_filename, ref_seq_filename,
+                             feature_options=None):
+        feature_options = dict([(name, value) for name, value in (feature_options or {}).items()
+                                if name not in SiteResultCache.IGNORED_FEATURE_OPTIONS])
+        identity = [SiteResultCache.VERSION,
+                    SiteResultCache.retrieve_file_identity(case_sample_bam_filename),
+                    SiteResultCache.retrieve_file_identity(control_sample_bam_filename),
+                    SiteResultCache.retrieve_file_identity(ref_seq_filename),
+                    sorted([[name, SiteResultCache.retrieve_file_identity(value)
+                             if name.endswith("_filename") and value is not None else repr(value)]
+                            for name, value in feature_options.items()])]
+        return hashlib.sha1(json.dumps(identity).encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def retrieve_site_keys(mutations_dataframe):
+        # -> [(chrom, start, end, ref allele, alt allele), ...], one per row
+        return list(zip(mutations_dataframe["Chromosome"].astype(str).tolist(),
+                        mutations_dataframe["Start_position"].astype("int64").tolist(),
+                        mutations_dataframe["End_position"].astype("int64").tolist(),
+                        mutations_dataframe["Reference_Allele"].astype(str).tolist(),
+                        mutations_dataframe["Tumor_Seq_Allele2"].astype(str).tolist()))
+
+    def retrieve(self, mutations_dataframe):
+        # -> DataFrame of the features of the rows already in the cache, in the rows' order; the rows' keys go into a
+        # temporary table joined against the cache in a single query
+        self._connection.execute("CREATE TEMP TABLE IF NOT EXISTS site_keys (position INTEGER NOT NULL, "
+                                 "chrom TEXT NOT NULL, start INTEGER NOT NULL, end INTEGER NOT NULL, "
+                                 "ref_allele TEXT NOT NULL, alt_allele TEXT NOT NULL)")
+        with self._connection:
+            self._connection.execute("DELETE FROM site_keys")
+            self._connection.executemany("INSERT INTO site_keys VALUES (?, ?, ?, ?, ?, ?)",
+                                         [(position,) + site_key for position, site_key in
+                                          enumerate(SiteResultCache.retrieve_site_keys(mutations_dataframe))])
+        results = self._connection.execute(
+            "SELECT site_keys.position, site_results.features FROM site_keys JOIN site_results ON "
+            "site_results.fingerprint = ? AND %s ORDER BY site_keys.position" %
+            " AND ".join(["site_results.%s = site_keys.%s" % (column, column)
+                          for column in SiteResultCache.SITE_KEY_COLUMNS]), (self._fingerprint,)).fetchall()
+        with self._connection:
+            self._connection.execute("DELETE FROM site_keys")
+        return pandas.DataFrame([OrderedDict(json.loads(features)) for _, features in results],
+                                index=mutations_dataframe.index[[position for position, _ in results]])
+
+    def insert(self, mutations_dataframe, mutational_features):
+        # mutational_features: DataFrame of features indexed like mutations_dataframe; written in one transaction
+        names = mutational_features.columns.tolist()
+        rows = [(self._fingerprint,) + site_key +
+                (json.dumps([[name, float(value)] for name, value in zip(names, values)]),)
+                for site_key, values in zip(SiteResultCache.retrieve_site_keys(mutations_dataframe),
+                                            mutational_features.loc[mutations_dataframe.index].values.tolist())]
+        with self._connection:
+            self._connection.executemany("INSERT OR REPLACE INTO site_results VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+
+    def close(self):
+        self._connection.close()
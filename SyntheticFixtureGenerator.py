@@ -0,0 +1,209 @@
+import argparse
+import os
+import random
+import pysam
+
+MAF_COLUMNS = ["Hugo_Symbol", "Chromosome", "Start_position", "End_position", "Variant_Classification",
+               "Variant_Type", "Reference_Allele", "Tumor_Seq_Allele2", "Tumor_Sample_Barcode",
+               "Matched_Norm_Sample_Barcode"]
+
+
+class SyntheticFixtureGenerator(object):
+
+    # Writes an indexed reference, an indexed case and control bam and a MAF of SNP sites, all consistent with each
+    # other, for benchmarking. Reads are paired, a fraction carry an insertion, a deletion or a leading soft clip,
+    # and the case bam supports each site's alternate allele in alt_fraction of its reads.
+    DEFAULT_CONTIG_LENGTH = 50000
+    DEFAULT_CONTIG_COUNT = 2
+    DEFAULT_DEPTH = 50
+    DEFAULT_READ_LENGTH = 100
+    DEFAULT_INDEL_RATE = 0.05
+    DEFAULT_SOFT_CLIP_RATE = 0.1
+    DEFAULT_MISMATCH_RATE = 0.005
+    DEFAULT_ALT_FRACTION = 0.2
+    DEFAULT_SITE_COUNT = 50
+    BASES = "ACGT"
+
+    def __init__(self, depth=None, read_length=None, indel_rate=None, soft_clip_rate=None, site_count=None,
+                 contig_length=None, contig_count=None, mismatch_rate=None, alt_fraction=None, seed=0):
+        self._depth = SyntheticFixtureGenerator.DEFAULT_DEPTH if depth is None else depth
+        self._read_length = SyntheticFixtureGenerator.DEFAULT_READ_LENGTH if read_length is None else read_length
+        self._indel_rate = SyntheticFixtureGenerator.DEFAULT_INDEL_RATE if indel_rate is None else indel_rate
+        self._soft_clip_rate = SyntheticFixtureGenerator.DEFAULT_SOFT_CLIP_RATE if soft_clip_rate is None else \
+            soft_clip_rate
+        self._site_count = SyntheticFixtureGenerator.DEFAULT_SITE_COUNT if site_count is None else site_count
+        self._contig_length = SyntheticFixtureGenerator.DEFAULT_CONTIG_LENGTH if contig_length is None else \
+            contig_length
+        self._contig_count = SyntheticFixtureGenerator.DEFAULT_CONTIG_COUNT if contig_count is None else \
+            contig_count
+        self._mismatch_rate = SyntheticFixtureGenerator.DEFAULT_MISMATCH_RATE if mismatch_rate is None else \
+            mismatch_rate
+        self._alt_fraction = SyntheticFixtureGenerator.DEFAULT_ALT_FRACTION if alt_fraction is None else \
+            alt_fraction
+        self._seed = seed
+
+    @property
+    def parameters(self):
+        return dict(depth=self._depth, read_length=self._read_length, indel_rate=self._indel_rate,
+                    soft_clip_rate=self._soft_clip_rate, site_count=self._site_count,
+                    contig_length=self._contig_length, contig_count=self._contig_count,
+                    mismatch_rate=self._mismatch_rate, alt_fraction=self._alt_fraction, seed=self._seed)
+
+    def _create_ref_seqs(self, random_generator):
+        return [(str(contig_index + 1),
+                 "".join([random_generator.choice(SyntheticFixtureGenerator.BASES)
+                          for _ in range(self._contig_length)]))
+                for contig_index in range(self._contig_count)]
+
+    def _create_sites(self, random_generator, ref_seqs):
+        # -> sorted [(chrom, zero based position, ref allele, alt allele), ...] spread over the contigs
+        margin = min(2 * self._read_length, self._contig_length // 4)
+        sites = set()
+        while len(sites) < self._site_count:
+            chrom, ref_seq = ref_seqs[random_generator.randrange(len(ref_seqs))]
+            position = random_generator.randrange(margin, self._contig_length - margin)
+            sites.add((chrom, position))
+        ref_seqs = dict(ref_seqs)
+        return [(chrom, position, ref_seqs[chrom][position],
+                 random_generator.choice([base for base in SyntheticFixtureGenerator.BASES
+                                          if base != ref_seqs[chrom][position]]))
+                for chrom, position in sorted(sites, key=lambda site: (int(site[0]), site[1]))]
+
+    def _create_aligned_segment(self, random_generator, header, query_name, flag, chrom, ref_seq, reference_start,
+                                alt_alleles, alt_fraction):
+        read_length = self._read_length
+        reference_start = max(0, min(reference_start, len(ref_seq) - read_length - 4))
+        event = random_generator.random()
+        middle = random_generator.randrange(read_length // 4, 3 * read_length // 4)
+        if event < self._soft_clip_rate:
+            soft_clipped_length = random_generator.randint(2, max(2, read_length // 8))
+            cigartuples = [(pysam.CSOFT_CLIP, soft_clipped_length), (pysam.CMATCH, read_length - soft_clipped_length)]
+        elif event < self._soft_clip_rate + self._indel_rate / 2:
+            cigartuples = [(pysam.CMATCH, middle), (pysam.CINS, 2), (pysam.CMATCH, read_length - middle - 2)]
+        elif event < self._soft_clip_rate + self._indel_rate:
+            cigartuples = [(pysam.CMATCH, middle), (pysam.CDEL, 3), (pysam.CMATCH, read_length - middle)]
+        else:
+            cigartuples = [(pysam.CMATCH, read_length)]
+
+        query_sequence = []
+        reference_position = reference_start
+        for operation, length in cigartuples:
+            if operation == pysam.CMATCH:
+                for _ in range(length):
+                    base = ref_seq[reference_position]
+                    if (chrom, reference_position) in alt_alleles and random_generator.random() < alt_fraction:
+                        base = alt_alleles[(chrom, reference_position)]
+                    elif random_generator.random() < self._mismatch_rate:
+                        base = random_generator.choice(SyntheticFixtureGenerator.BASES)
+                    query_sequence += [base]
+                    reference_position += 1
+            elif operation == pysam.CDEL:
+                reference_position += length
+            else:
+                query_sequence += [random_generator.choice(SyntheticFixtureGenerator.BASES) for _ in range(length)]
+
+        aligned_segment = pysam.AlignedSegment(header)
+        aligned_segment.query_name = query_name
+        aligned_segment.flag = flag
+        aligned_segment.reference_name = chrom
+        aligned_segment.reference_start = reference_start
+        aligned_segment.mapping_quality = random_generator.choice([60, 60, 60, 20, 0])
+        aligned_segment.cigartuples = cigartuples
+        aligned_segment.query_sequence = "".join(query_sequence)
+        aligned_segment.query_qualities = pysam.qualitystring_to_array(
+            "".join([random_generator.choice("I?5+&") for _ in range(read_length)]))
+        return aligned_segment
+
+    def _create_sample_bam(self, random_generator, sample_bam_filename, ref_seqs, alt_alleles, alt_fraction):
+        header = pysam.AlignmentHeader.from_dict(
+            dict(HD=dict(VN="1.6", SO="coordinate"),
+                 SQ=[dict(SN=chrom, LN=len(ref_seq)) for chrom, ref_seq in ref_seqs]))
+        aligned_segments = []
+        for chrom, ref_seq in ref_seqs:
+            pair_count = len(ref_seq) * self._depth // (2 * self._read_length)
+            for pair_index in range(pair_count):
+                query_name = "%s_%s_%d" % (os.path.basename(sample_bam_filename), chrom, pair_index)
+                reference_start = random_generator.randrange(0, len(ref_seq) - self._read_length)
+                mate_reference_start = reference_start + random_generator.randint(-self._read_length // 3,
+                                                                                   self._read_length)
+                aligned_segments += [
+                    self._create_aligned_segment(random_generator, header, query_name, 0x1 | 0x2 | 0x20 | 0x40,
+                                                 chrom, ref_seq, reference_start, alt_alleles, alt_fraction),
+                    self._create_aligned_segment(random_generator, header, query_name, 0x1 | 0x2 | 0x10 | 0x80,
+                                                 chrom, ref_seq, mate_reference_start, alt_alleles, alt_fraction)]
+        for first_aligned_segment, second_aligned_segment in zip(aligned_segments[::2], aligned_segments[1::2]):
+            first_aligned_segment.next_reference_id = second_aligned_segment.reference_id
+            first_aligned_segment.next_reference_start = second_aligned_segment.reference_start
+            second_aligned_segment.next_reference_id = first_aligned_segment.reference_id
+            second_aligned_segment.next_reference_start = first_aligned_segment.reference_start
+
+        aligned_segments.sort(key=lambda aligned_segment: (aligned_segment.reference_id,
+                                                           aligned_segment.reference_start))
+        with pysam.AlignmentFile(sample_bam_filename, "wb", header=header) as sample_bam_file:
+            for aligned_segment in aligned_segments:
+                sample_bam_file.write(aligned_segment)
+        pysam.index(sample_bam_filename)
+
+    def create(self, output_dirname):
+        # -> dict of the written filenames: ref_seq_filename, case/control_sample_bam_filename, maf_filename
+        random_generator = random.Random(self._seed)
+        if not os.path.isdir(output_dirname):
+            os.makedirs(output_dirname)
+        filenames = dict(ref_seq_filename=os.path.join(output_dirname, "ref.fasta"),
+                         case_sample_bam_filename=os.path.join(output_dirname, "case.bam"),
+                         control_sample_bam_filename=os.path.join(output_dirname, "control.bam"),
+                         maf_filename=os.path.join(output_dirname, "mutations.maf"))
+
+        ref_seqs = self._create_ref_seqs(random_generator)
+        with open(filenames["ref_seq_filename"], "w") as ref_seq_file:
+            for chrom, ref_seq in ref_seqs:
+                ref_seq_file.write(">%s\n" % chrom)
+                for line_start in range(0, len(ref_seq), 60):
+                    ref_seq_file.write(ref_seq[line_start:line_start + 60] + "\n")
+        pysam.faidx(filenames["ref_seq_filename"])
+
+        sites = self._create_sites(random_generator, ref_seqs)
+        with open(filenames["maf_filename"], "w") as maf_file:
+            maf_file.write("#version 2.4\n")
+            maf_file.write("\t".join(MAF_COLUMNS) + "\n")
+            for site_index, (chrom, position, ref_allele, alt_allele) in enumerate(sites):
+                maf_file.write("\t".join(["GENE%d" % site_index, chrom, str(position + 1), str(position + 1),
+                                          "Missense_Mutation", "SNP", ref_allele, alt_allele, "CASE",
+                                          "CONTROL"]) + "\n")
+
+        alt_alleles = dict([((chrom, position), alt_allele) for chrom, position, _, alt_allele in sites])
+        self._create_sample_bam(random_generator, filenames["case_sample_bam_filename"], ref_seqs, alt_alleles,
+                                self._alt_fraction)
+        self._create_sample_bam(random_generator, filenames["control_sample_bam_filename"], ref_seqs, alt_alleles,
+                                0.0)
+        return filenames
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write synthetic reference, bam and MAF fixtures.", epilog="")
+    parser.add_argument("--output_dirname", dest="output_dirname", action="store", required=True,
+                        help="Directory the fixtures are written to.")
+    parser.add_argument("--depth", dest="depth", action="store", type=int, required=False, default=None,
+                        help="Mean read depth.")
+    parser.add_argument("--read_length", dest="read_length", action="store", type=int, required=False,
+                        default=None, help="Read length.")
+    parser.add_argument("--indel_rate", dest="indel_rate", action="store", type=float, required=False,
+                        default=None, help="Fraction of reads carrying an insertion or a deletion.")
+    parser.add_argument("--soft_clip_rate", dest="soft_clip_rate", action="store", type=float, required=False,
+                        default=None, help="Fraction of reads with a leading soft clip.")
+    parser.add_argument("--site_count", dest="site_count", action="store", type=int, required=False, default=None,
+                        help="Number of SNP sites in the MAF.")
+    parser.add_argument("--contig_length", dest="contig_length", action="store", type=int, required=False,
+                        default=None, help="Length of each contig.")
+    parser.add_argument("--seed", dest="seed", action="store", type=int, required=False, default=0,
+                        help="Random seed.")
+
+    args, _ = parser.parse_known_args()
+
+    SyntheticFixtureGenerator(depth=args.depth, read_length=args.read_length, indel_rate=args.indel_rate,
+                              soft_clip_rate=args.soft_clip_rate, site_count=args.site_count,
+                              contig_length=args.contig_length, seed=args.seed).create(args.output_dirname)
+
+
+if __name__ == "__main__":
+    main()